@@ -11,10 +11,8 @@ const ComplaintsPage = () => {
     const [searchText, setSearchText] = useState('');
     const [messages, setMessages] = useState([{ text: "Hi! I'm Bob. How can I help you?", isBot: true }]);
     const scrollViewRef = useRef();
-    const [refund_phase, setRefundPhase] = useState("none");
-    const [wrong_drink_phase, setWrongDrinkPhase] = useState("none");
-    const [order_num, setOrderNum] = useState("none");
-    const [drink_nums, setDrinkNums] = useState("none");
+    // The server keeps track of refunds and remakes in progress, we only send back the id of the conversation
+    const [conversationId, setConversationId] = useState(null);
     const [loading, setLoading] = useState(false);
     const navigation = useNavigation();
 
@@ -41,53 +39,41 @@ const ComplaintsPage = () => {
         setLoading(true);
 
         try {
+            // Refunds, remakes and order status only find the logged in user's orders, so send their token if they have one
+            const token = await AsyncStorage.getItem('userToken');
+            const headers = { 'Content-Type': 'application/json' };
+            if (token) {
+                headers['Authorization'] = `Token ${token}`;
+            }
+
             // Make a POST request to the chatbot endpoint
             const response = await fetch(`${BASE_URL}/backend/chatbot/`, {
                 method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json',
-                },
+                headers: headers,
                 body: JSON.stringify({
                     message: userRequest,
-                    refund_phase: refund_phase,
-                    wrong_drink_phase: wrong_drink_phase,
-                    order_num: order_num,
-                    drink_nums: drink_nums
+                    conversation_id: conversationId
                 })
             });
     
             if (response.ok) {
                 const data = await response.json();
                 const botResponse = data.responses;
-                const response_refund_phase = data.refund_phase;
-                const response_wrong_drink_phase = data.wrong_drink_phase;
-                setOrderNum(data.order_num);
-                setDrinkNums(data.drink_nums);
+                setConversationId(data.conversation_id);
 
-                if(response_refund_phase === "none" && response_wrong_drink_phase === "none"){
-                    setRefundPhase(null);
-                    setWrongDrinkPhase(null);
-                    // Replace the "typing" message with the actual response
-                    setMessages((prevMessages) =>
-                        prevMessages.map((msg, index) =>
-                            msg.isLoading ? { text: botResponse, isBot: true } : msg
-                        )
-                    );
-                } else if (response_wrong_drink_phase === "4"){
-                    //I will need to go to the post order page with it processing the newly remade order
-                    // Update messages with bot's response
-                    // Replace the "typing" message with the actual response
-                    setMessages((prevMessages) =>
-                        prevMessages.map((msg, index) =>
-                            msg.isLoading ? { text: botResponse, isBot: true } : msg
-                        )
-                    );
+                // Replace the "typing" message with the actual response
+                setMessages((prevMessages) =>
+                    prevMessages.map((msg, index) =>
+                        msg.isLoading ? { text: botResponse, isBot: true } : msg
+                    )
+                );
 
+                if (data.state === "remade") {
+                    // Go to the post order page with it processing the newly remade order
+                    const order_num = data.order_num;
                     const orderResponse = await fetch(`${BASE_URL}/backend/orders/${order_num}/`, {
                         method: 'GET',
-                        headers: {
-                            'Content-Type': 'application/json',
-                        }
+                        headers: headers
                     });
 
                     if(orderResponse.ok){
@@ -110,17 +96,6 @@ const ComplaintsPage = () => {
                     setTimeout(() => {
                         navigation.navigate("PostCheckout");
                       }, 2000); // 2000 milliseconds = 2 seconds
-                    
-                } else {
-                    setRefundPhase(response_refund_phase);
-                    setWrongDrinkPhase(response_wrong_drink_phase);
-                    // Update messages with bot's response
-                    // Replace the "typing" message with the actual response
-                    setMessages((prevMessages) =>
-                        prevMessages.map((msg, index) =>
-                            msg.isLoading ? { text: botResponse, isBot: true } : msg
-                        )
-                    );
                 }
             } else {
                 throw new Error("Failed to fetch response from chatbot");
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class BackendConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'backend'
+
+    def ready(self):
+        # Connect the model signal receivers
+        from . import signals
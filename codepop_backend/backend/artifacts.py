@@ -0,0 +1,52 @@
+import os
+import threading
+from django.conf import settings
+
+# Where files generated by management commands (embeddings, the intent classifier) are written, not checked in
+cache_dir = getattr(settings, 'DRINKAI_CACHE_DIR', os.path.join(settings.BASE_DIR, 'drinkai_cache'))
+
+
+def save_arrays(path, arrays):
+    """Write the {name: array} dict as an .npz next to path and then swap it in, so readers never see half a file."""
+    import numpy as np
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'wb') as file:
+        np.savez(file, **arrays)
+    os.replace(temporary_path, path)
+
+
+class Reloader:
+    """
+    The object last loaded from a file written by a management command, loaded again when the file changes,
+    so running servers pick up a rebuild without a restart. load(path) returns an object with a version attribute
+    holding the file's st_mtime_ns.
+    """
+
+    def __init__(self, load, description):
+        self.load = load
+        self.description = description
+        self.current = None
+        self._lock = threading.Lock()
+        self._failed_version = None
+
+    def get(self, path):
+        """Return the object loaded from path, or None until the file has been written."""
+        try:
+            version = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+        current = self.current
+        if (current is None or current.version != version) and version != self._failed_version:
+            with self._lock:
+                if self.current is None or self.current.version != version:
+                    try:
+                        self.current = self.load(path)
+                    except (OSError, ValueError, KeyError) as e:
+                        # Keep the old object, and don't retry until the file changes again
+                        self._failed_version = version
+                        print(f"Could not load {self.description}: {e}")
+                current = self.current
+        return current
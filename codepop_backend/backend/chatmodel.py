@@ -0,0 +1,412 @@
+import os
+import queue
+import random
+import re
+import threading
+import time
+import warnings
+from concurrent.futures import Future
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+from django.conf import settings
+from .cache import LRUCache
+
+# Hugging Face model the customer service chatbot answers free-form messages with
+model_name = getattr(settings, 'CHATBOT_MODEL_NAME', 'microsoft/DialoGPT-medium')
+# Where run_chatbot_server listens, a unix socket path (only this user can connect) or "127.0.0.1:port"
+# When set, web workers send messages there instead of loading the model themselves
+inference_address = getattr(settings, 'CHATBOT_INFERENCE_ADDRESS', None)
+# Shared secret between web workers and the inference server, the server unpickles what is sent to it
+# Only read from the environment, so it never ends up checked in, and neither side runs without it
+authkey = os.environ.get('CHATBOT_INFERENCE_AUTHKEY', '').encode()
+# Messages arriving within this many seconds of each other are answered by one batched generate call, 0 turns it off
+batch_window = getattr(settings, 'CHATBOT_BATCH_WINDOW_MS', 5) / 1000
+max_batch_size = getattr(settings, 'CHATBOT_MAX_BATCH_SIZE', 16)
+# How the model runs on CPU: 'fp32' as downloaded, or 'int8' to quantize its linear layers to 8 bit weights when it
+# is loaded (several times less memory for those layers and usually faster, replies can differ slightly)
+inference_backend = getattr(settings, 'CHATBOT_INFERENCE_BACKEND', 'fp32')
+INFERENCE_BACKENDS = ('fp32', 'int8')
+# Most tokens generated for one reply, None generates until the model stops (up to 1000 tokens with the prompt)
+default_max_new_tokens = getattr(settings, 'CHATBOT_MAX_NEW_TOKENS', 128)
+# Messages remembered, how long (seconds) their replies are reused, and replies generated per message before reusing them
+cache_size = getattr(settings, 'CHATBOT_CACHE_SIZE', 512)
+cache_ttl = getattr(settings, 'CHATBOT_CACHE_TTL', 3600)
+cache_replies = getattr(settings, 'CHATBOT_CACHE_REPLIES', 3)
+
+
+class ChatbotUnavailable(Exception):
+    """The inference server could not be reached or failed to answer."""
+
+
+def require_authkey():
+    if not authkey:
+        raise ChatbotUnavailable("Set the CHATBOT_INFERENCE_AUTHKEY environment variable (the same long random value for "
+                                 "the web server and run_chatbot_server) to use the chatbot inference server.")
+
+
+def parse_address(address):
+    """Turn "host:port" into a (host, port) tuple for a TCP socket, anything else is a unix socket path."""
+    host, _, port = address.rpartition(':')
+    if host and port.isdigit():
+        return (host, int(port))
+    return address
+
+
+_tokenizer = None
+_model = None
+_load_lock = threading.Lock()
+
+
+def load_model():
+    """Return the tokenizer and model, loading them the first time they are needed."""
+    global _tokenizer, _model
+    if _model is None:
+        with _load_lock:
+            if _model is None:
+                _tokenizer, _model = load_pretrained(inference_backend)
+    return _tokenizer, _model
+
+
+def load_pretrained(backend='fp32'):
+    """Load the tokenizer and model_name from Hugging Face and prepare the model for backend (see INFERENCE_BACKENDS)."""
+    if backend not in INFERENCE_BACKENDS:
+        raise ValueError(f"Unknown chatbot inference backend {backend!r}, expected one of {', '.join(INFERENCE_BACKENDS)}")
+    # transformers and torch are only imported here, so importing the chatbot costs nothing until it is used
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+    try:
+        tokenizer = AutoTokenizer.from_pretrained(model_name)
+        model = AutoModelForCausalLM.from_pretrained(model_name)
+    except OSError as e:
+        # Not downloaded and no network, the next message tries again
+        raise ChatbotUnavailable(f"Could not load {model_name}: {e}")
+    # Batched prompts are padded on the left, so generation continues right after every prompt's last token
+    tokenizer.pad_token = tokenizer.eos_token
+    tokenizer.padding_side = 'left'
+    return tokenizer, prepare_model(model, backend)
+
+
+def prepare_model(model, backend):
+    """Switch a loaded model to inference mode and convert it for backend."""
+    model.eval()
+    if backend == 'int8':
+        import torch
+        from torch.ao.quantization import quantize_dynamic
+
+        # GPT-2 style models (DialoGPT) keep their attention and MLP weights in Conv1D layers, which dynamic
+        # quantization skips, so they become the equivalent nn.Linear first
+        conv1d_to_linear(model)
+        with warnings.catch_warnings():
+            # torch warns that eager mode quantization is moving to the torchao package
+            warnings.simplefilter('ignore')
+            # In place, a copy would briefly hold the full precision weights twice
+            model = quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    return model
+
+
+def conv1d_to_linear(model):
+    """Replace every transformers Conv1D in model with an nn.Linear computing the same thing."""
+    import torch
+    from transformers.pytorch_utils import Conv1D
+
+    for parent in list(model.modules()):
+        for name, child in list(parent.named_children()):
+            if isinstance(child, Conv1D):
+                # Conv1D computes x @ weight + bias with weight stored (in, out), nn.Linear stores it (out, in)
+                linear = torch.nn.Linear(child.weight.shape[0], child.weight.shape[1])
+                with torch.no_grad():
+                    linear.weight.copy_(child.weight.t())
+                    linear.bias.copy_(child.bias)
+                setattr(parent, name, linear)
+    return model
+
+
+def generation_options(tokenizer, max_new_tokens=None):
+    """Sampling settings shared by every generate call."""
+    max_new_tokens = max_new_tokens or default_max_new_tokens
+    return {
+        'pad_token_id': tokenizer.eos_token_id,
+        'temperature': 1.0,
+        'top_k': 50,
+        'do_sample': True,
+        'top_p': 0.9,
+        **({'max_new_tokens': max_new_tokens} if max_new_tokens else {'max_length': 1000}),
+    }
+
+
+def generate_batch(user_inputs, max_new_tokens=None):
+    """Generate a reply to each message, running them through the model together as one padded batch."""
+    tokenizer, model = load_model()
+
+    # encode the new user inputs, add the eos_token and return padded tensors in Pytorch
+    # (a single message needs no padding and is encoded exactly as on its own)
+    encoded = tokenizer([user_input + tokenizer.eos_token for user_input in user_inputs], return_tensors='pt', padding=True)
+    bot_input_ids = encoded['input_ids']
+
+    # generated a response within the token budget, rows that finish early are padded until the longest one is done
+    chat_history_ids = model.generate(bot_input_ids, attention_mask=encoded['attention_mask'],
+                                      **generation_options(tokenizer, max_new_tokens))
+
+    # Decode each response, everything after the (padded) prompt
+    return [tokenizer.decode(row[bot_input_ids.shape[-1]:], skip_special_tokens=True) for row in chat_history_ids]
+
+
+class BatchScheduler:
+    """
+    Collects items submitted from many threads and hands them to run_batch(items) together on one worker thread.
+    A batch starts with the oldest waiting item and takes whatever else arrives within window seconds (at most max_size),
+    then every submitter's Future gets its own result back.
+    """
+
+    def __init__(self, run_batch, window, max_size):
+        self.run_batch = run_batch
+        self.window = window
+        self.max_size = max_size
+        self._queue = queue.Queue()
+        self._worker = None
+        self._lock = threading.Lock()
+
+    def submit(self, item):
+        future = Future()
+        self._queue.put((item, future))
+        if self._worker is None:
+            with self._lock:
+                if self._worker is None:
+                    self._worker = threading.Thread(target=self._work, daemon=True)
+                    self._worker.start()
+        return future
+
+    def _work(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            try:
+                results = self.run_batch([item for item, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+            else:
+                for (_, future), result in zip(batch, results):
+                    future.set_result(result)
+
+
+# Every message answered by this process goes through one scheduler, so concurrent chats share forward passes
+_scheduler = BatchScheduler(generate_batch, batch_window, max_batch_size)
+
+
+def local_reply(user_input):
+    """Generate a reply with the model loaded in this process, batched with concurrent messages."""
+    if batch_window > 0:
+        return _scheduler.submit(user_input).result()
+    return generate_batch([user_input])[0]
+
+
+def local_stream(user_input, max_new_tokens=None):
+    """Yield the reply to a message piece by piece while the model in this process generates it (never batched)."""
+    from transformers import TextIteratorStreamer
+
+    tokenizer, model = load_model()
+    encoded = tokenizer(user_input + tokenizer.eos_token, return_tensors='pt')
+    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+    errors = []
+
+    def run():
+        try:
+            model.generate(encoded['input_ids'], attention_mask=encoded['attention_mask'], streamer=streamer,
+                           **generation_options(tokenizer, max_new_tokens))
+        except Exception as e:
+            # Ends the stream, which would otherwise wait forever
+            errors.append(e)
+            streamer.end()
+
+    threading.Thread(target=run, daemon=True).start()
+    for text in streamer:
+        if text:
+            yield text
+    if errors:
+        raise ChatbotUnavailable(f"The chatbot model failed: {errors[0]}")
+
+
+def normalize_message(user_input):
+    """Lowercase a message and drop its punctuation and extra spaces, so "Hi!" and "hi" share cached replies."""
+    return " ".join(re.sub(r"[^\w\s]", " ", user_input.lower().replace("'", "")).split())
+
+
+class ReplyCache:
+    """
+    Replies from the model to frequent messages (greetings, store hours...), keyed on the normalized message.
+    The first per_key times a message is seen the model still answers it and the reply is kept,
+    after that one of the kept replies is picked at random, so repeated questions don't always get the same answer.
+    """
+
+    def __init__(self, maxsize, ttl, per_key):
+        self.entries = LRUCache(maxsize, ttl)
+        self.per_key = per_key
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, user_input):
+        """Return a kept reply to the message, or None if the model should answer it."""
+        replies = self.entries.get(normalize_message(user_input)) if self.per_key > 0 else None
+        with self._lock:
+            if replies is None or len(replies) < self.per_key:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return random.choice(replies)
+
+    def add(self, user_input, reply):
+        if self.per_key <= 0 or not reply.strip():
+            return
+        key = normalize_message(user_input)
+        with self._lock:
+            replies = self.entries.get(key) or ()
+            # Concurrent misses on the same message can each bring a reply, past per_key they are dropped
+            if len(replies) < self.per_key:
+                self.entries.set(key, replies + (reply,))
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+# Consulted by the chatbot views before the model, in each web worker
+reply_cache = ReplyCache(cache_size, cache_ttl, cache_replies)
+
+
+# One connection to the inference server per web worker thread, opened on first use
+_connections = threading.local()
+
+
+def send_to_server(message, address=None):
+    """Send message to the inference server at address (CHATBOT_INFERENCE_ADDRESS by default) on this thread's
+    connection, and return the connection with the server's first answer."""
+    require_authkey()
+    address = parse_address(address or inference_address)
+    # A connection the server dropped (e.g. it was restarted) is reopened once
+    for attempt in range(2):
+        connection = getattr(_connections, 'connection', None)
+        try:
+            if connection is None:
+                connection = _connections.connection = Client(address, authkey=authkey)
+            connection.send(message)
+            return connection, connection.recv()
+        except (OSError, EOFError, AuthenticationError) as e:
+            _connections.connection = None
+            if attempt == 1:
+                raise ChatbotUnavailable(f"Could not reach the chatbot inference server: {e}")
+
+
+def remote_reply(user_input, address=None):
+    """Have the inference server generate a reply."""
+    _, (status, result) = send_to_server(user_input, address)
+    if status != 'ok':
+        raise ChatbotUnavailable(f"The chatbot inference server failed: {result}")
+    return result
+
+
+def remote_stream(user_input, address=None):
+    """Yield the pieces of a reply as the inference server streams them."""
+    connection, answer = send_to_server(('stream', user_input), address)
+    finished = False
+    try:
+        while True:
+            status, result = answer
+            if status == 'done':
+                finished = True
+                return
+            if status == 'error':
+                finished = True
+                raise ChatbotUnavailable(f"The chatbot inference server failed: {result}")
+            yield result
+            answer = connection.recv()
+    except (OSError, EOFError) as e:
+        raise ChatbotUnavailable(f"Lost the chatbot inference server: {e}")
+    finally:
+        if not finished:
+            # Stopped halfway (e.g. the client went away), the rest of this stream would be read as the next answer
+            _connections.connection = None
+            connection.close()
+
+
+def generate_reply(user_input):
+    """Reply to a message, through the inference server when one is configured, otherwise with a model in this process."""
+    if inference_address:
+        return remote_reply(user_input)
+    return local_reply(user_input)
+
+
+def stream_reply(user_input):
+    """Like generate_reply, but yields the reply piece by piece as it is generated."""
+    if inference_address:
+        return remote_stream(user_input)
+    return local_stream(user_input)
+
+
+def serve(listener, reply=local_reply, stream=local_stream):
+    """Answer the messages on every connection accepted by listener with reply(message), or stream(message) for
+    ('stream', message) requests, until the listener is closed."""
+    while True:
+        try:
+            connection = listener.accept()
+        except AuthenticationError:
+            continue
+        except OSError:
+            return
+        threading.Thread(target=handle_connection, args=(connection, reply, stream), daemon=True).start()
+
+
+def handle_connection(connection, reply, stream):
+    with connection:
+        while True:
+            try:
+                message = connection.recv()
+                if isinstance(message, tuple) and message[0] == 'stream':
+                    # ('token', text) for every piece, then ('done', None)
+                    try:
+                        for text in stream(message[1]):
+                            connection.send(('token', text))
+                        result = ('done', None)
+                    except (EOFError, OSError):
+                        raise
+                    except Exception as e:
+                        result = ('error', str(e))
+                else:
+                    try:
+                        result = ('ok', reply(message))
+                    except Exception as e:
+                        result = ('error', str(e))
+                connection.send(result)
+            except (EOFError, OSError):
+                # The web worker closed the connection
+                return
+
+
+def listen(address):
+    """
+    Open a Listener on address ("host:port" or a unix socket path), replacing a leftover unix socket file.
+    A unix socket is created readable and writable by this user only.
+    """
+    require_authkey()
+    address = parse_address(address)
+    if not isinstance(address, str):
+        return Listener(address, authkey=authkey)
+    if os.path.exists(address):
+        os.remove(address)
+    # Set before the socket file exists, so there is no moment other users could connect
+    previous_umask = os.umask(0o177)
+    try:
+        return Listener(address, authkey=authkey)
+    finally:
+        os.umask(previous_umask)
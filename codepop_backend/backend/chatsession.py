@@ -0,0 +1,208 @@
+import re
+import uuid
+from django.conf import settings
+from django.core.cache import cache
+from .intents import classify
+from .models import Order, Revenue
+from .views import refund_order
+
+# Seconds a conversation is remembered after its last message
+# Kept in Django's cache, so web workers share conversations when CACHES is a shared backend (e.g. Redis)
+session_ttl = getattr(settings, 'CHATBOT_SESSION_TTL', 1800)
+
+# Where a conversation is: chatting, or a step of the remake or refund flow
+CHAT = "chat"
+CHOOSE = "choose"
+REMAKE_ORDER = "remake_order"
+REMAKE_DRINKS = "remake_drinks"
+REMAKE_ACCEPT = "remake_accept"
+# The remade order is ready, the client takes the customer to it (then it's back to chatting)
+REMADE = "remade"
+REFUND_ORDER = "refund_order"
+REFUND_CONFIRM = "refund_confirm"
+REFUND_ACCEPT = "refund_accept"
+
+CANCEL_HINT = "\n\nIf you want to cancel this process please say cancel at any time!"
+
+
+class ChatSession:
+    """
+    One conversation of the user chatting (an AnonymousUser when not logged in), its state and the order
+    (and its drink ids) the current flow is about.
+    """
+    __slots__ = ('id', 'user', 'state', 'order', 'drinks')
+
+    def __init__(self, conversation_id, user, state=CHAT, order=None, drinks=()):
+        self.id = conversation_id
+        self.user = user
+        self.state = state
+        self.order = order
+        self.drinks = list(drinks)
+
+    def save(self):
+        # A plain tuple keeps the cached record small
+        cache.set(session_key(self.id), (self.user.pk, self.state, self.order, self.drinks), session_ttl)
+
+    def reset(self, state=CHAT):
+        self.state = state
+        self.order = None
+        self.drinks = []
+
+
+def session_key(conversation_id):
+    return f"chatbot:session:{conversation_id}"
+
+
+def load_session(conversation_id, user):
+    """
+    Return user's session of conversation_id, or a new session (with a new id) if the id is unknown, expired
+    or belongs to someone else.
+    Ids are only ever made here, so a client can't pick one, and everything about the flow stays on the server.
+    """
+    if isinstance(conversation_id, str) and re.fullmatch(r'[0-9a-f]{32}', conversation_id):
+        record = cache.get(session_key(conversation_id))
+        if record is not None and record[0] == user.pk:
+            return ChatSession(conversation_id, user, *record[1:])
+    return ChatSession(uuid.uuid4().hex, user)
+
+
+def user_orders(user):
+    """The orders the chatbot may look up and change for user, none unless they are logged in."""
+    if not user.is_authenticated:
+        return Order.objects.none()
+    return Order.objects.filter(UserID=user)
+
+
+def find_order(session, user_input):
+    """Return (order, None) for the one order number in the message, or (None, reply explaining what's wrong)."""
+    if not session.user.is_authenticated:
+        return None, "Please log in first so we can find your order! " + CANCEL_HINT
+    order_numbers = re.findall(r'\d+', user_input)
+    if len(order_numbers) != 1:
+        return None, "I'm sorry I couldn't find your order from that information! Please clearly enter a single order number! " + CANCEL_HINT
+    # Someone else's order number gets the same answer as one that doesn't exist
+    order = user_orders(session.user).filter(OrderID=int(order_numbers[0])).first()
+    if not order:
+        return None, "I'm sorry that order doesn't exist. " + CANCEL_HINT
+    return order, None
+
+
+def describe_drinks(drinks):
+    drinks_info = ""
+    for counter, drink in enumerate(drinks, start=1):
+        drinks_info += f"[{counter}]: Drink Name: {drink.Name}\n"
+        drinks_info += f"Soda Used: {', '.join(drink.SodaUsed or [])}\n"
+        drinks_info += f"Syrups: {', '.join(drink.SyrupsUsed or [])}\n"
+        drinks_info += f"Add ins: {', '.join(drink.AddIns or [])}\n"
+        drinks_info += f"Price: ${drink.Price:.2f}\n\n"
+    return drinks_info
+
+
+# Each step below takes the session and the customer's message, moves the session on and returns the reply
+
+def choose(session, user_input):
+    prediction = classify(user_input)
+    intent = prediction.intent if prediction else None
+    if "refund" in user_input.lower() or intent == "refund":
+        session.state = REFUND_ORDER
+        return "Please provide us with your order number to proceed with refund!"
+    if "remade" in user_input.lower() or intent == "remake":
+        session.state = REMAKE_ORDER
+        return "Please provide us with your order number to remake your drink!"
+    return "I'm sorry please clearly state wether you want a refund for a drink or if you want a drink remade. " + CANCEL_HINT
+
+
+def remake_order(session, user_input):
+    order, problem = find_order(session, user_input)
+    if problem:
+        return problem
+    drinks = list(order.Drinks.all())
+    session.state = REMAKE_DRINKS
+    session.order = order.OrderID
+    session.drinks = [drink.DrinkID for drink in drinks]
+    return ("We found your order! Please tell us which drink(s) we can remake for you?\nif you want all drinks remade say \"all\"\n\n"
+            + describe_drinks(drinks) + "If you want to cancel this process please say cancel at any time!")
+
+
+def remake_drinks(session, user_input):
+    if "all" in user_input.lower():
+        drink_ids = session.drinks
+        reply = "Sucessfully started remaking order, please continute by saying \"I accept\"."
+    else:
+        drink_numbers = [int(num) for num in re.findall(r'\d+', user_input)]
+        if not drink_numbers:
+            return "You didn't enter a valid drink number...\nplease try again! " + CANCEL_HINT
+        if len(drink_numbers) > len(session.drinks):
+            return "You entered too many drinks to remake...\nplease try again! " + CANCEL_HINT
+        if any(number < 1 or number > len(session.drinks) for number in drink_numbers):
+            return "One of the drinks entered was not in the list...\nplease try again! " + CANCEL_HINT
+        drink_ids = [session.drinks[number - 1] for number in drink_numbers]
+        reply = "Sucessfully started remaking drinks, please continute by saying \"I accept\"."
+
+    new_order = Order.objects.create(UserID=session.user, OrderStatus='pending', PaymentStatus='remade')
+    new_order.Drinks.add(*drink_ids)
+    session.state = REMAKE_ACCEPT
+    session.order = new_order.OrderID
+    return reply
+
+
+def remake_accept(session, user_input):
+    if "i accept" in user_input.lower():
+        session.state = REMADE
+        return "Thank you! your drink will be remade shortly"
+    return "Sorry you must say \"I accept\" before we can finish remaking your drink(s) " + CANCEL_HINT
+
+
+def refund_order_step(session, user_input):
+    order, problem = find_order(session, user_input)
+    if problem:
+        return problem
+    drinks = list(order.Drinks.all())
+    session.state = REFUND_CONFIRM
+    session.order = order.OrderID
+    session.drinks = [drink.DrinkID for drink in drinks]
+    return ("Is this the order you want refunded?\nConfirm by saying yes\n\n"
+            + describe_drinks(drinks) + "If you want to cancel this process please say cancel at any time!")
+
+
+def refund_confirm(session, user_input):
+    if "yes" not in user_input.lower():
+        return "Please say yes to confirm this is the order you want to refund! " + CANCEL_HINT
+    order = user_orders(session.user).filter(OrderID=session.order).first()
+    if order is None or not order.StripeID or not refund_order(order.StripeID):
+        return "Sorry, There was a problem processing the refund. Please try again later!"
+    Revenue.objects.filter(OrderID=order.OrderID).update(Refunded=True)
+    session.state = REFUND_ACCEPT
+    return "Sucessfully started refund, please continute by saying \"I accept\"."
+
+
+def refund_accept(session, user_input):
+    if "i accept" in user_input.lower():
+        session.reset()
+        return "Thank you! your refund has been proccessed"
+    return "Sorry you must say \"I accept\" before we can finish the refund! " + CANCEL_HINT
+
+
+# state -> step answering the next message in that state, states missing here are plain chat
+FLOWS = {
+    CHOOSE: choose,
+    REMAKE_ORDER: remake_order,
+    REMAKE_DRINKS: remake_drinks,
+    REMAKE_ACCEPT: remake_accept,
+    REFUND_ORDER: refund_order_step,
+    REFUND_CONFIRM: refund_confirm,
+    REFUND_ACCEPT: refund_accept,
+}
+
+
+def continue_flow(session, user_input):
+    """Answer the message with the session's current step, or return None when the conversation is just chatting."""
+    step = FLOWS.get(session.state)
+    if step is None:
+        # Back to chatting after a finished remake
+        session.reset()
+        return None
+    if "cancel" in user_input.lower():
+        session.reset()
+        return "Ok, canceling... \nplease let me know how I can further help you!"
+    return step(session, user_input)
@@ -0,0 +1,148 @@
+import os
+import numpy as n
+from django.conf import settings
+from .artifacts import Reloader, cache_dir, save_arrays
+
+# Written by build_cf_embeddings
+embeddings_path = os.path.join(cache_dir, 'cf_embeddings.npz')
+
+# How strongly collaborative scores move the flavor ranking (flavor similarities are between 0 and 1)
+cf_weight = getattr(settings, 'DRINKAI_CF_WEIGHT', 0.3)
+
+# How much each kind of interaction counts toward a user's affinity for an ingredient
+ORDER_WEIGHT = 1.0
+FAVORITE_WEIGHT = 2.0
+
+CATALOGS = ('syrups', 'sodas', 'addins')
+
+
+def item_key(catalog, name):
+    """Column name of an ingredient in the user x ingredient matrix, e.g. 'syrups:vanilla'."""
+    return f"{catalog}:{name.lower()}"
+
+
+def drink_columns(drink):
+    """Return the ingredient columns a drink uses."""
+    items = [item_key('syrups', name) for name in drink.SyrupsUsed or []]
+    items += [item_key('sodas', name) for name in drink.SodaUsed or []]
+    items += [item_key('addins', name) for name in drink.AddIns or []]
+    return items
+
+
+def rating_factor(rating):
+    # Drinks rated 0-5 count for 0.5x-1.5x, unrated drinks count normally
+    return 1.0 if rating is None else 0.5 + rating / 5
+
+
+class Embeddings:
+    """User and ingredient vectors from the last build_cf_embeddings run, whose dot product estimates affinity."""
+
+    def __init__(self, path):
+        self.version = os.stat(path).st_mtime_ns
+        with n.load(path) as data:
+            self.user_ids = data['user_ids']
+            self.user_vectors = data['user_vectors']
+            self.items = [str(item) for item in data['items']]
+            self.item_vectors = data['item_vectors']
+        self.user_rows = {int(user_id): row for row, user_id in enumerate(self.user_ids)}
+        self.item_columns = {item: column for column, item in enumerate(self.items)}
+
+    def has_user(self, user_id):
+        return int(user_id) in self.user_rows
+
+    def scores(self, user_id, index):
+        """
+        Return {'syrups', 'sodas', 'addins'} arrays of collaborative scores aligned with the FlavorIndex ids,
+        scaled so the strongest affinity in each catalog is cf_weight. Ingredients nobody has ordered score 0.
+        """
+        affinity = self.item_vectors @ self.user_vectors[self.user_rows[int(user_id)]]
+        names = {'syrups': index.syrup_names, 'sodas': index.soda_names, 'addins': index.addin_names}
+        scores = {}
+        for catalog in CATALOGS:
+            catalog_scores = n.zeros(len(names[catalog]))
+            for i, name in enumerate(names[catalog]):
+                column = self.item_columns.get(item_key(catalog, name))
+                if column is not None:
+                    catalog_scores[i] = affinity[column]
+            largest = n.abs(catalog_scores).max() if len(catalog_scores) else 0.0
+            if largest > 0:
+                catalog_scores *= cf_weight / largest
+            scores[catalog] = catalog_scores
+        return scores
+
+
+_embeddings = Reloader(Embeddings, "collaborative filtering embeddings")
+
+# Return the current Embeddings, reloading them when build_cf_embeddings wrote a new file
+# Returns None until the job has been run at least once
+def get_embeddings():
+    return _embeddings.get(embeddings_path)
+
+
+def user_embeddings(user_id):
+    """Return the current Embeddings if they have a vector for the user, or None if there are none for them yet."""
+    embeddings = get_embeddings()
+    if embeddings is None or not embeddings.has_user(user_id):
+        return None
+    return embeddings
+
+
+def build_interactions():
+    """
+    Return (user ids, ingredient columns, sparse user x ingredient matrix) from order history and favorites.
+    Every drink a user ordered adds ORDER_WEIGHT to each of its ingredients, every favorite adds FAVORITE_WEIGHT,
+    both scaled by the drink's rating.
+    """
+    from scipy.sparse import csr_matrix
+    from .models import Drink, Order
+
+    drinks = {drink.DrinkID: (drink_columns(drink), rating_factor(drink.Rating)) for drink in Drink.objects.all()}
+    weights = {}
+
+    def add(user_id, drink_id, weight):
+        items, factor = drinks[drink_id]
+        for item in items:
+            weights[(user_id, item)] = weights.get((user_id, item), 0.0) + weight * factor
+
+    ordered = Order.Drinks.through.objects.filter(order__UserID__isnull=False).exclude(order__OrderStatus='cancelled')
+    for user_id, drink_id in ordered.values_list('order__UserID', 'drink_id'):
+        add(user_id, drink_id, ORDER_WEIGHT)
+    for user_id, drink_id in Drink.Favorite.through.objects.values_list('user_id', 'drink_id'):
+        add(user_id, drink_id, FAVORITE_WEIGHT)
+
+    user_ids = sorted({user_id for user_id, _ in weights})
+    items = sorted({item for _, item in weights})
+    user_rows = {user_id: row for row, user_id in enumerate(user_ids)}
+    item_columns = {item: column for column, item in enumerate(items)}
+    rows, columns, values = [], [], []
+    for (user_id, item), weight in weights.items():
+        rows.append(user_rows[user_id])
+        columns.append(item_columns[item])
+        # Log scaling so a handful of heavy users don't dominate the factorization
+        values.append(n.log1p(weight))
+    matrix = csr_matrix((values, (rows, columns)), shape=(len(user_ids), len(items)))
+    return user_ids, items, matrix
+
+
+def factorize(matrix, components):
+    """
+    Factorize the user x ingredient matrix with a truncated SVD and return (user vectors, ingredient vectors).
+    The dot product of a user vector and an ingredient vector approximates the user's affinity for it.
+    """
+    from sklearn.decomposition import TruncatedSVD
+
+    components = min(components, min(matrix.shape) - 1)
+    if components < 1:
+        raise ValueError("Not enough users and ingredients to factorize, at least 2 of each are needed.")
+    svd = TruncatedSVD(n_components=components, random_state=0)
+    user_vectors = svd.fit_transform(matrix)
+    return user_vectors, svd.components_.T
+
+
+def save_embeddings(user_ids, user_vectors, items, item_vectors, path=None):
+    save_arrays(path or embeddings_path, {
+        'user_ids': n.asarray(user_ids, dtype=n.int64),
+        'user_vectors': user_vectors.astype(n.float32),
+        'items': n.asarray(items, dtype=str),
+        'item_vectors': item_vectors.astype(n.float32),
+    })
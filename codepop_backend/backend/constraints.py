@@ -0,0 +1,126 @@
+import csv
+import numpy as n
+
+# Which ingredients can go in the same drink, compiled from the csv files into bitsets
+# A bitset is a plain Python int where bit i is set when the item with id i (its row in the csv) is in the set,
+# so narrowing down the candidates for a drink is a few bitwise ANDs
+
+# Exclusions.csv kinds -> FlavorIndex catalog names
+EXCLUSION_KINDS = {'syrup': 'syrups', 'soda': 'sodas', 'addin': 'addins'}
+
+
+def to_bits(ids):
+    """Return the bitset of an iterable of ids."""
+    bits = 0
+    for i in ids:
+        bits |= 1 << int(i)
+    return bits
+
+
+def from_mask(mask):
+    """Return the bitset of a boolean numpy mask over ids."""
+    return int.from_bytes(n.packbits(mask, bitorder='little').tobytes(), 'little')
+
+
+def to_ids(bits, count):
+    """Return the ids (0 to count - 1) in a bitset as a sorted numpy array."""
+    raw = n.frombuffer(bits.to_bytes((count + 7) // 8, 'little'), dtype=n.uint8)
+    return n.flatnonzero(n.unpackbits(raw, bitorder='little')[:count])
+
+
+def load_exclusions(path):
+    """
+    Read pairs of items that must never be in the same drink from a csv file with
+    first-kind,first-name,second-kind,second-name columns (kinds are syrup, soda or addin).
+    Returns [] when the file doesn't exist.
+    """
+    try:
+        with open(path, newline='') as file:
+            rows = list(csv.DictReader(file))
+    except FileNotFoundError:
+        return []
+
+    exclusions = []
+    for row in rows:
+        first, second = row['first-kind'].strip().lower(), row['second-kind'].strip().lower()
+        if first not in EXCLUSION_KINDS or second not in EXCLUSION_KINDS:
+            raise ValueError(f"Unknown kind in exclusion {first} {row['first-name']} / {second} {row['second-name']}")
+        exclusions.append((EXCLUSION_KINDS[first], row['first-name'].strip().lower(),
+                           EXCLUSION_KINDS[second], row['second-name'].strip().lower()))
+    return exclusions
+
+
+class CompatibilityRules:
+    """
+    Per-ingredient bitsets of the ingredients it can be combined with:
+    a syrup goes with the sodas whose best-match-flavors share a word with its types,
+    and with the add-ins whose best-match-syrup shares a word with its types,
+    a soda goes with the add-ins whose best-match-soda includes its type,
+    and an add-in goes with every other add-in (never itself, so it isn't picked twice).
+    Exclusions then remove single pairs from those sets.
+
+    Every argument but exclusions is a list of sets of flavor words, one per item in id order.
+    exclusions are (catalog, id, catalog, id) pairs, catalog being 'syrups', 'sodas' or 'addins'.
+    """
+
+    def __init__(self, syrup_types, soda_types, soda_flavors, addin_syrup_flavors, addin_soda_flavors, exclusions=()):
+        self.soda_count = len(soda_flavors)
+        self.addin_count = len(addin_syrup_flavors)
+        self.all_sodas = (1 << self.soda_count) - 1
+        self.all_addins = (1 << self.addin_count) - 1
+
+        self.syrup_sodas = [to_bits(j for j, flavors in enumerate(soda_flavors) if types & flavors) for types in syrup_types]
+        self.syrup_addins = [to_bits(j for j, flavors in enumerate(addin_syrup_flavors) if types & flavors) for types in syrup_types]
+        self.soda_addins = [to_bits(j for j, flavors in enumerate(addin_soda_flavors) if types & flavors) for types in soda_types]
+        self.addin_addins = [self.all_addins & ~(1 << j) for j in range(self.addin_count)]
+
+        for exclusion in exclusions:
+            self.exclude(*exclusion)
+
+    def exclude(self, first, first_id, second, second_id):
+        """Never put these two items in the same drink."""
+        pair = dict(((first, first_id), (second, second_id)))
+        if first == second == 'addins':
+            self.addin_addins[first_id] &= ~(1 << second_id)
+            self.addin_addins[second_id] &= ~(1 << first_id)
+        elif pair.keys() == {'syrups', 'sodas'}:
+            self.syrup_sodas[pair['syrups']] &= ~(1 << pair['sodas'])
+        elif pair.keys() == {'syrups', 'addins'}:
+            self.syrup_addins[pair['syrups']] &= ~(1 << pair['addins'])
+        elif pair.keys() == {'sodas', 'addins'}:
+            self.soda_addins[pair['sodas']] &= ~(1 << pair['addins'])
+        else:
+            raise ValueError(f"Exclusions between {first} and {second} are not supported")
+
+    def sodas_for(self, syrup_ids):
+        """Bitset of the sodas that go with every one of the syrups."""
+        bits = self.all_sodas
+        for i in syrup_ids:
+            bits &= self.syrup_sodas[i]
+        return bits
+
+    def addins_for(self, syrup_ids, soda_id):
+        """Bitset of the add-ins that go with every one of the syrups and with the soda."""
+        bits = self.soda_addins[soda_id]
+        for i in syrup_ids:
+            bits &= self.syrup_addins[i]
+        return bits
+
+
+def compile_rules(index, soda_flavors, addin_syrup_flavors, addin_soda_flavors, exclusions=()):
+    """
+    Build the CompatibilityRules of a FlavorIndex from its flavor columns (strings of flavor words in id order)
+    and (catalog, name, catalog, name) exclusions. Exclusions naming items that are no longer in the catalog are skipped.
+    """
+    ids = {'syrups': index.syrup_ids, 'sodas': index.soda_ids, 'addins': index.addin_ids}
+    excluded_ids = [(first, ids[first][first_name], second, ids[second][second_name])
+                    for first, first_name, second, second_name in exclusions
+                    if first_name in ids[first] and second_name in ids[second]]
+    return CompatibilityRules(
+        [set(types) for types in index.syrup_types],
+        [set(types) for types in index.soda_types],
+        [set(flavors.split()) for flavors in soda_flavors],
+        [set(flavors.split()) for flavors in addin_syrup_flavors],
+        [set(flavors.split()) for flavors in addin_soda_flavors],
+        excluded_ids,
+    )
@@ -1,370 +1,567 @@
 # Credit to @sumanadhikari
 # https://medium.com/@sumanadhikari/building-a-movie-recommendation-engine-using-scikit-learn-8dbb11c5aa4b
 
+import hashlib
 import random
+import threading
+import time
 import pandas as p
-import csv
 import numpy as n
 from sklearn.feature_extraction.text import CountVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
 import os
 from django.conf import settings
+from . import timing
+from .constraints import compile_rules, from_mask, load_exclusions, to_bits, to_ids
 
 # Required for django
 syrup_file_path = os.path.join(settings.BASE_DIR, 'backend/Syrups.csv')
 soda_file_path = os.path.join(settings.BASE_DIR, 'backend/Sodas.csv')
 addin_file_path = os.path.join(settings.BASE_DIR, 'backend/AddIns.csv')
-
-# CSV related functions
-def get_name_from_index(file, index):
-    return file[file.index == index]["name"].values[0]
-
-def get_index_from_name(file, name):
-    return file[file.name == name]["index"].values[0]
-
-def get_type_from_name(file, name):
-    return file[file.name == name]["type"].values[0]
-
-
-# Return a list of syrups most similar to user_preference
-def generate_similar_syrup_preferences(user_preference):
-    syrups = p.read_csv(syrup_file_path)
-
+# Optional pairs of ingredients that never go in the same drink, see constraints.py
+exclusion_file_path = os.path.join(settings.BASE_DIR, 'backend/Exclusions.csv')
+
+# How often (in seconds) the csv files are checked for changes, 0 checks on every call
+catalog_check_interval = getattr(settings, 'DRINKAI_CATALOG_CHECK_INTERVAL', 5)
+
+# Precomputed matrices written by build_drinkai_matrices, one folder per catalog digest
+matrix_dir = os.path.join(getattr(settings, 'DRINKAI_CACHE_DIR', os.path.join(settings.BASE_DIR, 'drinkai_cache')), 'matrices')
+MATRIX_NAMES = ('syrup_vectors', 'syrup_similarity', 'soda_vectors', 'addin_syrup_vectors', 'addin_soda_vectors')
+
+
+# Modification stamp of the catalog csv files, cheap enough to compare on the request path
+def catalog_version():
+    stamps = []
+    for path in (syrup_file_path, soda_file_path, addin_file_path):
+        stat = os.stat(path)
+        stamps.append((stat.st_mtime_ns, stat.st_size))
+    if os.path.exists(exclusion_file_path):
+        stat = os.stat(exclusion_file_path)
+        stamps.append((stat.st_mtime_ns, stat.st_size))
+    return tuple(stamps)
+
+# Hash of the catalog csv contents, names the folder the matrices built from exactly these files are kept in
+def catalog_digest():
+    digest = hashlib.sha1()
+    for path in (syrup_file_path, soda_file_path, addin_file_path):
+        with open(path, 'rb') as file:
+            digest.update(file.read())
+    return digest.hexdigest()[:16]
+
+
+# Open the precomputed matrices for a catalog digest memory-mapped, or return None if they haven't been built
+# Every worker process maps the same read-only files, so the OS keeps one copy of them in memory for all of them
+def load_matrices(digest):
+    folder = os.path.join(matrix_dir, digest)
+    try:
+        return {name: n.load(os.path.join(folder, name + '.npy'), mmap_mode='r') for name in MATRIX_NAMES}
+    except (OSError, ValueError):
+        return None
+
+
+# Fit a vectorizer on a column of space separated flavor words and return it with the L2 normalized row vectors
+# With normalized rows, cosine similarity is just a dot product
+def fit_flavor_vectors(column):
     cv = CountVectorizer()
-    count_matrix = cv.fit_transform(syrups["type"])
-    similarity = cosine_similarity(count_matrix)
-
-    user_pref_index = get_index_from_name(syrups, user_preference)
-    similar_preferences =  list(enumerate(similarity[user_pref_index]))
-    sorted_similar_pref = sorted(similar_preferences,key=lambda x:x[1],reverse=True)
-
-    i = 0
-    top5_preferences = []
-    for item in sorted_similar_pref:
-        top5_preferences.append(get_name_from_index(syrups, item[0]))
-        i += 1
-        if i == 5:
-            break
+    vectors = cv.fit_transform(column).toarray().astype(n.float64)
+    norms = n.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return cv, vectors / norms
+
+
+# Score ad-hoc strings of flavor words against already fitted catalog vectors, one row of scores per string
+# boost is an optional score per catalog item added to every row (see collaborative.py)
+# Nothing is written to the csv files, so this is safe to call from many threads at once
+def score_against(vectorizer, vectors, flavors_list, boost=None):
+    queries = vectorizer.transform(flavors_list).toarray().astype(n.float64)
+    norms = n.linalg.norm(queries, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    scores = (queries / norms) @ vectors.T
+    if boost is not None:
+        scores += boost
+    return scores
+
+
+# Shuffles items before top_k breaks ties, for callers that don't pass a seeded one
+# numpy generators lock internally, so one can be shared by every thread
+_shuffler = n.random.default_rng()
+
+# Shuffler for top_k seeded from rng, so a seeded random.Random also fixes how ties are broken
+def shuffler_for(rng):
+    return None if rng is random else n.random.default_rng(rng.getrandbits(32))
+
+
+# Rows with fewer items than this are fully sorted, it is cheaper than the extra steps of partial selection
+partial_selection_min_items = 256
+
+# Return, for every row of scores, the catalog indexes of the k best scores from best to worst (all of them if k is None)
+# Only items in candidates (a list of indexes) and in the available mask are considered
+# Partial selection (argpartition) finds the k best without sorting whole rows, only those k get sorted
+# Items are shuffled first (by shuffler, a numpy Generator), so equal scores come out in random order
+# instead of always favoring the top of the csv
+def top_k(scores, k=None, available=None, candidates=None, shuffler=None):
+    items = None
+    if candidates is not None:
+        items = n.asarray(candidates, dtype=n.intp)
+    if available is not None:
+        items = n.flatnonzero(available) if items is None else items[available[items]]
+    count = scores.shape[1] if items is None else len(items)
+    k = count if k is None else min(k, count)
+    if k == 0:
+        return n.empty((len(scores), 0), dtype=n.intp)
+
+    order = (shuffler if shuffler is not None else _shuffler).permutation(count)
+    if items is not None:
+        order = items[order]
+    selected = scores[:, order]
+    if k < count and count >= partial_selection_min_items:
+        # The k best of each row in shuffled order (sorted positions), so the stable sort below keeps ties shuffled
+        rows = n.arange(len(scores))[:, None]
+        best = n.sort(n.argpartition(-selected, k - 1, axis=1)[:, :k], axis=1)
+        best = best[rows, n.argsort(-selected[rows, best], axis=1, kind='stable')]
+    else:
+        best = n.argsort(-selected, axis=1, kind='stable')[:, :k]
+    return order[best]
+
+# top_k with its own candidates for every row (rows can come out with different lengths)
+def top_k_rows(scores, k, row_candidates, shuffler=None):
+    return [top_k(scores[i:i + 1], k, candidates=candidates, shuffler=shuffler)[0] for i, candidates in enumerate(row_candidates)]
+
+
+class FlavorIndex:
+    """
+    Syrups, sodas and add-ins loaded once, with fitted vocabularies and normalized flavor vectors.
+    Everything the generator needs from the CSV files is answered from this state instead of re-reading them.
+    The vectors are memory-mapped from build_drinkai_matrices files when there are some for these csv files
+    (pass precomputed=False to always compute them).
+    """
+
+    def __init__(self, precomputed=True):
+        # Taken before reading so an edit made while building is picked up by the next check
+        self.version = catalog_version()
+        self.digest = catalog_digest()
+
+        with timing.stage('catalog_read'):
+            syrups = p.read_csv(syrup_file_path)
+            sodas = p.read_csv(soda_file_path)
+            addins = p.read_csv(addin_file_path)
+
+        # Plain list / dict lookups (id -> name, name -> id, id -> type words) so the generator never scans a DataFrame
+        # An item's id is its row in the csv file, which is also its row in the vector matrices below
+        self.syrup_names = list(syrups["name"])
+        self.syrup_ids = {name: i for i, name in enumerate(self.syrup_names)}
+        self.syrup_types = [syrupType.split() for syrupType in syrups["type"]]
+
+        self.soda_names = list(sodas["name"])
+        self.soda_ids = {name: i for i, name in enumerate(self.soda_names)}
+        self.soda_types = [sodaType.split() for sodaType in sodas["type"]]
+
+        self.addin_names = list(addins["name"])
+        self.addin_ids = {name: i for i, name in enumerate(self.addin_names)}
+
+        with timing.stage('catalog_vectors'):
+            matrices = load_matrices(self.digest) if precomputed else None
+            if matrices is not None:
+                # Only the vocabularies are fitted, they turn ad-hoc flavor words into vectors matching the mapped ones
+                self.syrup_vectorizer = CountVectorizer().fit(syrups["type"])
+                self.soda_vectorizer = CountVectorizer().fit(sodas["best-match-flavors"])
+                self.addin_syrup_vectorizer = CountVectorizer().fit(addins["best-match-syrup"])
+                self.addin_soda_vectorizer = CountVectorizer().fit(addins["best-match-soda"])
+                for name in MATRIX_NAMES:
+                    setattr(self, name, matrices[name])
+            else:
+                # Syrups are compared with each other by their "type" words
+                # Without a precomputed syrup x syrup matrix, only the rows asked for are computed
+                self.syrup_vectorizer, self.syrup_vectors = fit_flavor_vectors(syrups["type"])
+                self.syrup_similarity = None
+
+                # Sodas are matched against syrup types, add-ins against syrup types and soda type
+                self.soda_vectorizer, self.soda_vectors = fit_flavor_vectors(sodas["best-match-flavors"])
+                self.addin_syrup_vectorizer, self.addin_syrup_vectors = fit_flavor_vectors(addins["best-match-syrup"])
+                self.addin_soda_vectorizer, self.addin_soda_vectors = fit_flavor_vectors(addins["best-match-soda"])
+
+        # Which syrups, sodas and add-ins go together, as bitsets over the ids
+        with timing.stage('catalog_rules'):
+            self.rules = compile_rules(self, sodas["best-match-flavors"], addins["best-match-syrup"], addins["best-match-soda"],
+                                       load_exclusions(exclusion_file_path))
+
+        # In stock masks for the last stock snapshot seen, see availability()
+        self._availability = None
+
+    def availability(self, stock):
+        """Return boolean in stock masks over the syrup, soda and add-in ids, rebuilt only when the stock snapshot changes.
+        The 'soda_bits' and 'addin_bits' entries are the same sodas and add-ins as bitsets, for combining with self.rules."""
+        cached = self._availability
+        if cached is None or cached[0] != stock.generation:
+            masks = {
+                'syrups': n.array([stock.is_available('syrups', name) for name in self.syrup_names], dtype=bool),
+                'sodas': n.array([stock.is_available('sodas', name) for name in self.soda_names], dtype=bool),
+                'addins': n.array([stock.is_available('addins', name) for name in self.addin_names], dtype=bool),
+            }
+            masks['soda_bits'] = from_mask(masks['sodas'])
+            masks['addin_bits'] = from_mask(masks['addins'])
+            cached = (stock.generation, masks)
+            self._availability = cached
+        return cached[1]
+
+    def similar_syrups(self, names, k=5, available=None, boost=None, shuffler=None):
+        """Return, for each given syrup, the names of the k syrups most similar to it (including itself, unless there
+        are more than k exact ties). With an available mask, only in stock syrups are returned.
+        A boost (score per syrup) is added to the similarities."""
+        ids = [self.syrup_ids[name] for name in names]
+        if self.syrup_similarity is not None:
+            rows = n.array(self.syrup_similarity[ids])
+        else:
+            rows = self.syrup_vectors[ids] @ self.syrup_vectors.T
+        if boost is not None:
+            rows += boost
+        top = top_k(rows, k, available, shuffler=shuffler)
+        return [[self.syrup_names[i] for i in row] for row in top]
+
+    # The rank_ methods return, for each string, catalog indexes from best to worst match
+    # k, available, candidates and shuffler work the same way as in top_k, without them every item is ranked
+    # row_candidates (one candidates list per string) ranks every string among its own candidates instead
+    def rank_sodas(self, flavors_list, boost=None, k=None, available=None, candidates=None, shuffler=None, row_candidates=None):
+        """Rank sodas against each string of syrup flavor words."""
+        scores = score_against(self.soda_vectorizer, self.soda_vectors, flavors_list, boost)
+        if row_candidates is not None:
+            return top_k_rows(scores, k, row_candidates, shuffler)
+        return top_k(scores, k, available, candidates, shuffler)
+
+    def rank_addins_by_syrup(self, flavors_list, boost=None, k=None, available=None, candidates=None, shuffler=None, row_candidates=None):
+        """Rank add-ins against each string of syrup flavor words."""
+        scores = score_against(self.addin_syrup_vectorizer, self.addin_syrup_vectors, flavors_list, boost)
+        if row_candidates is not None:
+            return top_k_rows(scores, k, row_candidates, shuffler)
+        return top_k(scores, k, available, candidates, shuffler)
+
+    def rank_addins_by_soda(self, flavors_list, boost=None, k=None, available=None, candidates=None, shuffler=None, row_candidates=None):
+        """Rank add-ins against each soda type."""
+        scores = score_against(self.addin_soda_vectorizer, self.addin_soda_vectors, flavors_list, boost)
+        if row_candidates is not None:
+            return top_k_rows(scores, k, row_candidates, shuffler)
+        return top_k(scores, k, available, candidates, shuffler)
+
+
+_flavor_index = None
+_flavor_index_lock = threading.Lock()
+_last_catalog_check = 0.0
+_reload_thread = None
+_failed_version = None
+
+# Return the shared FlavorIndex, building it the first time it is needed
+# If the csv files changed since it was built, a new index is built in the background and swapped in
+# when ready, callers keep getting the old snapshot until then
+def get_flavor_index():
+    global _flavor_index
+    index = _flavor_index
+    if index is None:
+        with _flavor_index_lock:
+            if _flavor_index is None:
+                _flavor_index = FlavorIndex()
+            return _flavor_index
+
+    check_catalog_for_changes(index)
+    return index
+
+
+# Start a background rebuild if the csv files no longer match the index
+def check_catalog_for_changes(index):
+    global _last_catalog_check, _reload_thread
+    now = time.monotonic()
+    if now - _last_catalog_check < catalog_check_interval:
+        return
+    _last_catalog_check = now
+
+    try:
+        version = catalog_version()
+    except OSError:
+        return # a file is being replaced, try again on the next check
+    if version == index.version or version == _failed_version:
+        return
+
+    with _flavor_index_lock:
+        if _reload_thread is not None and _reload_thread.is_alive():
+            return
+        _reload_thread = threading.Thread(target=reload_flavor_index, daemon=True)
+        _reload_thread.start()
+
+
+# Build a fresh index from the csv files and swap it in with a single assignment
+def reload_flavor_index():
+    global _flavor_index, _failed_version
+    version = None
+    try:
+        version = catalog_version()
+        new_index = FlavorIndex()
+    except Exception as e:
+        # Keep serving the old snapshot, and don't retry until the files change again
+        _failed_version = version
+        print(f"Could not reload drink catalog: {e}")
+        return
+    _flavor_index = new_index
 
-    return top5_preferences
 
+# Return a list of syrups most similar to user_preference
+def generate_similar_syrup_preferences(user_preference, rng=random):
+    return get_flavor_index().similar_syrups([user_preference], 5, shuffler=shuffler_for(rng))[0]
 
-# Generate best soda option based on chosen syrup flavors
-def generate_best_soda(syrups, prefs):
-    sodas = p.read_csv(soda_file_path)
-    syrupList = p.read_csv(syrup_file_path)
 
-    # Get types of each syrup and add to syrupTypes (only one entry per type)
+# Get types of each syrup (only one entry per type) as a single string of flavor words
+def get_syrup_types(index, syrups):
     syrupTypes = []
     for syrup in syrups:
-        syrupType = get_type_from_name(syrupList, syrup)
-        syrupType = syrupType.split()
-        for item in syrupType:
+        for item in index.syrup_types[index.syrup_ids[syrup]]:
             if item not in syrupTypes:
                 syrupTypes.append(item)
 
-    syrupTypes = " ".join(syrupTypes)
-
-    # Credit: chatgpt
-    # Add a new row to the soda csv file -- need to do this since the AI can only compare things within the same file
-    with open(soda_file_path, mode='r', newline='') as file:
-        reader = csv.reader(file)
-        rows = list(reader)  # Read all existing rows into a list
-        file.close()
+    return " ".join(syrupTypes)
 
-    # Array that we want to add as a new row
-    new_row = [len(rows) - 1, 'syrupTypes', 'n/a', 'n/a', syrupTypes]
 
-    rows.append(new_row)
-
-    # Write all rows back to the file, including the new row
-    with open(soda_file_path, mode='w', newline='') as file:
-        writer = csv.writer(file)
-        writer.writerows(rows)  # Write all rows back to the file
-        file.close()
-    # end of chatgpt section
+# Generate best soda option based on chosen syrup flavors
+# sorted_best_sodas can be passed in when the ranking was already computed (and stock filtered) as part of a batch
+def generate_best_soda(syrups, prefs, sorted_best_sodas=None, index=None, rng=random):
+    index = index or get_flavor_index()
+
+    # Score the syrup types directly against the fitted soda vectors
+    # Only sodas that go with every syrup are ranked, unless none of them (or of the preferences) do
+    if sorted_best_sodas is None:
+        choices = to_bits(index.soda_ids[pref] for pref in prefs) if len(prefs) > 0 else index.rules.all_sodas
+        allowed = index.rules.sodas_for([index.syrup_ids[syrup] for syrup in syrups]) & choices or choices
+        sorted_best_sodas = index.rank_sodas([get_syrup_types(index, syrups)], candidates=to_ids(allowed, index.rules.soda_count),
+                                             shuffler=shuffler_for(rng))[0]
 
-    sodas = p.read_csv(soda_file_path) # Reread now that new row is added
-    cv = CountVectorizer()
-    count_matrix = cv.fit_transform(sodas["best-match-flavors"])
-    similarity = cosine_similarity(count_matrix)
-
-    best_sodas =  list(enumerate(similarity[len(rows) - 2]))
-    sorted_best_sodas = sorted(best_sodas,key=lambda x:x[1],reverse=True)[1:]
-
-    # Credit: chatgpt
-    # Remove row we added to soda csv file, this way the sodas file wont get infinitely huge
-    with open(soda_file_path, mode='r', newline='') as file:
-        reader = csv.reader(file)
-        rows = list(reader)
-        file.close()
-
-    # Remove the specified row
-    if 0 <= len(rows) - 1 < len(rows):
-        rows.pop(len(rows) - 1)  # Remove the row at the specified index
-
-    with open(soda_file_path, mode='w', newline='') as file:
-        writer = csv.writer(file)
-        writer.writerows(rows)
-        file.close()
-    # end of chatgpt section
-
-    i = 0
-    top5_sodas = []
     # If user had no soda preferences, pick a random one from the top 5 sodas that best match the syrup flavors
     if len(prefs) == 0:
-        for item in sorted_best_sodas:
-            top5_sodas.append(get_name_from_index(sodas, item[0]))
-            i += 1
-            if i == 5:
-                break
-        return top5_sodas[random.randint(0, len(top5_sodas) - 1)]
+        top5_sodas = [index.soda_names[item] for item in sorted_best_sodas[:5]]
+        return top5_sodas[rng.randint(0, len(top5_sodas) - 1)]
 
     # If user had multiple soda preferences, pick the preference that best matches the syrup flavors
     else:
+        prefIds = {index.soda_ids[pref] for pref in prefs}
         for item in sorted_best_sodas:
-            if get_name_from_index(sodas, item[0]) in prefs:
-                return get_name_from_index(sodas, item[0])
+            if item in prefIds:
+                return index.soda_names[item]
 
 
 # Generate best add-in options based on chosen soda and syrup flavors
-def generate_best_addins(syrups, soda, prefs, num):
-    sodaList = p.read_csv(soda_file_path)
-    syrupList = p.read_csv(syrup_file_path)
-    addins = p.read_csv(addin_file_path)
-
-    # Get types of each syrup (only one entry per type)
-    syrupTypes = []
-    for syrup in syrups:
-        syrupType = get_type_from_name(syrupList, syrup)
-        syrupType = syrupType.split()
-        for item in syrupType:
-            if item not in syrupTypes:
-                syrupTypes.append(item)
-
-    syrupTypes = " ".join(syrupTypes)
-
-    # Get type of the soda
-    sodaType = get_type_from_name(sodaList, soda)
-
-    # ----- Syrup Calculations -----
-    # Credit: chatgpt
-    # Add a new row to the soda csv file -- need to do this since the AI can only compare things within the same file
-    with open(addin_file_path, mode='r', newline='') as file:
-        reader = csv.reader(file)
-        rows = list(reader)  # Read all existing rows into a list
-        file.close()
-
-    # Array that we want to add as a new row
-    new_row = [len(rows) - 1, 'syrupTypes', 'n/a', syrupTypes, 'n/a']
-
-    rows.append(new_row)
-
-    # Write all rows back to the file, including the new row
-    with open(addin_file_path, mode='w', newline='') as file:
-        writer = csv.writer(file)
-        writer.writerows(rows)  # Write all rows back to the file
-        file.close()
-    # end of chatgpt section
-
-    addins = p.read_csv(addin_file_path) # Reread now that new row is added
-    cv = CountVectorizer()
-    count_matrix = cv.fit_transform(addins["best-match-syrup"])
-    similarity = cosine_similarity(count_matrix)
-
-    best_addins_from_syrup = list(enumerate(similarity[len(rows) - 2]))
-    sorted_best_addins_from_syrup = sorted(best_addins_from_syrup,key=lambda x:x[1],reverse=True)[1:]
-
-    # Credit: chatgpt
-    # Remove row we added to soda csv file, this way the sodas file wont get infinitely huge
-    with open(addin_file_path, mode='r', newline='') as file:
-        reader = csv.reader(file)
-        rows = list(reader)
-        file.close()
-
-    # Remove the specified row
-    if 0 <= len(rows) - 1 < len(rows):
-        rows.pop(len(rows) - 1)  # Remove the row at the specified index
-
-    with open(addin_file_path, mode='w', newline='') as file:
-        writer = csv.writer(file)
-        writer.writerows(rows)
-        file.close()
-    # end of chatgpt section
-
-
-    # ----- Soda Calculations -----
-    # Credit: chatgpt
-    # Add a new row to the soda csv file -- need to do this since the AI can only compare things within the same file
-    with open(addin_file_path, mode='r', newline='') as file:
-        reader = csv.reader(file)
-        rows = list(reader)  # Read all existing rows into a list
-        file.close()
-
-    # Array that we want to add as a new row
-    new_row = [len(rows) - 1, 'sodaType', 'n/a', 'n/a', sodaType]
-
-    rows.append(new_row)
-
-    # Write all rows back to the file, including the new row
-    with open(addin_file_path, mode='w', newline='') as file:
-        writer = csv.writer(file)
-        writer.writerows(rows)  # Write all rows back to the file
-        file.close()
-    # end of chatgpt section
-
-    addins = p.read_csv(addin_file_path) # Reread now that new row is added
-    cv = CountVectorizer()
-    count_matrix = cv.fit_transform(addins["best-match-soda"])
-    similarity = cosine_similarity(count_matrix)
-
-    best_addins_from_soda = list(enumerate(similarity[len(rows) - 2]))
-    sorted_best_addins_from_soda = sorted(best_addins_from_soda,key=lambda x:x[1],reverse=True)[1:]
-
-    # Credit: chatgpt
-    # Remove row we added to soda csv file, this way the sodas file wont get infinitely huge
-    with open(addin_file_path, mode='r', newline='') as file:
-        reader = csv.reader(file)
-        rows = list(reader)
-        file.close()
-
-    # Remove the specified row
-    if 0 <= len(rows) - 1 < len(rows):
-        rows.pop(len(rows) - 1)  # Remove the row at the specified index
-
-    with open(addin_file_path, mode='w', newline='') as file:
-        writer = csv.writer(file)
-        writer.writerows(rows)
-        file.close()
-    # end of chatgpt section
+# The two rankings can be passed in when they were already computed (and stock filtered) as part of a batch
+# The index is passed in by batch generation so one drink never mixes two catalog snapshots
+def generate_best_addins(syrups, soda, prefs, num, sorted_best_addins_from_syrup=None, sorted_best_addins_from_soda=None, index=None, rng=random):
+    index = index or get_flavor_index()
+
+    # Only add-ins that go with every syrup and with the soda are picked
+    # An add-in is optional, so when none of them go with the drink it simply gets none
+    allowed = index.rules.addins_for([index.syrup_ids[syrup] for syrup in syrups], index.soda_ids[soda])
+    if len(prefs) > 0:
+        allowed &= to_bits(index.addin_ids[pref] for pref in prefs)
+    candidates = to_ids(allowed, index.rules.addin_count)
+
+    # Score the syrup types and soda type directly against the fitted add-in vectors
+    if sorted_best_addins_from_syrup is None:
+        sorted_best_addins_from_syrup = index.rank_addins_by_syrup([get_syrup_types(index, syrups)], candidates=candidates, shuffler=shuffler_for(rng))[0]
+    if sorted_best_addins_from_soda is None and len(prefs) > 0:
+        sodaType = " ".join(index.soda_types[index.soda_ids[soda]])
+        sorted_best_addins_from_soda = index.rank_addins_by_soda([sodaType], candidates=candidates, shuffler=shuffler_for(rng))[0]
 
     possibleAddins = []
-    chosenAddins = []
-    # If no addins in pref, get top5 best addins that are in both sorted lists
+    # If no addins in pref, get top5 best addins for the syrups (out of those that also go with the soda)
     # Choose num # of addins from that top5 to send back
     if len(prefs) == 0:
-        for item1 in sorted_best_addins_from_syrup:
-            if len(possibleAddins) >= 5:
-                break
-            for item2 in sorted_best_addins_from_soda:
-                if get_name_from_index(addins, item1[0]) == get_name_from_index(addins, item2[0]):
-                    possibleAddins.append(get_name_from_index(addins, item1[0]))
-                    break
-        
-        for i in range(num):
-            chosenAddins.append(possibleAddins[random.randint(0, len(possibleAddins) - 1)])
-        
-        return chosenAddins
+        possibleAddins = [item for item in sorted_best_addins_from_syrup if allowed >> item & 1][:5]
+
+    # If randNum is 2 and pref is length 2, pick both
+    elif num == 2 and len(prefs) == 2:
+        possibleAddins = list(candidates)
 
     # If 2+ addins in pref
     else:
         # Pick best matching one in each sorted list
-        for item in sorted_best_addins_from_syrup:
-            if get_name_from_index(addins, item[0]) in prefs:
-                possibleAddins.append(get_name_from_index(addins, item[0]))
-                break
-
-        for item in sorted_best_addins_from_soda:
-            if get_name_from_index(addins, item[0]) in prefs:
-                possibleAddins.append(get_name_from_index(addins, item[0]))
-                break
-
-        # If randNum is 1, randomly pick between them
-        if num == 1:
-            chosenAddins.append(possibleAddins[random.randint(0, len(possibleAddins) - 1)])
-            return chosenAddins
-
-        # If randNum is 2 and pref is length 2, pick both
-        elif num == 2 and len(prefs) == 2:
-            return prefs
-
-        # Else pick 2 randomly from prefs
-        else:
-            for i in range(num):
-                chosenAddins.append(possibleAddins[random.randint(0, len(possibleAddins) - 1)])
-            
-            return chosenAddins
+        for ranking in (sorted_best_addins_from_syrup, sorted_best_addins_from_soda):
+            for item in ranking:
+                if allowed >> item & 1:
+                    if item not in possibleAddins:
+                        possibleAddins.append(item)
+                    break
 
+    return choose_addins(index, possibleAddins, num, rng)
 
-# Credit: chatgpt
-# Create list of all entries in the "name" column (column 2) of a csv file
-def create_list(csv_file_name):
-    names = []
-    with open(csv_file_name, mode='r', newline='') as file:
-        reader = csv.reader(file)
-        next(reader)  # Skip the header row
-        for row in reader:
-            names.append(row[1])  # Assuming 'name' is in the second column (index 1)
 
-        file.close()
-    return names
+# Randomly pick up to num different add-ins from possibleAddins (ids)
+# Once an add-in is picked, the ones excluded with it (and itself) are no longer possible
+def choose_addins(index, possibleAddins, num, rng):
+    chosenAddins = []
+    while len(chosenAddins) < num and len(possibleAddins) > 0:
+        item = possibleAddins[rng.randint(0, len(possibleAddins) - 1)]
+        chosenAddins.append(index.addin_names[item])
+        possibleAddins = [other for other in possibleAddins if index.rules.addin_addins[item] >> other & 1]
+
+    return chosenAddins
+
 
 # MAIN FUNCTION
 # user_preferences is either
 # a) list of the user's preferences
 # b) list of (syrup) flavors, sodas, and add-ins from popular / highly rated drinks
-def generate_soda(user_preferences):
-    drink = {}
-    validSyrups = create_list(syrup_file_path)
-    validSodas = create_list(soda_file_path)
-    validAddIns = create_list(addin_file_path)
+# stock is an optional StockSnapshot, when given only in stock syrups, sodas and add-ins are used
+# rng is an optional random.Random, passing one seeded with the same value gives the same drink every time
+# boost is an optional {'syrups', 'sodas', 'addins'} dict of scores per catalog item (from collaborative.py)
+# that is added to the flavor similarity when ranking, nudging the drink toward what similar users order
+def generate_soda(user_preferences, stock=None, rng=random, boost=None):
+    drinks = generate_sodas(user_preferences, 1, stock, rng, boost)
+    if len(drinks) == 0: # user_preferences somehow had no valid syrups -- the AI does not believe in syrup-less drinks
+        return {} # empty
+    return drinks[0]
+
+
+# Drinks with the same syrups, soda and add-ins are the same drink, whatever order they were picked in
+def drink_key(drink):
+    return (tuple(sorted(drink["syrups"])), drink["soda"][0], tuple(sorted(drink["addins"])))
+
+
+# Generate up to count distinct drinks from the same preferences
+# Preference parsing and syrup similarity are done once, and soda / add-in rankings for every
+# candidate in the batch are computed together instead of once per drink
+def generate_sodas(user_preferences, count, stock=None, rng=random, boost=None):
+    index = get_flavor_index()
 
     syrupPrefs = []
     sodaPrefs = []
     addinPrefs = []
     for item in user_preferences:
-        if item.lower() in validSyrups:
-            syrupPrefs.append(item.lower())
-        elif item.lower() in validSodas:
-            sodaPrefs.append(item.lower())
-        elif item.lower() in validAddIns:
-            addinPrefs.append(item.lower())
-
-    if len(syrupPrefs) == 0: # user_preferences somehow had no valid syrups -- the AI does not believe in syrup-less drinks
-        return drink # empty
-    else:
-        # Randomly picking 1-2 of the syrup preferences to create a drink with
-        chosenSyrupPrefs = []
-        rand_pref_1 = random.randint(0, len(syrupPrefs) - 1)
-        rand_pref_2 = random.randint(0, len(syrupPrefs) - 1)
-        chosenSyrupPrefs.append(syrupPrefs[rand_pref_1])
-        if not rand_pref_1 == rand_pref_2:
-            chosenSyrupPrefs.append(syrupPrefs[rand_pref_2])
-
-        syrupsToUse = []
-        # Send chosen preferences to Syrup AI
-        for pref in chosenSyrupPrefs:
-            top5 = generate_similar_syrup_preferences(pref)
-
-            # Can have duplicate syrups the way this is coded right now
-            # Pick 1-2 random flavors from the top 5
-            rand_top5_1 = random.randint(0, len(top5) - 1)
-            rand_top5_2 = random.randint(0, len(top5) - 1)
-            syrupsToUse.append(top5[rand_top5_1])
-            syrupsToUse.append(top5[rand_top5_2])
-
-        drink["syrups"] = syrupsToUse
-
-        # Pick a preffered soda that best matches the generated syrups
-        # Auto pick soda if there is only 1 soda in preferences
-        if len(sodaPrefs) == 1:
-            drink["soda"] = [sodaPrefs[0]]
+        item = item.lower()
+        if item in index.syrup_ids:
+            syrupPrefs.append(item)
+        elif item in index.soda_ids:
+            sodaPrefs.append(item)
+        elif item in index.addin_ids:
+            addinPrefs.append(item)
+
+    drinks = []
+    if len(syrupPrefs) == 0: # the AI does not believe in syrup-less drinks
+        return drinks
+
+    available = None
+    if stock is not None:
+        # Only recommend what can actually be made right now
+        # Out of stock syrup preferences still steer the flavor, only in stock syrups similar to them get picked
+        available = index.availability(stock)
+        sodaPrefs = [pref for pref in sodaPrefs if stock.is_available('sodas', pref)]
+        addinPrefs = [pref for pref in addinPrefs if stock.is_available('addins', pref)]
+        if not available['syrups'].any() or not available['sodas'].any():
+            return drinks
+
+    # Made once here rather than in every ranking below
+    shuffler = shuffler_for(rng)
+
+    # Top 5 similar syrups for every syrup preference, computed in one pass
+    with timing.stage('similar_syrups'):
+        top5_by_pref = dict(zip(syrupPrefs, index.similar_syrups(syrupPrefs, 5, available['syrups'] if available is not None else None,
+                                                                 boost['syrups'] if boost is not None else None, shuffler)))
+
+    seen = set()
+    attempts = 0
+    # Random picks can repeat a drink, so keep generating candidates until there are enough distinct ones
+    while len(drinks) < count and attempts < count * 10:
+        batch = generate_drink_batch(index, syrupPrefs, sodaPrefs, addinPrefs, top5_by_pref, count - len(drinks), available, rng, boost, shuffler)
+        attempts += len(batch)
+        for drink in batch:
+            key = drink_key(drink)
+            if key not in seen and len(drinks) < count:
+                seen.add(key)
+                drinks.append(drink)
+
+    return drinks
+
+
+# Build size drinks at once from already split (and stock filtered) preferences
+def generate_drink_batch(index, syrupPrefs, sodaPrefs, addinPrefs, top5_by_pref, size, available=None, rng=random, boost=None, shuffler=None):
+    boost = boost or {}
+    available = available or {}
+    batch = []
+    with timing.stage('syrup_picks'):
+        for _ in range(size):
+            drink = {}
+            # Randomly picking 1-2 of the syrup preferences to create a drink with
+            chosenSyrupPrefs = []
+            rand_pref_1 = rng.randint(0, len(syrupPrefs) - 1)
+            rand_pref_2 = rng.randint(0, len(syrupPrefs) - 1)
+            chosenSyrupPrefs.append(syrupPrefs[rand_pref_1])
+            if not rand_pref_1 == rand_pref_2:
+                chosenSyrupPrefs.append(syrupPrefs[rand_pref_2])
+
+            syrupsToUse = []
+            # Send chosen preferences to Syrup AI
+            for pref in chosenSyrupPrefs:
+                top5 = top5_by_pref[pref]
+
+                # Can have duplicate syrups the way this is coded right now
+                # Pick 1-2 random flavors from the top 5
+                rand_top5_1 = rng.randint(0, len(top5) - 1)
+                rand_top5_2 = rng.randint(0, len(top5) - 1)
+                syrupsToUse.append(top5[rand_top5_1])
+                syrupsToUse.append(top5[rand_top5_2])
+
+            drink["syrups"] = syrupsToUse
+            batch.append(drink)
+
+    # Rank sodas and add-ins for the syrups of every drink in the batch together
+    # Each drink only ranks the in stock items (or preferences, which were already stock filtered) that go with its
+    # syrups (and soda), see constraints.py
+    # Only as much of each ranking as the picks below look at is selected: the top 5 when there are no preferences,
+    # otherwise the best matching preference
+    with timing.stage('soda_ranking'):
+        rules = index.rules
+        syrupIds = [[index.syrup_ids[syrup] for syrup in drink["syrups"]] for drink in batch]
+        syrupTypes = [get_syrup_types(index, drink["syrups"]) for drink in batch]
+        if len(sodaPrefs) == 0:
+            sodaChoices = available.get('soda_bits', rules.all_sodas)
         else:
-            drink["soda"] = [generate_best_soda(syrupsToUse, sodaPrefs)]
-
-        sodaToUse = drink['soda'][0]
-        # Pick a preffered add-in that best matches the generated syrups and soda
-        # Can pick 0-2 add-ins
-        numAddIn = random.randint(0, 2)
-        if numAddIn > 0:
-            # Auto pick addin if there is only 1 in preferences
-            if len(addinPrefs) == 1:
-                drink['addins'] = [addinPrefs[0]]
-
-            # 0 or 2+ addins in pref
+            sodaChoices = to_bits(index.soda_ids[pref] for pref in sodaPrefs)
+        # Every drink needs a soda, if none of the choices go with the syrups the best flavor match is used anyway
+        sodaCandidates = [to_ids(rules.sodas_for(ids) & sodaChoices or sodaChoices, rules.soda_count) for ids in syrupIds]
+        sodaRankings = index.rank_sodas(syrupTypes, boost.get('sodas'), 5 if len(sodaPrefs) == 0 else 1, shuffler=shuffler, row_candidates=sodaCandidates)
+
+    with timing.stage('soda_picks'):
+        for i, drink in enumerate(batch):
+            # Pick a preffered soda that best matches the generated syrups
+            # Auto pick soda if there is only 1 soda in preferences
+            if len(sodaPrefs) == 1:
+                drink["soda"] = [sodaPrefs[0]]
             else:
-                drink['addins'] = generate_best_addins(syrupsToUse, sodaToUse, addinPrefs, numAddIn)
+                drink["soda"] = [generate_best_soda(drink["syrups"], sodaPrefs, sodaRankings[i], index, rng)]
+
+    with timing.stage('addin_ranking'):
+        if len(addinPrefs) == 0:
+            addinChoices = available.get('addin_bits', rules.all_addins)
         else:
-            drink['addins'] = []
+            addinChoices = to_bits(index.addin_ids[pref] for pref in addinPrefs)
+        addinCandidates = [to_ids(rules.addins_for(ids, index.soda_ids[drink["soda"][0]]) & addinChoices, rules.addin_count)
+                           for ids, drink in zip(syrupIds, batch)]
+        addinSyrupRankings = index.rank_addins_by_syrup(syrupTypes, boost.get('addins'), 5 if len(addinPrefs) == 0 else 1,
+                                                        shuffler=shuffler, row_candidates=addinCandidates)
+
+        # The add-in ranking by soda is only looked at to pick between add-in preferences
+        addinSodaRankings = [None] * len(batch)
+        if len(addinPrefs) > 0:
+            sodaTypes = [" ".join(index.soda_types[index.soda_ids[drink["soda"][0]]]) for drink in batch]
+            addinSodaRankings = index.rank_addins_by_soda(sodaTypes, boost.get('addins'), 1, shuffler=shuffler, row_candidates=addinCandidates)
+
+    with timing.stage('addin_picks'):
+        for i, drink in enumerate(batch):
+            sodaToUse = drink['soda'][0]
+            # Pick a preffered add-in that best matches the generated syrups and soda
+            # Can pick 0-2 add-ins
+            numAddIn = rng.randint(0, 2)
+            if numAddIn > 0:
+                # Auto pick addin if there is only 1 in preferences (and it goes with the drink)
+                if len(addinPrefs) == 1:
+                    drink['addins'] = [addinPrefs[0]] if len(addinCandidates[i]) > 0 else []
+
+                # 0 or 2+ addins in pref
+                else:
+                    drink['addins'] = generate_best_addins(drink["syrups"], sodaToUse, addinPrefs, numAddIn,
+                                                           addinSyrupRankings[i], addinSodaRankings[i], index, rng)
+            else:
+                drink['addins'] = []
 
-        return drink
\ No newline at end of file
+    return batch
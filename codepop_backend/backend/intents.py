@@ -0,0 +1,237 @@
+import csv
+import math
+import os
+import re
+from collections import Counter, namedtuple
+from django.conf import settings
+from .artifacts import Reloader, cache_dir, save_arrays
+
+# Phrases that mean the customer's drink was made wrong or that they want their money back
+# Matched as plain substrings of the lowercased message, like "refund" in "I'd like a refund please"
+DRINK_MADE_WRONG_PHRASES = [
+    "wrong drink", "incorrect drink", "bad drink", "mistake", "not what I ordered",
+    "off", "tastes wrong", "too sweet", "not sweet enough", "too bitter", "too sour",
+    "too salty", "wrong flavor", "missing flavor", "added flavor", "wrong syrup",
+    "extra syrup", "not enough syrup", "wrong base", "too much ice", "not enough ice",
+    "flat", "warm", "cold", "too fizzy", "not fizzy", "wrong size", "wrong temperature",
+    "messed up", "forgot ingredient", "overfilled", "underfilled", "weird taste",
+    "unusual taste", "gross", "disgusting", "not fresh", "stale", "expired",
+    "wrong toppings", "missing toppings", "extra toppings", "wrong ingredients",
+    "bad mix", "not stirred", "too diluted", "watered down", "burnt taste",
+    "sour taste", "bitter taste", "wrong sweetness", "too strong", "not strong enough",
+    "wrong cream", "spoiled", "odd smell", "bad smell", "funky taste",
+    "not as ordered", "doesn’t taste right", "off flavor", "odd aftertaste",
+    "too creamy", "not creamy enough", "incorrect consistency", "too thick",
+    "too thin", "strange consistency", "unpleasant aftertaste", "wrong texture",
+    "wrong ratio", "overpowering flavor", "bland", "missing shot", "extra shot",
+    "different drink", "wrong drink name", "unsatisfied", "not right", "mistaken order",
+    "missing drink", "didn't receive drink", "forgot drink", "drink never arrived",
+    "missing item", "order incomplete", "drink was left out", "never got my drink",
+    "drink wasn’t included", "drink not in bag", "left out my drink", "didn’t deliver drink",
+    "drink made wrong", "drink was made wrong", "drink is wrong", "drink is made wrong",
+    "didn't get drink", "didn't get my drink", "didn't get a drink", "made wrong", "drink remade"
+]
+
+REFUND_PHRASES = [
+    "refund", "money back", "return my money", "get a refund", "compensation",
+    "reimbursement", "want my money back", "give me my money", "credit",
+    "not satisfied", "not happy", "not worth it", "poor quality", "bad experience",
+    "unsatisfactory", "didn't like it", "request refund", "ask for refund",
+    "need a refund", "want a refund", "reimburse me", "return", "return policy",
+    "customer service", "unacceptable", "demand a refund", "disappointed",
+    "unhappy with service", "refund request", "claim refund", "issue refund",
+    "compensation for inconvenience", "unsatisfactory experience",
+    "unsatisfied with product", "exchange", "swap", "not as expected",
+    "didn’t meet expectations", "request money back", "money back guarantee",
+    "seek reimbursement", "entitled to refund", "need compensation",
+    "request credit", "partial refund", "discount", "voucher",
+    "not worth the money", "not good value", "overcharged", "incorrect charge",
+    "wrong billing", "bad service", "inconvenienced", "request resolution"
+]
+
+IntentMatch = namedtuple('IntentMatch', ['intent', 'phrase'])
+
+
+def trie_pattern(phrases):
+    """
+    Return a regex source matching any of phrases. Phrases sharing a prefix share its branch of the pattern,
+    so the regex engine never matches a prefix twice at the same position, and the longest phrase starting there wins.
+    """
+    trie = {}
+    for phrase in phrases:
+        node = trie
+        for char in phrase:
+            node = node.setdefault(char, {})
+        node[None] = None # a phrase ends here
+    return node_pattern(trie)
+
+
+def node_pattern(node):
+    branches = [re.escape(char) + node_pattern(node[char]) for char in sorted(char for char in node if char is not None)]
+    if not branches:
+        return ''
+    pattern = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+    if None in node:
+        # Greedy, so the longer phrases through this node are tried before stopping here
+        pattern = '(?:' + pattern + ')?'
+    return pattern
+
+
+class IntentMatcher:
+    """Finds phrases of several intents in a message with one compiled regex, built once."""
+
+    def __init__(self, phrases_by_intent):
+        # phrase -> intent, a phrase listed under two intents belongs to the first
+        self.intents = {}
+        for intent, phrases in phrases_by_intent.items():
+            for phrase in phrases:
+                self.intents.setdefault(phrase.lower(), intent)
+        self.pattern = re.compile(trie_pattern(self.intents))
+
+    def match(self, text):
+        """Return IntentMatch(intent, phrase) for the first phrase in text (the longest if several start at the same
+        place), or None if there is none."""
+        found = self.pattern.search(text.lower())
+        if found is None:
+            return None
+        return IntentMatch(self.intents[found.group()], found.group())
+
+
+complaint_matcher = IntentMatcher({'wrong_drink': DRINK_MADE_WRONG_PHRASES, 'refund': REFUND_PHRASES})
+
+
+# Labeled example messages the intent classifier is trained on, one "phrase,intent" row each
+phrases_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'IntentPhrases.csv')
+# Written by train_intent_classifier, the chatbot works without it (phrase matching and the model only)
+classifier_path = os.path.join(cache_dir, 'intent_classifier.npz')
+# Least probability the classifier needs before the chatbot acts on its intent instead of asking the model
+intent_threshold = getattr(settings, 'CHATBOT_INTENT_THRESHOLD', 0.5)
+
+# Messages of this intent are left to the model
+OTHER_INTENT = 'other'
+NGRAM_SIZES = (2, 3, 4)
+
+IntentPrediction = namedtuple('IntentPrediction', ['intent', 'probability'])
+
+
+def char_ngrams(text):
+    """
+    Character 2 to 4 grams of each word of the lowercased text, with the word padded by a space on both sides
+    (" hi " gives " h", "hi", "i ", " hi", "hi "...). Misspellings still share most of their n-grams with the real word.
+    The classifier is trained and run on exactly these features.
+    """
+    ngrams = []
+    for word in text.lower().split():
+        word = f" {word} "
+        for size in NGRAM_SIZES:
+            ngrams.extend(word[start:start + size] for start in range(max(1, len(word) - size + 1)))
+    return ngrams
+
+
+def load_phrases(path=None):
+    """Return (phrases, intents) from the labeled phrase file."""
+    phrases, intents = [], []
+    with open(path or phrases_path, newline='') as file:
+        for row in csv.DictReader(file):
+            phrases.append(row['phrase'])
+            intents.append(row['intent'])
+    return phrases, intents
+
+
+def train_classifier(phrases, intents, regularization=10.0):
+    """
+    Fit TF-IDF weighted character n-grams and a logistic regression on the labeled phrases (needs scikit-learn),
+    and return the arrays IntentClassifier runs on.
+    """
+    import numpy as np
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.linear_model import LogisticRegression
+
+    vectorizer = TfidfVectorizer(analyzer=char_ngrams, sublinear_tf=True)
+    features = vectorizer.fit_transform(phrases)
+    model = LogisticRegression(C=regularization, max_iter=1000).fit(features, intents)
+
+    ngrams = vectorizer.get_feature_names_out()
+    return {
+        'ngrams': np.asarray(ngrams, dtype=str),
+        'idf': vectorizer.idf_.astype(np.float32),
+        'coef': model.coef_.astype(np.float32),
+        'intercept': model.intercept_.astype(np.float32),
+        'intents': np.asarray(model.classes_, dtype=str),
+    }
+
+
+def save_classifier(arrays, path=None):
+    save_arrays(path or classifier_path, arrays)
+
+
+class IntentClassifier:
+    """
+    The classifier from train_intent_classifier, run with plain numpy: the message's n-grams are weighted like
+    scikit-learn's TfidfVectorizer(sublinear_tf=True) did in training, then scored by the logistic regression.
+    """
+
+    def __init__(self, arrays, version=None):
+        import numpy as np
+
+        self.version = version
+        ngrams = [str(ngram) for ngram in arrays['ngrams']]
+        self.idf = arrays['idf']
+        # Transposed, so a message's few n-grams pick contiguous rows
+        self.weights = np.ascontiguousarray(arrays['coef'].T)
+        self.intercept = arrays['intercept']
+        self.intents = [str(intent) for intent in arrays['intents']]
+        self.columns = {ngram: column for column, ngram in enumerate(ngrams)}
+        if self.weights.shape[0] != len(ngrams) or len(self.intercept) != len(self.intents):
+            raise ValueError("The intent classifier arrays don't match each other")
+        # A binary model (2 intents) has a single score for the second intent
+        self.binary = self.weights.shape[1] == 1
+
+    @classmethod
+    def load(cls, path):
+        import numpy as np
+
+        version = os.stat(path).st_mtime_ns
+        with np.load(path) as data:
+            return cls({name: data[name] for name in data.files}, version)
+
+    def predict(self, text):
+        """Return IntentPrediction(intent, probability) for the most likely intent of text."""
+        import numpy as np
+
+        counts = Counter(ngram for ngram in char_ngrams(text) if ngram in self.columns)
+        if not counts:
+            # Nothing the classifier has seen, leave it to the model
+            return IntentPrediction(OTHER_INTENT, 0.0)
+        columns = [self.columns[ngram] for ngram in counts]
+        values = np.array([1 + math.log(count) for count in counts.values()], dtype=np.float32) * self.idf[columns]
+        values /= np.sqrt(values @ values)
+        scores = values @ self.weights[columns] + self.intercept
+        if self.binary:
+            probability = 1 / (1 + math.exp(-scores[0]))
+            return IntentPrediction(*((self.intents[1], probability) if probability >= 0.5
+                                      else (self.intents[0], 1 - probability)))
+        scores = np.exp(scores - scores.max())
+        best = int(scores.argmax())
+        return IntentPrediction(self.intents[best], float(scores[best] / scores.sum()))
+
+
+_classifier = Reloader(IntentClassifier.load, "the intent classifier")
+
+
+def get_classifier():
+    """Return the current IntentClassifier, reloading it when train_intent_classifier wrote a new file,
+    or None until it has been trained."""
+    return _classifier.get(classifier_path)
+
+
+def classify(text):
+    """Return the IntentPrediction for text if the classifier is sure enough of an intent other than OTHER_INTENT,
+    otherwise None."""
+    classifier = get_classifier()
+    if classifier is None:
+        return None
+    prediction = classifier.predict(text)
+    if prediction.intent == OTHER_INTENT or prediction.probability < intent_threshold:
+        return None
+    return prediction
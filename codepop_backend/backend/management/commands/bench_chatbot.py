@@ -0,0 +1,101 @@
+import threading
+import time
+from django.core.management.base import BaseCommand, CommandError
+from backend import chatmodel
+from .bench_drinkai import parse_counts, percentile
+
+MESSAGES = [
+    "hi, how are you today?",
+    "what is your favorite drink?",
+    "do you have anything with coconut?",
+    "thanks for the help!",
+    "is the store open late tonight?",
+    "what goes well with vanilla?",
+]
+
+
+class Command(BaseCommand):
+    help = ('Benchmarks chatbot replies per second with one generate call per request against batched generation, '
+            'and time to first token when streaming')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', default='1,8,32', help='Comma separated numbers of users chatting at the same time')
+        parser.add_argument('--messages', type=int, default=2, help='Messages each user sends, one after the other')
+        parser.add_argument('--max-new-tokens', type=int, default=32,
+                            help='Reply length cap, so every run generates a comparable amount of text')
+        parser.add_argument('--window-ms', type=float, default=chatmodel.batch_window * 1000 or 5,
+                            help='Batching window in milliseconds')
+        parser.add_argument('--max-batch-size', type=int, default=chatmodel.max_batch_size)
+
+    def handle(self, *args, **options):
+        user_counts = parse_counts(options['users'], 'users')
+        max_new_tokens = options['max_new_tokens']
+        try:
+            chatmodel.load_model()
+        except chatmodel.ChatbotUnavailable as e:
+            raise CommandError(str(e))
+
+        def per_request(message):
+            return chatmodel.generate_batch([message], max_new_tokens)[0]
+
+        scheduler = chatmodel.BatchScheduler(lambda messages: chatmodel.generate_batch(messages, max_new_tokens),
+                                             options['window_ms'] / 1000, options['max_batch_size'])
+
+        def batched(message):
+            return scheduler.submit(message).result()
+
+        def streamed(message):
+            # Returns the time to first token, what a user of the streaming endpoint waits for
+            started = time.perf_counter()
+            first_token = None
+            for _ in chatmodel.local_stream(message, max_new_tokens):
+                if first_token is None:
+                    first_token = time.perf_counter() - started
+            return first_token
+
+        for users in user_counts:
+            results = {}
+            for mode, reply in (('per-request', per_request), ('batched', batched), ('streaming', streamed)):
+                results[mode] = self.run_case(reply, users, options['messages'])
+                self.report(f"users={users} {mode}", results[mode])
+            speedup = results['batched']['replies_per_sec'] / results['per-request']['replies_per_sec']
+            self.stdout.write(f"users={users} batched throughput is {speedup:.2f}x per-request\n")
+
+    def run_case(self, reply, users, messages):
+        """Have users threads each send messages messages, like concurrent requests on one web worker."""
+        latencies = [[] for _ in range(users)]
+        first_tokens = []
+        start_barrier = threading.Barrier(users)
+
+        def chat(user):
+            start_barrier.wait()
+            for i in range(messages):
+                started = time.perf_counter()
+                first_token = reply(MESSAGES[(user + i) % len(MESSAGES)])
+                latencies[user].append(time.perf_counter() - started)
+                if isinstance(first_token, float):
+                    first_tokens.append(first_token)
+
+        threads = [threading.Thread(target=chat, args=(user,)) for user in range(users)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        flat = sorted(latency for timings in latencies for latency in timings)
+        first_tokens.sort()
+        return {
+            'replies_per_sec': len(flat) / elapsed if elapsed else 0.0,
+            'p50_ms': percentile(flat, 50) * 1000,
+            'p95_ms': percentile(flat, 95) * 1000,
+            'first_token_p50_ms': percentile(first_tokens, 50) * 1000 if first_tokens else None,
+        }
+
+    def report(self, name, result):
+        line = (f"{name:<24} {result['replies_per_sec']:>8.2f} replies/s  "
+                f"p50 {result['p50_ms']:.0f} ms  p95 {result['p95_ms']:.0f} ms")
+        if result['first_token_p50_ms'] is not None:
+            line += f"  first token p50 {result['first_token_p50_ms']:.0f} ms"
+        self.stdout.write(line)
@@ -0,0 +1,128 @@
+import gc
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from django.core.management.base import BaseCommand, CommandError
+from backend import chatmodel
+from .bench_chatbot import MESSAGES
+from .bench_drinkai import peak_rss_mb, percentile
+
+
+def rss_mb():
+    """Resident memory of this process right now in MB, or None where it can't be read (only Linux has /proc)."""
+    try:
+        with open('/proc/self/statm') as file:
+            resident_pages = int(file.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return resident_pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+
+
+def run_backend(backend, max_new_tokens, rounds, seed):
+    """
+    Load the model for backend and time it on MESSAGES, one message at a time and then all of them as one batch.
+    Runs in its own process, so the memory figures belong to this backend alone.
+    """
+    import django
+    from django.apps import apps
+    if not apps.ready:  # a spawned pool worker starts without Django set up
+        django.setup()
+    import torch
+
+    rss_before = rss_mb()
+    started = time.perf_counter()
+    tokenizer, model = chatmodel.load_pretrained(backend)
+    load_seconds = time.perf_counter() - started
+    gc.collect()
+    rss_loaded = rss_mb()
+
+    # Every reply is exactly max_new_tokens long, so both backends do the same amount of work
+    options = {**chatmodel.generation_options(tokenizer, max_new_tokens), 'min_new_tokens': max_new_tokens}
+
+    def generate(messages):
+        encoded = tokenizer([message + tokenizer.eos_token for message in messages], return_tensors='pt', padding=True)
+        with torch.inference_mode():
+            output = model.generate(encoded['input_ids'], attention_mask=encoded['attention_mask'], **options)
+        return [tokenizer.decode(row[encoded['input_ids'].shape[-1]:], skip_special_tokens=True) for row in output]
+
+    torch.manual_seed(seed)
+    # Warm up, the first call pays for one-off allocations
+    sample = generate(MESSAGES[:1])[0]
+
+    latencies = []
+    for _ in range(rounds):
+        for message in MESSAGES:
+            started = time.perf_counter()
+            generate([message])
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    for _ in range(rounds):
+        generate(MESSAGES)
+    batch_elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'load_seconds': load_seconds,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'tokens_per_sec': len(latencies) * max_new_tokens / sum(latencies),
+        'batch_tokens_per_sec': rounds * len(MESSAGES) * max_new_tokens / batch_elapsed,
+        'model_rss_mb': rss_loaded - rss_before if rss_loaded is not None else None,
+        'rss_mb': rss_mb(),
+        'peak_rss_mb': peak_rss_mb(),
+        'sample': sample,
+    }
+
+
+class Command(BaseCommand):
+    help = ('Benchmarks the chatbot inference backends (CHATBOT_INFERENCE_BACKEND) on a fixed set of messages: '
+            'latency, tokens per second one at a time and batched, and resident memory')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--backends', default=','.join(chatmodel.INFERENCE_BACKENDS),
+                            help='Comma separated backends to compare')
+        parser.add_argument('--max-new-tokens', type=int, default=32, help='Tokens generated for every reply')
+        parser.add_argument('--rounds', type=int, default=3, help='Times each message is answered')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        backends = [backend.strip() for backend in options['backends'].split(',') if backend.strip()]
+        unknown = [backend for backend in backends if backend not in chatmodel.INFERENCE_BACKENDS]
+        if unknown or not backends:
+            raise CommandError(f"--backends must be some of {', '.join(chatmodel.INFERENCE_BACKENDS)}.")
+        if options['max_new_tokens'] < 1 or options['rounds'] < 1:
+            raise CommandError("--max-new-tokens and --rounds must be at least 1.")
+
+        results = {}
+        for backend in backends:
+            # A fresh process per backend, so one model's memory doesn't count against the other
+            with ProcessPoolExecutor(max_workers=1) as pool:
+                try:
+                    results[backend] = pool.submit(run_backend, backend, options['max_new_tokens'],
+                                                   options['rounds'], options['seed']).result()
+                except chatmodel.ChatbotUnavailable as e:
+                    raise CommandError(str(e))
+            self.report(backend, results[backend])
+
+        if 'fp32' in results:
+            baseline = results['fp32']
+            for backend, result in results.items():
+                if backend != 'fp32':
+                    self.stdout.write(
+                        f"{backend}: p50 latency {baseline['p50_ms'] / result['p50_ms']:.2f}x faster, "
+                        f"batched throughput {result['batch_tokens_per_sec'] / baseline['batch_tokens_per_sec']:.2f}x fp32"
+                    )
+
+    def report(self, backend, result):
+        memory = []
+        if result['rss_mb'] is not None:
+            memory.append(f"model +{result['model_rss_mb']:.0f} MB  RSS {result['rss_mb']:.0f} MB")
+        if result['peak_rss_mb'] is not None:
+            memory.append(f"peak RSS {result['peak_rss_mb']:.0f} MB")
+        self.stdout.write(
+            f"{backend:<6} load {result['load_seconds']:.1f} s  p50 {result['p50_ms']:.0f} ms  p95 {result['p95_ms']:.0f} ms  "
+            f"{result['tokens_per_sec']:.1f} tokens/s  batched {result['batch_tokens_per_sec']:.1f} tokens/s  "
+            + ('  '.join(memory) or "memory n/a")
+        )
+        self.stdout.write(f"       sample reply: {result['sample']!r}")
@@ -0,0 +1,241 @@
+import json
+import os
+import platform
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from django.core.management.base import BaseCommand, CommandError
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process in MB, or None where it can't be read."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes everywhere else
+    return peak / (1024 * 1024) if platform.system() == 'Darwin' else peak / 1024
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def parse_counts(value, option):
+    """Parse a comma separated --option value of whole numbers of at least 1."""
+    try:
+        counts = [int(part) for part in value.split(',') if part.strip()]
+    except ValueError:
+        raise CommandError(f"--{option} must be a comma separated list of whole numbers.")
+    if not counts or min(counts) < 1:
+        raise CommandError(f"--{option} must contain numbers of at least 1.")
+    return counts
+
+
+def write_synthetic_catalog(directory, scale, seed):
+    """
+    Write Syrups.csv, Sodas.csv and AddIns.csv scale times the size of the real ones into directory.
+    The first copy is the real catalog, the others get renamed items with random flavor words from the same vocabulary.
+    """
+    import pandas as p
+    from backend import drinkAI
+
+    rng = random.Random(seed)
+    catalogs = (
+        (drinkAI.syrup_file_path, ['type']),
+        (drinkAI.soda_file_path, ['type', 'best-match-flavors']),
+        (drinkAI.addin_file_path, ['best-match-syrup', 'best-match-soda']),
+    )
+    for source, flavor_columns in catalogs:
+        frame = p.read_csv(source)
+        vocabularies = {column: sorted({word for value in frame[column] for word in value.split()}) for column in flavor_columns}
+        copies = [frame]
+        for copy in range(1, scale):
+            extra = frame.copy()
+            extra['name'] = [f"{name} {copy}" for name in frame['name']]
+            for column, words in vocabularies.items():
+                extra[column] = [" ".join(rng.sample(words, rng.randint(1, min(3, len(words))))) for _ in range(len(frame))]
+            copies.append(extra)
+        synthetic = p.concat(copies, ignore_index=True)
+        synthetic['index'] = range(len(synthetic))
+        synthetic.to_csv(os.path.join(directory, os.path.basename(source)), index=False)
+
+
+def use_catalog(directory):
+    """Point drinkAI at the csv files in directory, the index is rebuilt from them on next use."""
+    from backend import drinkAI
+
+    drinkAI.syrup_file_path = os.path.join(directory, 'Syrups.csv')
+    drinkAI.soda_file_path = os.path.join(directory, 'Sodas.csv')
+    drinkAI.addin_file_path = os.path.join(directory, 'AddIns.csv')
+    drinkAI._flavor_index = None
+
+
+def make_preference_sets(size, count, seed):
+    """Return count random preference lists of the given size, drawn from the syrup, soda and add-in catalogs."""
+    from backend.drinkAI import get_flavor_index
+
+    index = get_flavor_index()
+    names = list(index.syrup_names) + list(index.soda_names) + list(index.addin_names)
+    rng = random.Random(seed)
+    return [rng.sample(names, min(size, len(names))) for _ in range(count)]
+
+
+def run_worker(preference_sets, threads, iterations, seed, catalog_dir=None):
+    """
+    Generate iterations drinks on each of threads threads, cycling through preference_sets.
+    Runs in the command's process or in a pool worker, and returns the per-drink latencies in seconds.
+    """
+    import django
+    from django.apps import apps
+    if not apps.ready:  # a spawned pool worker starts without Django set up
+        django.setup()
+        if catalog_dir:
+            use_catalog(catalog_dir)
+    from backend.drinkAI import generate_soda, get_flavor_index
+
+    # Build the index before the clock starts so only generation is measured
+    get_flavor_index()
+    latencies = [[] for _ in range(threads)]
+    start_barrier = threading.Barrier(threads)
+
+    def loop(thread_number):
+        rng = random.Random(seed + thread_number)
+        timings = latencies[thread_number]
+        start_barrier.wait()
+        for i in range(iterations):
+            prefs = preference_sets[(thread_number + i) % len(preference_sets)]
+            started = time.perf_counter()
+            generate_soda(prefs, rng=rng)
+            timings.append(time.perf_counter() - started)
+
+    workers = [threading.Thread(target=loop, args=(n,)) for n in range(threads)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+
+    return {
+        'latencies': [latency for timings in latencies for latency in timings],
+        'elapsed': elapsed,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks drink generation throughput, tail latency and memory, optionally against a saved baseline'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='2,8,16', help='Comma separated preference set sizes')
+        parser.add_argument('--threads', default='1,4', help='Comma separated thread counts per process')
+        parser.add_argument('--processes', default='1', help='Comma separated process counts')
+        parser.add_argument('--iterations', type=int, default=200, help='Drinks generated by each thread')
+        parser.add_argument('--seed', type=int, default=0, help='Seed for the preference sets and the generator')
+        parser.add_argument('--synthetic-scale', type=int, default=1,
+                            help='Benchmark against a generated catalog this many times the size of the csv files')
+        parser.add_argument('--save', help='Write the results to this JSON file')
+        parser.add_argument('--baseline', help='Compare against results saved earlier with --save')
+        parser.add_argument('--tolerance', type=float, default=10.0,
+                            help='Percent drop in ops/sec or rise in p95 that counts as a regression')
+
+    def handle(self, *args, **options):
+        sizes = parse_counts(options['sizes'], 'sizes')
+        thread_counts = parse_counts(options['threads'], 'threads')
+        process_counts = parse_counts(options['processes'], 'processes')
+        iterations = options['iterations']
+        seed = options['seed']
+        scale = options['synthetic_scale']
+        if scale < 1:
+            raise CommandError("--synthetic-scale must be at least 1.")
+
+        with tempfile.TemporaryDirectory() as catalog_dir:
+            if scale > 1:
+                write_synthetic_catalog(catalog_dir, scale, seed)
+                use_catalog(catalog_dir)
+            else:
+                catalog_dir = None
+
+            results = {}
+            for size in sizes:
+                preference_sets = make_preference_sets(size, 50, seed)
+                for processes in process_counts:
+                    for threads in thread_counts:
+                        name = f"size={size} threads={threads} processes={processes}"
+                        if scale > 1:
+                            name += f" scale={scale}"
+                        results[name] = self.run_case(preference_sets, processes, threads, iterations, seed, catalog_dir)
+                        self.report(name, results[name])
+
+        if options['save']:
+            with open(options['save'], 'w') as file:
+                json.dump(results, file, indent=2)
+            self.stdout.write(f"Saved results to {options['save']}")
+
+        if options['baseline']:
+            self.compare(results, options['baseline'], options['tolerance'])
+
+    def run_case(self, preference_sets, processes, threads, iterations, seed, catalog_dir=None):
+        if processes == 1:
+            runs = [run_worker(preference_sets, threads, iterations, seed)]
+        else:
+            with ProcessPoolExecutor(max_workers=processes) as pool:
+                futures = [pool.submit(run_worker, preference_sets, threads, iterations, seed + 1000 * n, catalog_dir)
+                           for n in range(processes)]
+                runs = [future.result() for future in futures]
+
+        latencies = sorted(latency for run in runs for latency in run['latencies'])
+        # The processes run side by side, so throughput is measured against the slowest one
+        elapsed = max(run['elapsed'] for run in runs)
+        rss = [run['peak_rss_mb'] for run in runs if run['peak_rss_mb'] is not None]
+        return {
+            'ops_per_sec': len(latencies) / elapsed if elapsed else 0.0,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p95_ms': percentile(latencies, 95) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'peak_rss_mb': max(rss) if rss else None,
+        }
+
+    def report(self, name, result):
+        rss = f"{result['peak_rss_mb']:.0f} MB" if result['peak_rss_mb'] is not None else "n/a"
+        self.stdout.write(
+            f"{name:<48} {result['ops_per_sec']:>9.1f} ops/s  "
+            f"p50 {result['p50_ms']:.2f} ms  p95 {result['p95_ms']:.2f} ms  p99 {result['p99_ms']:.2f} ms  "
+            f"peak RSS {rss}"
+        )
+
+    def compare(self, results, baseline_path, tolerance):
+        try:
+            with open(baseline_path) as file:
+                baseline = json.load(file)
+        except (OSError, ValueError) as e:
+            raise CommandError(f"Could not read baseline {baseline_path}: {e}")
+
+        regressions = []
+        self.stdout.write(f"\nCompared to {baseline_path}:")
+        for name, result in results.items():
+            before = baseline.get(name)
+            if before is None:
+                self.stdout.write(f"{name:<48} not in baseline")
+                continue
+            ops_change = (result['ops_per_sec'] - before['ops_per_sec']) / before['ops_per_sec'] * 100
+            p95_change = (result['p95_ms'] - before['p95_ms']) / before['p95_ms'] * 100
+            line = f"{name:<48} ops/s {ops_change:+.1f}%  p95 {p95_change:+.1f}%"
+            if ops_change < -tolerance or p95_change > tolerance:
+                regressions.append(name)
+                self.stdout.write(self.style.ERROR(line + "  REGRESSION"))
+            else:
+                self.stdout.write(self.style.SUCCESS(line))
+
+        if regressions:
+            raise CommandError(f"{len(regressions)} benchmark case(s) regressed by more than {tolerance}%.")
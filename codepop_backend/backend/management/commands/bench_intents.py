@@ -0,0 +1,39 @@
+import timeit
+from django.core.management.base import BaseCommand, CommandError
+from backend.intents import DRINK_MADE_WRONG_PHRASES, REFUND_PHRASES, complaint_matcher
+
+MESSAGES = [
+    "hi",
+    "what drinks do you recommend for a hot day?",
+    "I want a refund",
+    "my drink was made wrong, it tastes like nothing I have ever ordered before and the ice melted",
+    "Can you tell me about the loyalty program and how points work when I order through the app every morning?",
+    "the coconut cream was missing and it is way too sweet",
+]
+
+
+def scan_phrases(user_input):
+    """The matching Chatbot.post did before the compiled matcher: a lowercase and substring check per phrase."""
+    made_wrong_found = any(keyword in user_input.lower() for keyword in DRINK_MADE_WRONG_PHRASES)
+    refund_keyword_found = any(keyword in user_input.lower() for keyword in REFUND_PHRASES)
+    return made_wrong_found or refund_keyword_found
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks the compiled complaint matcher against scanning the phrase lists one by one'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--number', type=int, default=20000, help='Matches timed per message and matcher')
+
+    def handle(self, *args, **options):
+        number = options['number']
+        if number < 1:
+            raise CommandError("--number must be at least 1.")
+
+        for message in MESSAGES:
+            match = complaint_matcher.match(message)
+            scan = min(timeit.repeat(lambda: scan_phrases(message), number=number, repeat=3)) / number
+            compiled = min(timeit.repeat(lambda: complaint_matcher.match(message), number=number, repeat=3)) / number
+            label = f"{match.intent} ({match.phrase})" if match else "no match"
+            self.stdout.write(f"{message[:40]!r:<44} {label:<32} scan {scan * 1e6:7.2f} us  "
+                              f"compiled {compiled * 1e6:6.2f} us  {scan / compiled:5.1f}x")
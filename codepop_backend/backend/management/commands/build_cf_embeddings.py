@@ -0,0 +1,24 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from backend import collaborative
+
+
+class Command(BaseCommand):
+    help = 'Builds the collaborative filtering embeddings used by /generate/<user_id>/ from order history and favorites'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--components', type=int, default=getattr(settings, 'DRINKAI_CF_COMPONENTS', 16),
+                            help='Length of the user and ingredient vectors')
+
+    def handle(self, *args, **options):
+        user_ids, items, matrix = collaborative.build_interactions()
+        self.stdout.write(f"{len(user_ids)} users x {len(items)} ingredients, {matrix.nnz} interactions")
+
+        try:
+            user_vectors, item_vectors = collaborative.factorize(matrix, options['components'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        # Running servers pick the new file up on their next request
+        collaborative.save_embeddings(user_ids, user_vectors, items, item_vectors)
+        self.stdout.write(self.style.SUCCESS(f"Saved {user_vectors.shape[1]} dimensional embeddings to {collaborative.embeddings_path}"))
@@ -0,0 +1,42 @@
+import os
+import shutil
+import tempfile
+import numpy as n
+from django.core.management.base import BaseCommand
+from backend import drinkAI
+
+
+class Command(BaseCommand):
+    help = 'Precomputes the drink AI flavor and similarity matrices into .npy files that every worker memory-maps'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keep-old', action='store_true', help='Keep matrices built from earlier versions of the csv files')
+
+    def handle(self, *args, **options):
+        index = drinkAI.FlavorIndex(precomputed=False)
+        matrices = {
+            'syrup_vectors': index.syrup_vectors,
+            'syrup_similarity': index.syrup_vectors @ index.syrup_vectors.T,
+            'soda_vectors': index.soda_vectors,
+            'addin_syrup_vectors': index.addin_syrup_vectors,
+            'addin_soda_vectors': index.addin_soda_vectors,
+        }
+
+        # Written to a temporary folder and renamed into place, so a worker never maps half written files
+        os.makedirs(drinkAI.matrix_dir, exist_ok=True)
+        folder = os.path.join(drinkAI.matrix_dir, index.digest)
+        temporary_folder = tempfile.mkdtemp(dir=drinkAI.matrix_dir)
+        for name, matrix in matrices.items():
+            n.save(os.path.join(temporary_folder, name + '.npy'), n.ascontiguousarray(matrix))
+        if os.path.isdir(folder):
+            shutil.rmtree(folder)
+        os.replace(temporary_folder, folder)
+        self.stdout.write(self.style.SUCCESS(f"Saved matrices for catalog {index.digest} to {folder}"))
+
+        if not options['keep_old']:
+            for entry in os.listdir(drinkAI.matrix_dir):
+                if entry != index.digest:
+                    # Workers that still map old files keep their pages until they reload the catalog
+                    shutil.rmtree(os.path.join(drinkAI.matrix_dir, entry), ignore_errors=True)
+
+        # Running workers pick the matrices up the next time they build the index (csv change or restart)
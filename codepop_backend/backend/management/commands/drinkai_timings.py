@@ -0,0 +1,39 @@
+import os
+from django.core.management.base import BaseCommand
+from backend import timing
+
+
+class Command(BaseCommand):
+    help = 'Prints per-stage drink generation timings merged from every process (needs DRINKAI_TIMING on while serving)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir', help='Folder of histogram files (defaults to DRINKAI_CACHE_DIR/timings)')
+        parser.add_argument('--namespace', default='',
+                            help='Print the stages recorded under this prefix instead, e.g. chat for chat:first_token')
+        parser.add_argument('--reset', action='store_true',
+                            help='Delete the histogram files (of every namespace) after printing them')
+
+    def handle(self, *args, **options):
+        directory = options['dir'] or timing.timing_dir
+        # Other parts of the server (the chatbot) share the histogram files under their own prefix
+        histograms = {name: histogram for name, histogram in timing.load_histograms(directory).items()
+                      if timing.namespace(name) == options['namespace']}
+        if not histograms:
+            self.stdout.write(f"No timings in {directory}, is DRINKAI_TIMING on?")
+            return
+
+        # Percentiles are bucket upper bounds, so they read as "at most"
+        self.stdout.write(f"{'stage':<18} {'count':>9} {'mean ms':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'total s':>9}")
+        for name, histogram in sorted(histograms.items(), key=lambda item: -item[1].total_ms):
+            count = histogram.count
+            self.stdout.write(
+                f"{name:<18} {count:>9} {histogram.total_ms / count if count else 0:>9.2f} "
+                f"{histogram.percentile(50):>9} {histogram.percentile(95):>9} {histogram.percentile(99):>9} "
+                f"{histogram.total_ms / 1000:>9.2f}"
+            )
+
+        if options['reset']:
+            for name in os.listdir(directory):
+                if name.endswith('.json'):
+                    os.remove(os.path.join(directory, name))
+            self.stdout.write("Deleted the histogram files")
@@ -0,0 +1,30 @@
+from collections import Counter
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from backend.models import Order, Popularity
+from backend.popularity import drink_items
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the Popularity table from every existing order (it is kept up to date incrementally afterwards)'
+
+    def handle(self, *args, **kwargs):
+        ordered = Counter()
+        completed = Counter()
+        for order in Order.objects.prefetch_related('Drinks'):
+            day = timezone.localdate(order.CreationTime)
+            for drink in order.Drinks.all():
+                for item_type, item_name in drink_items(drink):
+                    ordered[(item_type, item_name, day)] += 1
+                    if order.OrderStatus == 'completed':
+                        completed[(item_type, item_name, day)] += 1
+
+        rows = [
+            Popularity(ItemType=item_type, ItemName=item_name, Day=day, Ordered=count, Completed=completed[(item_type, item_name, day)])
+            for (item_type, item_name, day), count in ordered.items()
+        ]
+        with transaction.atomic():
+            Popularity.objects.all().delete()
+            Popularity.objects.bulk_create(rows, batch_size=1000)
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {len(rows)} popularity rows"))
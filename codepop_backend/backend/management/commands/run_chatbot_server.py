@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+from backend import chatmodel
+
+
+class Command(BaseCommand):
+    help = 'Hosts the chatbot model in this process for web workers to send messages to (see CHATBOT_INFERENCE_ADDRESS)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--address', help='Unix socket path or "127.0.0.1:port" to listen on (defaults to CHATBOT_INFERENCE_ADDRESS)')
+
+    def handle(self, *args, **options):
+        address = options['address'] or chatmodel.inference_address
+        if not address:
+            raise CommandError("Set CHATBOT_INFERENCE_ADDRESS or pass --address.")
+        try:
+            chatmodel.require_authkey()
+        except chatmodel.ChatbotUnavailable as e:
+            raise CommandError(str(e))
+        host = chatmodel.parse_address(address)
+        if not isinstance(host, str) and host[0] not in ('127.0.0.1', 'localhost', '::1'):
+            # Anyone who can reach the port can try the authkey, keep it on this machine
+            self.stdout.write(self.style.WARNING(f"{address} is reachable from other machines, listen on a unix socket "
+                                                 f"or 127.0.0.1 instead."))
+
+        # Loaded before listening, so the first message isn't the one that waits for it
+        self.stdout.write(f"Loading {chatmodel.model_name}...")
+        try:
+            chatmodel.load_model()
+        except chatmodel.ChatbotUnavailable as e:
+            raise CommandError(str(e))
+
+        with chatmodel.listen(address) as listener:
+            self.stdout.write(self.style.SUCCESS(f"Chatbot inference server listening on {address}"))
+            try:
+                chatmodel.serve(listener)
+            except KeyboardInterrupt:
+                pass
@@ -0,0 +1,53 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from backend import intents
+
+
+class Command(BaseCommand):
+    help = 'Trains the chatbot intent classifier (refund, remake, order status, small talk) from the labeled phrase file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--phrases', help='Labeled "phrase,intent" csv (defaults to backend/IntentPhrases.csv)')
+        parser.add_argument('--output', help='Where to write the classifier (defaults to DRINKAI_CACHE_DIR/intent_classifier.npz)')
+        parser.add_argument('--regularization', type=float, default=10.0,
+                            help='Inverse regularization strength (C) of the logistic regression')
+
+    def handle(self, *args, **options):
+        try:
+            phrases, labels = intents.load_phrases(options['phrases'])
+        except (OSError, KeyError) as e:
+            raise CommandError(f"Could not read the labeled phrases: {e}")
+        if len(set(labels)) < 2:
+            raise CommandError("The labeled phrases need at least 2 intents.")
+        self.stdout.write(f"{len(phrases)} phrases, intents: {', '.join(sorted(set(labels)))}")
+
+        self.report_accuracy(phrases, labels, options['regularization'])
+
+        arrays = intents.train_classifier(phrases, labels, options['regularization'])
+        path = options['output'] or intents.classifier_path
+        # Running servers pick the new file up on their next chat message
+        intents.save_classifier(arrays, path)
+        classifier = intents.IntentClassifier.load(path)
+
+        started = time.perf_counter()
+        for phrase in phrases:
+            classifier.predict(phrase)
+        per_message = (time.perf_counter() - started) / len(phrases)
+        self.stdout.write(self.style.SUCCESS(
+            f"Saved {len(arrays['ngrams'])} n-gram classifier to {path} ({per_message * 1e6:.0f} us per message)"))
+
+    def report_accuracy(self, phrases, labels, regularization):
+        """Print the accuracy on phrases held out of training, 5 folds at a time."""
+        from sklearn.model_selection import StratifiedKFold
+
+        smallest = min(labels.count(label) for label in set(labels))
+        if smallest < 2:
+            return
+        correct = 0
+        folds = StratifiedKFold(n_splits=min(5, smallest), shuffle=True, random_state=0)
+        for train_rows, test_rows in folds.split(phrases, labels):
+            arrays = intents.train_classifier([phrases[row] for row in train_rows], [labels[row] for row in train_rows],
+                                              regularization)
+            classifier = intents.IntentClassifier(arrays)
+            correct += sum(classifier.predict(phrases[row]).intent == labels[row] for row in test_rows)
+        self.stdout.write(f"Held out accuracy: {correct / len(phrases):.1%}")
@@ -14,6 +14,13 @@ class Preference(models.Model):
     # Preference field with a string data type
     Preference = models.CharField(max_length=100, blank=False, null=False)
 
+    # Remember the values read from the database, so a save can tell which user the preference belonged to (see signals.py)
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
     def __str__(self):
         return f'Preference {self.PreferenceID} for User {self.UserID}: {self.Preference}'
     
@@ -96,6 +103,13 @@ class Order(models.Model):
     CreationTime = models.DateTimeField(auto_now_add=True)
     LockerCombo = models.BigIntegerField(null=True)
     StripeID = models.CharField()
+
+    # Remember the values read from the database, so a save can tell whether it completed the order (see signals.py)
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
     
     def add_drinks(self, drink_ids):
         # Assuming you have a ManyToMany field for drinks in your Order model
@@ -143,4 +157,31 @@ class Revenue(models.Model):
         try:
             return f"Revenue {self.RevenueID} for Order {self.OrderID}: ${self.TotalAmount:.2f}"
         except Order.DoesNotExist:
-            return f"Revenue {self.RevenueID} for unknown Order {self.OrderID}: ${self.TotalAmount:.2f}"
\ No newline at end of file
+            return f"Revenue {self.RevenueID} for unknown Order {self.OrderID}: ${self.TotalAmount:.2f}"
+
+class Popularity(models.Model):
+    """
+    How often a drink or ingredient was ordered, and how often those orders were completed, per day.
+    Kept up to date by the signals in signals.py so popular items never need a scan of every Order.
+    Drink rows use the DrinkID as ItemName, ingredient rows the lowercased ingredient name.
+    """
+    ITEM_TYPES = [
+        ('Drink', 'Drink'),
+        ('Syrup', 'Syrup'),
+        ('Soda', 'Soda'),
+        ('Add In', 'Add In'),
+    ]
+
+    PopularityID = models.AutoField(primary_key=True)
+    ItemType = models.CharField(max_length=50, choices=ITEM_TYPES)
+    ItemName = models.CharField(max_length=255)
+    Day = models.DateField()
+    Ordered = models.PositiveIntegerField(default=0)
+    Completed = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('ItemType', 'ItemName', 'Day')
+        indexes = [models.Index(fields=['ItemType', 'Day'])]
+
+    def __str__(self):
+        return f"{self.ItemType} {self.ItemName} on {self.Day}: {self.Ordered} ordered, {self.Completed} completed"
\ No newline at end of file
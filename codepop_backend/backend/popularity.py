@@ -0,0 +1,87 @@
+from datetime import timedelta
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+from .cache import LRUCache
+from .models import Drink, Popularity
+
+# How many days of counts "popular" looks back over
+popular_days = getattr(settings, 'DRINKAI_POPULAR_DAYS', 30)
+
+# Popularity ItemType -> the Drink field listing ingredients of that type
+INGREDIENT_FIELDS = {
+    'Syrup': 'SyrupsUsed',
+    'Soda': 'SodaUsed',
+    'Add In': 'AddIns',
+}
+
+# Preferences built from the popular ingredients, so general users don't aggregate the table on every request
+popular_preferences_cache = LRUCache(1, getattr(settings, 'DRINKAI_RECOMMENDATION_CACHE_TTL', 300))
+
+
+def drink_items(drink):
+    """Return the (ItemType, ItemName) rows a drink counts toward: the drink itself and each of its ingredients."""
+    items = [('Drink', str(drink.DrinkID))]
+    for item_type, field in INGREDIENT_FIELDS.items():
+        for name in getattr(drink, field) or []:
+            items.append((item_type, name.lower()))
+    return items
+
+
+def increment(items, field, day=None):
+    """Add one to field ('Ordered' or 'Completed') of each (ItemType, ItemName) row for the day."""
+    day = day or timezone.localdate()
+    for item_type, item_name in items:
+        rows = Popularity.objects.filter(ItemType=item_type, ItemName=item_name, Day=day)
+        # F() makes the database do the addition, so concurrent orders can't overwrite each other's counts
+        if rows.update(**{field: F(field) + 1}) == 0:
+            try:
+                with transaction.atomic():
+                    Popularity.objects.create(ItemType=item_type, ItemName=item_name, Day=day, **{field: 1})
+            except IntegrityError:
+                # Another request created today's row first
+                rows.update(**{field: F(field) + 1})
+
+
+def record_drinks(drinks, field, day=None):
+    items = []
+    for drink in drinks:
+        items.extend(drink_items(drink))
+    increment(items, field, day)
+
+
+def popular_items(item_type, limit=10, days=None):
+    """
+    Return [{'ItemName', 'Ordered', 'Completed'}] for the most popular items of a type over the last days,
+    most completed orders first (ties broken by times ordered).
+    """
+    since = timezone.localdate() - timedelta(days=(days or popular_days) - 1)
+    rows = (Popularity.objects.filter(ItemType=item_type, Day__gte=since)
+            .values('ItemName')
+            .annotate(Ordered=Sum('Ordered'), Completed=Sum('Completed'))
+            .order_by('-Completed', '-Ordered', 'ItemName'))
+    return list(rows[:limit])
+
+
+def popular_drinks(limit=10, days=None):
+    """Return [(Drink, counts)] for the most popular drinks that still exist."""
+    counts = popular_items('Drink', limit, days)
+    drinks = Drink.objects.in_bulk([int(row['ItemName']) for row in counts])
+    return [(drinks[int(row['ItemName'])], row) for row in counts if int(row['ItemName']) in drinks]
+
+
+def popular_preferences():
+    """
+    Return a preference list of the most popular syrups, sodas and add-ins, for users without preferences of their own.
+    Returns an empty list until orders have been recorded.
+    """
+    preferences = popular_preferences_cache.get('preferences')
+    if preferences is None:
+        preferences = [row['ItemName'] for row in popular_items('Syrup', 5)]
+        # The drink AI can't make a drink without a syrup, sodas and add-ins alone are no use
+        if preferences:
+            preferences += [row['ItemName'] for row in popular_items('Soda', 2)]
+            preferences += [row['ItemName'] for row in popular_items('Add In', 2)]
+        popular_preferences_cache.set('preferences', preferences)
+    return preferences
@@ -0,0 +1,101 @@
+import queue
+import threading
+from collections import deque
+from django.conf import settings
+from .cache import LRUCache
+
+# Drinks kept ready per active user (and for general users), 0 turns pre-generation off
+queue_size = getattr(settings, 'DRINKAI_PREGEN_QUEUE_SIZE', 5)
+
+# user id (or 'general') -> (context the drinks were made for, deque of ready drinks)
+# The context is the candidate pool key (preferences, catalog, stock, embeddings), drinks made for another context are dropped
+ready_drinks = LRUCache(getattr(settings, 'DRINKAI_RECOMMENDATION_CACHE_SIZE', 1024),
+                        getattr(settings, 'DRINKAI_RECOMMENDATION_CACHE_TTL', 300))
+
+_jobs = queue.Queue()
+_pending = set()
+_lock = threading.Lock()
+_worker = None
+
+
+def take(queue_key, context, count):
+    """Pop up to count distinct ready drinks for queue_key, if they were made for the same context."""
+    # Only called once a request has imported drinkAI, importing it here costs nothing
+    from .drinkAI import drink_key
+
+    entry = ready_drinks.get(queue_key)
+    if entry is None or entry[0] != context:
+        return []
+    drinks = entry[1]
+    taken = []
+    seen = set()
+    while len(taken) < count:
+        try:
+            drink = drinks.popleft()
+        except IndexError:
+            break
+        # A repeat of a drink already handed out in this response is dropped
+        if drink_key(drink) not in seen:
+            seen.add(drink_key(drink))
+            taken.append(drink)
+    return taken
+
+
+def refill(queue_key, context, make_drinks):
+    """
+    Top queue_key back up to queue_size drinks in the background, unless it is full or a refill is already pending.
+    make_drinks(number) is called on the worker thread, so it must only use what the request already loaded
+    (preferences, stock snapshot) and never the database.
+    """
+    if queue_size <= 0:
+        return
+    entry = ready_drinks.get(queue_key)
+    if entry is not None and entry[0] == context and len(entry[1]) >= queue_size:
+        return
+
+    global _worker
+    with _lock:
+        if queue_key in _pending:
+            return
+        _pending.add(queue_key)
+        if _worker is None:
+            _worker = threading.Thread(target=work, daemon=True)
+            _worker.start()
+    _jobs.put((queue_key, context, make_drinks))
+
+
+def work():
+    from .drinkAI import drink_key
+
+    while True:
+        queue_key, context, make_drinks = _jobs.get()
+        try:
+            entry = ready_drinks.get(queue_key)
+            if entry is None or entry[0] != context:
+                entry = (context, deque())
+            missing = queue_size - len(entry[1])
+            if missing > 0:
+                # Each refill makes distinct drinks, but they can repeat drinks still waiting from an earlier one
+                queued = {drink_key(drink) for drink in entry[1]}
+                for drink in make_drinks(missing):
+                    if drink_key(drink) not in queued:
+                        queued.add(drink_key(drink))
+                        entry[1].append(drink)
+            ready_drinks.set(queue_key, entry)
+        except Exception as e:
+            # The request path falls back to generating synchronously
+            print(f"Could not pre-generate drinks: {e}")
+        finally:
+            with _lock:
+                _pending.discard(queue_key)
+            _jobs.task_done()
+
+
+def discard(queue_key):
+    """Drop the ready drinks of queue_key, e.g. after the user's preferences changed."""
+    ready_drinks.delete(queue_key)
+
+
+def wait_for_refills():
+    """Block until every queued refill has finished (for tests and benchmarks)."""
+    _jobs.join()
@@ -0,0 +1,94 @@
+import hashlib
+import random
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.shortcuts import get_object_or_404
+from . import pregen, timing
+from .cache import LRUCache
+from .models import Preference
+
+# How many drinks are generated up front for a preference set, requests then sample from them
+candidate_pool_size = getattr(settings, 'DRINKAI_CANDIDATE_POOL_SIZE', 20)
+cache_size = getattr(settings, 'DRINKAI_RECOMMENDATION_CACHE_SIZE', 1024)
+cache_ttl = getattr(settings, 'DRINKAI_RECOMMENDATION_CACHE_TTL', 300)
+preference_ttl = getattr(settings, 'DRINKAI_PREFERENCE_CACHE_TTL', 5)
+
+# user id -> that user's preference list, dropped by the Preference signals whenever it changes in this process
+# Kept only briefly, so a change saved by another worker process is picked up within preference_ttl
+user_preferences = LRUCache(cache_size, preference_ttl)
+
+# (preference set hash, catalog version, out of stock items, collaborative key) -> generated candidate drinks
+# Users with the same preferences share a pool, and a catalog reload or stock change starts a new one
+# Users with collaborative filtering embeddings get their own pool, until the embeddings are rebuilt
+candidate_pools = LRUCache(cache_size, cache_ttl)
+
+
+def preference_key(preferences):
+    """Return a hash of a preference list that ignores order and capitalization."""
+    joined = "\n".join(sorted(pref.lower() for pref in preferences))
+    return hashlib.sha1(joined.encode()).hexdigest()
+
+
+def get_user_preferences(user_id, default_preferences):
+    """Return the user's preferences (or the defaults if they have none), querying Preference only on a cache miss."""
+    preferences = user_preferences.get(user_id)
+    if preferences is None:
+        user = get_object_or_404(User, pk=user_id)
+        preferences = list(Preference.objects.filter(UserID=user).values_list('Preference', flat=True))
+        if len(preferences) == 0:
+            preferences = list(default_preferences)
+        user_preferences.set(user_id, preferences)
+    return preferences
+
+
+def invalidate_user(user_id):
+    """Forget the cached preferences (and drinks made from them) of a user after one was created, updated or deleted."""
+    user_preferences.delete(user_id)
+    pregen.discard(int(user_id))
+
+
+def recommend(preferences, count, stock, seed=None, user_id=None):
+    """
+    Return up to count distinct drinks for the preferences. Drinks pre-generated in the background for this user
+    (or for general users) are used first, the rest are sampled from a cached candidate pool.
+    With a user_id, the rankings are blended with what users who order like them order (see collaborative.py).
+    With a seed the drinks are generated directly from a random.Random(seed), so the same seed, preferences,
+    catalog and stock always give the same drinks (for tests and benchmarks).
+    """
+    # drinkAI pulls in pandas, numpy and scikit-learn, so it is only imported once a drink is actually needed
+    # Workers and management commands that never generate a drink don't pay for it
+    from .collaborative import user_embeddings
+    from .drinkAI import drink_key, generate_sodas, get_flavor_index
+
+    index = get_flavor_index()
+    embeddings = user_embeddings(user_id) if user_id is not None else None
+
+    if seed is not None:
+        boost = embeddings.scores(user_id, index) if embeddings is not None else None
+        return generate_sodas(preferences, count, stock, random.Random(seed), boost)
+
+    cf_key = (int(user_id), embeddings.version) if embeddings is not None else None
+    key = (preference_key(preferences), index.version, stock.key, cf_key)
+
+    def make_drinks(number):
+        # Scores are only computed when drinks are actually generated, requests in between just sample
+        boost = embeddings.scores(user_id, index) if embeddings is not None else None
+        return generate_sodas(preferences, number, stock, boost=boost)
+
+    # Take what the background worker made since the last request, and have it top the queue back up
+    queue_key = int(user_id) if user_id is not None else 'general'
+    drinks = pregen.take(queue_key, key, count)
+    pregen.refill(queue_key, key, make_drinks)
+    if len(drinks) == count:
+        return drinks
+
+    # Not enough ready yet (first request, or the preferences / catalog / stock changed)
+    pool = candidate_pools.get(key)
+    if pool is None:
+        with timing.stage('candidate_pool'):
+            pool = make_drinks(max(candidate_pool_size, count))
+        candidate_pools.set(key, pool)
+    # The same drink can be both ready and in the pool, with its ingredients listed in another order
+    taken = {drink_key(drink) for drink in drinks}
+    pool = [drink for drink in pool if drink_key(drink) not in taken]
+    return drinks + random.sample(pool, min(count - len(drinks), len(pool)))
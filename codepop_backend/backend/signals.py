@@ -0,0 +1,72 @@
+from django.db.models.signals import m2m_changed, post_save, post_delete, pre_save
+from django.dispatch import receiver
+from .models import Inventory, Order, Preference
+from .popularity import record_drinks
+from .recommendations import invalidate_user
+from .stock import invalidate_stock
+
+# Keep the drink AI's cached stock in step with the Inventory table
+@receiver(post_save, sender=Inventory)
+@receiver(post_delete, sender=Inventory)
+def inventory_changed(sender, **kwargs):
+    invalidate_stock()
+
+
+# Keep the drink AI's cached preferences in step with the Preference table, however a preference is changed
+@receiver(post_save, sender=Preference)
+@receiver(post_delete, sender=Preference)
+def preference_changed(sender, instance, **kwargs):
+    invalidate_user(instance.UserID_id)
+    # A preference moved to another user changes the preferences of the user it came from too
+    loaded_user_id = getattr(instance, '_loaded_values', {}).get('UserID_id')
+    if loaded_user_id is not None and loaded_user_id != instance.UserID_id:
+        invalidate_user(loaded_user_id)
+
+
+# Keep the Popularity rollup in step with orders
+# pk_set only holds drinks that were not already in the order, so adding a drink twice counts once
+@receiver(m2m_changed, sender=Order.Drinks.through)
+def order_drinks_added(sender, instance, action, reverse, pk_set, **kwargs):
+    if action != 'post_add' or not pk_set:
+        return
+    if reverse:
+        # drink.order_set.add(...), instance is the drink
+        orders = Order.objects.filter(pk__in=pk_set)
+        for order in orders:
+            record_order_drinks(order, [instance])
+    else:
+        record_order_drinks(instance, instance.Drinks.filter(pk__in=pk_set))
+
+
+def record_order_drinks(order, drinks):
+    drinks = list(drinks)
+    record_drinks(drinks, 'Ordered')
+    # Drinks added to an order that is already completed count as completed too
+    if order.OrderStatus == 'completed':
+        record_drinks(drinks, 'Completed')
+
+
+def saves_status(update_fields):
+    # Only a save that writes OrderStatus can complete an order
+    return update_fields is None or 'OrderStatus' in update_fields
+
+
+# Orders read from the database (see Order.from_db) or saved before already know their stored status
+# Only an order made up in code with an existing pk needs a query to find it
+@receiver(pre_save, sender=Order)
+def remember_order_status(sender, instance, update_fields, **kwargs):
+    if instance.pk is None or 'OrderStatus' in getattr(instance, '_loaded_values', {}) or not saves_status(update_fields):
+        return
+    status = Order.objects.filter(pk=instance.pk).values_list('OrderStatus', flat=True).first()
+    instance._loaded_values = {'OrderStatus': status}
+
+
+@receiver(post_save, sender=Order)
+def order_saved(sender, instance, created, update_fields, **kwargs):
+    if not saves_status(update_fields):
+        return
+    loaded_values = getattr(instance, '_loaded_values', {})
+    if instance.OrderStatus == 'completed' and loaded_values.get('OrderStatus') != 'completed':
+        record_drinks(instance.Drinks.all(), 'Completed')
+    # What was just written is the stored status the next save of this instance starts from
+    instance._loaded_values = {**loaded_values, 'OrderStatus': instance.OrderStatus}
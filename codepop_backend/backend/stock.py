@@ -0,0 +1,66 @@
+import threading
+import time
+from django.conf import settings
+from .models import Inventory
+
+# Inventory item types the drink AI can recommend, and the catalog each one belongs to
+CATALOG_ITEM_TYPES = {
+    'Syrup': 'syrups',
+    'Soda': 'sodas',
+    'Add In': 'addins',
+}
+
+# Upper bound (in seconds) on how stale the cached stock can get, for changes made by other worker processes
+stock_ttl = getattr(settings, 'DRINKAI_STOCK_TTL', 30)
+
+
+class StockSnapshot:
+    """
+    Names of the syrups, sodas and add-ins that Inventory says are out of stock, from one read of the table.
+    Items that are not tracked in Inventory at all are treated as available.
+    """
+
+    def __init__(self, generation, out_of_stock):
+        self.generation = generation
+        self.out_of_stock = out_of_stock
+        # Equal for any two snapshots with the same items out of stock, usable as a cache key
+        self.key = tuple(frozenset(out_of_stock[catalog]) for catalog in sorted(out_of_stock))
+
+    def is_available(self, catalog, name):
+        return name not in self.out_of_stock[catalog]
+
+
+_snapshot = None
+_generation = 0
+_loaded_at = 0.0
+_dirty = True
+_lock = threading.Lock()
+
+# Return the cached stock snapshot, reading Inventory again only after it changed or the ttl ran out
+def get_stock():
+    snapshot = _snapshot
+    if snapshot is None or _dirty or time.monotonic() - _loaded_at > stock_ttl:
+        snapshot = load_stock()
+    return snapshot
+
+
+def load_stock():
+    global _snapshot, _generation, _loaded_at, _dirty
+    with _lock:
+        # Cleared before the query so a change saved while reading marks the new snapshot stale again
+        _dirty = False
+        out_of_stock = {catalog: set() for catalog in CATALOG_ITEM_TYPES.values()}
+        items = Inventory.objects.filter(ItemType__in=CATALOG_ITEM_TYPES.keys(), Quantity__lte=0)
+        for item_name, item_type in items.values_list('ItemName', 'ItemType'):
+            out_of_stock[CATALOG_ITEM_TYPES[item_type]].add(item_name.lower())
+
+        _generation += 1
+        _snapshot = StockSnapshot(_generation, out_of_stock)
+        _loaded_at = time.monotonic()
+        return _snapshot
+
+
+# Called whenever an Inventory row is saved or deleted in this process
+def invalidate_stock():
+    global _dirty
+    _dirty = True
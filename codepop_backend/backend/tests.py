@@ -5,12 +5,35 @@ from rest_framework.test import APIClient, APITestCase
 from rest_framework import status
 from rest_framework.authtoken.models import Token  # Import for token authentication
 from unittest.mock import patch
-from .models import Preference, Drink, Inventory, Notification, Order, Revenue
+from .models import Preference, Drink, Inventory, Notification, Order, Revenue, Popularity
 from django.utils import timezone
 from datetime import timedelta
-from .drinkAI import generate_soda
+from .drinkAI import generate_soda, generate_sodas, generate_similar_syrup_preferences, get_flavor_index
+from . import drinkAI
+from .stock import get_stock, invalidate_stock
+from .recommendations import user_preferences, candidate_pools, get_user_preferences, preference_key
+from .collaborative import build_interactions, cf_weight, user_embeddings
+from .popularity import popular_preferences, popular_preferences_cache
+from . import pregen
+from . import timing
+from . import chatmodel
+from .constraints import CompatibilityRules, to_bits, to_ids
+from .intents import IntentMatcher, IntentMatch, complaint_matcher, DRINK_MADE_WRONG_PHRASES, REFUND_PHRASES
+from .intents import IntentClassifier, char_ngrams, load_phrases, save_classifier, train_classifier
+from .customerAI import SMALL_TALK_REPLIES
+from django.core.management import call_command
+from django.core.management.base import CommandError
 import csv
+import numpy as n
+from concurrent.futures import ThreadPoolExecutor
+import io
+import json
 import os
+import random
+import shutil
+import tempfile
+import threading
+from collections import deque
 from django.conf import settings
 
 class PreferenceTests(TestCase):
@@ -1208,3 +1231,845 @@ class AITests(TestCase):
     def testPrefListSize(self):
         result6 = self.authGetPrefAndSendToAI(self.token6, self.user6)
         self.checkOutput(result6)
+
+
+class FlavorIndexTests(TestCase):
+    # The catalog should only be loaded once and then reused by every call
+    def testIndexIsShared(self):
+        self.assertIs(get_flavor_index(), get_flavor_index())
+
+    # id -> name and name -> id lookups must agree with each other and with the csv rows
+    def testCatalogLookups(self):
+        index = get_flavor_index()
+        self.assertEqual(len(index.syrup_names), 48)
+        self.assertEqual(len(index.soda_names), 19)
+        self.assertEqual(len(index.addin_names), 12)
+        for name, i in index.syrup_ids.items():
+            self.assertEqual(index.syrup_names[i], name)
+        self.assertEqual(index.syrup_names[0], "coconut")
+        self.assertEqual(index.syrup_types[index.syrup_ids["mango"]], ["fruit", "tropical", "cool"])
+        self.assertEqual(index.soda_types[index.soda_ids["coke"]], ["cola"])
+
+    # A syrup is always among the syrups most similar to itself
+    # Mango ties with the four other tropical syrups that share its flavor words, ties come out in random order
+    def testSimilarSyrups(self):
+        top5 = generate_similar_syrup_preferences("mango")
+        self.assertEqual(sorted(top5), ["banana", "guava", "mango", "passion fruit", "pineapple"])
+
+    # Partial selection returns the same best items as a full sort, and breaks ties randomly
+    def testTopK(self):
+        scores = n.array([[0.1, 0.9, 0.5, 0.9, 0.3, 0.9]])
+        self.assertIn(sorted(drinkAI.top_k(scores, 2)[0].tolist()), [[1, 3], [1, 5], [3, 5]])
+        self.assertEqual(drinkAI.top_k(scores, 4)[0][3], 2)
+        self.assertEqual(drinkAI.top_k(scores, None, n.array([True, False, True, False, True, False]))[0].tolist(), [2, 4, 0])
+        self.assertEqual(drinkAI.top_k(scores, 1, candidates=[0, 4])[0].tolist(), [4])
+        # Every tied item gets picked first sometimes
+        firsts = {drinkAI.top_k(scores, 1, shuffler=n.random.default_rng(seed))[0][0] for seed in range(50)}
+        self.assertEqual(firsts, {1, 3, 5})
+
+    # Generating drinks from many threads at once must not touch the shipped csv files
+    def testConcurrentGenerationIsReadOnly(self):
+        paths = [os.path.join(settings.BASE_DIR, 'backend', name) for name in ("Syrups.csv", "Sodas.csv", "AddIns.csv")]
+        before = [open(path, 'rb').read() for path in paths]
+
+        prefs = ["mango", "vanilla", "coke", "sprite", "cream", "lime wedge"]
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            results = list(pool.map(lambda _: generate_soda(prefs), range(32)))
+
+        for result in results:
+            self.assertTrue(result["soda"][0] in ["coke", "sprite"])
+        self.assertEqual(before, [open(path, 'rb').read() for path in paths])
+
+
+class GenerateAIDrinkTests(TestCase):
+    def setUp(self):
+        user_preferences.clear()
+        candidate_pools.clear()
+        self.user = User.objects.create_user(username='user1', password='password123')
+        for pref in ["mango", "vanilla", "peach", "coke", "sprite"]:
+            Preference.objects.create(UserID=self.user, Preference=pref)
+        self.client = APIClient()
+
+    # Without a count the endpoint still returns a single drink
+    def testSingleDrink(self):
+        response = self.client.get(f'/backend/generate/{self.user.id}/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn("SyrupsUsed", response.data)
+
+    # With a count the endpoint returns that many distinct drinks
+    def testBatchOfDrinks(self):
+        response = self.client.get(f'/backend/generate/{self.user.id}/?count=5')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 5)
+        keys = {(tuple(sorted(d["SyrupsUsed"])), d["SodaUsed"], tuple(sorted(d["AddIns"]))) for d in response.data}
+        self.assertEqual(len(keys), 5)
+        for drink in response.data:
+            self.assertTrue(drink["SodaUsed"] in ["coke", "sprite"])
+            self.assertTrue(drink["UserCreated"])
+
+        response = self.client.get('/backend/generate/?count=3')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 3)
+
+    def testInvalidCount(self):
+        response = self.client.get('/backend/generate/?count=abc')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get('/backend/generate/?count=0')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get('/backend/generate/?count=500')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    # Editing a csv file swaps in a rebuilt index in the background, the old one keeps serving until then
+    def testCatalogReload(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = {}
+            for name in ("Syrups.csv", "Sodas.csv", "AddIns.csv"):
+                paths[name] = os.path.join(tmp, name)
+                shutil.copy(os.path.join(settings.BASE_DIR, 'backend', name), paths[name])
+
+            with patch('backend.drinkAI.syrup_file_path', paths["Syrups.csv"]), \
+                 patch('backend.drinkAI.soda_file_path', paths["Sodas.csv"]), \
+                 patch('backend.drinkAI.addin_file_path', paths["AddIns.csv"]), \
+                 patch('backend.drinkAI.catalog_check_interval', 0), \
+                 patch('backend.drinkAI._flavor_index', None):
+                old_index = get_flavor_index()
+                self.assertNotIn("root beer float", old_index.syrup_ids)
+
+                # Syrups.csv has no trailing newline
+                with open(paths["Syrups.csv"], 'a', newline='') as file:
+                    file.write("\n48,root beer float,dessert cream")
+
+                # The edit is noticed, but this call is still answered from the old snapshot
+                self.assertIs(get_flavor_index(), old_index)
+                drinkAI._reload_thread.join()
+
+                new_index = get_flavor_index()
+                self.assertIsNot(new_index, old_index)
+                self.assertIn("root beer float", new_index.syrup_ids)
+                self.assertNotIn("root beer float", old_index.syrup_ids)
+
+
+class StockAwareGenerationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='user1', password='password123')
+        for pref in ["mango", "coke", "sprite", "cream", "lime wedge"]:
+            Preference.objects.create(UserID=self.user, Preference=pref)
+        self.coke = Inventory.objects.create(ItemName="Coke", ItemType="Soda", Quantity=0, ThresholdLevel=2)
+        Inventory.objects.create(ItemName="Cream", ItemType="Add In", Quantity=0, ThresholdLevel=2)
+        Inventory.objects.create(ItemName="Sprite", ItemType="Soda", Quantity=10, ThresholdLevel=2)
+        self.client = APIClient()
+
+    def tearDown(self):
+        # Rolled back rows don't send signals, so don't leave this test's stock cached for the next one
+        invalidate_stock()
+
+    # Out of stock items are never recommended
+    def testOutOfStockItemsAreSkipped(self):
+        response = self.client.get(f'/backend/generate/{self.user.id}/?count=10')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        for drink in response.data:
+            self.assertEqual(drink["SodaUsed"], "sprite")
+            self.assertNotIn("cream", drink["AddIns"])
+
+    # Restocking an item is picked up without waiting for the cache to expire
+    def testRestockRefreshesCache(self):
+        self.assertFalse(get_stock().is_available('sodas', 'coke'))
+        self.coke.Quantity = 5
+        self.coke.save()
+        self.assertTrue(get_stock().is_available('sodas', 'coke'))
+
+    # Items that aren't tracked in Inventory are treated as available
+    def testUntrackedItemsAreAvailable(self):
+        stock = get_stock()
+        self.assertTrue(stock.is_available('syrups', 'mango'))
+        self.assertTrue(stock.is_available('addins', 'lime wedge'))
+
+
+class RecommendationCacheTests(TestCase):
+    def setUp(self):
+        user_preferences.clear()
+        candidate_pools.clear()
+        self.user = User.objects.create_user(username='user1', password='password123')
+        self.token = Token.objects.create(user=self.user)
+        Preference.objects.create(UserID=self.user, Preference="mango")
+        Preference.objects.create(UserID=self.user, Preference="coke")
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token.key)
+
+    # The same preferences in any order or case share a candidate pool
+    def testPreferenceKey(self):
+        self.assertEqual(preference_key(["Mango", "coke"]), preference_key(["coke", "mango"]))
+        self.assertNotEqual(preference_key(["mango", "coke"]), preference_key(["mango", "sprite"]))
+
+    # Repeat requests are answered from the cache, and changing a preference drops the user's entry
+    def testPreferenceChangesInvalidateCache(self):
+        response = self.client.get(f'/backend/generate/{self.user.id}/')
+        self.assertEqual(response.data["SodaUsed"], "coke")
+        self.assertEqual(sorted(user_preferences.get(self.user.id)), ["coke", "mango"])
+
+        response = self.client.post('/backend/preferences/', {'UserID': self.user.id, 'Preference': 'sprite'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertIsNone(user_preferences.get(self.user.id))
+
+        response = self.client.get(f'/backend/generate/{self.user.id}/?count=5')
+        self.assertEqual(sorted(user_preferences.get(self.user.id)), ["coke", "mango", "sprite"])
+
+        coke = Preference.objects.get(UserID=self.user, Preference="coke")
+        response = self.client.delete(f'/backend/preferences/{coke.PreferenceID}/')
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertIsNone(user_preferences.get(self.user.id))
+        for i in range(5):
+            response = self.client.get(f'/backend/generate/{self.user.id}/')
+            self.assertEqual(response.data["SodaUsed"], "sprite")
+
+    # Preferences changed outside the API (admin, shell, other code) drop the cache too, for both users of a moved preference
+    def testModelChangesInvalidateCache(self):
+        other = User.objects.create_user(username='user2', password='password123')
+        get_user_preferences(self.user.id, [])
+        get_user_preferences(other.id, [])
+        coke = Preference.objects.get(UserID=self.user, Preference="coke")
+        coke.UserID = other
+        coke.save()
+        self.assertIsNone(user_preferences.get(self.user.id))
+        self.assertIsNone(user_preferences.get(other.id))
+
+        self.assertEqual(get_user_preferences(other.id, []), ["coke"])
+        Preference.objects.filter(UserID=other).delete()
+        self.assertIsNone(user_preferences.get(other.id))
+
+
+class SeededGenerationTests(TestCase):
+    def setUp(self):
+        self.prefs = ["mango", "vanilla", "peach", "coke", "sprite", "cream", "lime wedge"]
+
+    # The same seed always gives the same drinks
+    def testSameSeedSameDrinks(self):
+        first = [generate_soda(self.prefs, rng=random.Random(seed)) for seed in range(20)]
+        second = [generate_soda(self.prefs, rng=random.Random(seed)) for seed in range(20)]
+        self.assertEqual(first, second)
+        # ...and different seeds don't all collapse to one drink
+        self.assertTrue(len({str(drink) for drink in first}) > 1)
+
+    def testSeededBatch(self):
+        self.assertEqual(generate_sodas(self.prefs, 5, rng=random.Random(7)), generate_sodas(self.prefs, 5, rng=random.Random(7)))
+
+    def testSeedQueryParameter(self):
+        client = APIClient()
+        first = client.get('/backend/generate/?count=3&seed=42')
+        second = client.get('/backend/generate/?count=3&seed=42')
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+        self.assertEqual(first.data, second.data)
+
+        response = client.get('/backend/generate/?seed=abc')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class CollaborativeFilteringTests(TestCase):
+    def setUp(self):
+        candidate_pools.clear()
+        self.user1 = User.objects.create_user(username='user1', password='password123')
+        self.user2 = User.objects.create_user(username='user2', password='password123')
+        self.user3 = User.objects.create_user(username='user3', password='password123')
+        coconut = Drink.objects.create(Name="Coconut Coke", SodaUsed=["Coke"], SyrupsUsed=["Coconut"], AddIns=["Cream"], User_Created=False, Price=1.99, Rating=5)
+        mango = Drink.objects.create(Name="Mango Sprite", SodaUsed=["Sprite"], SyrupsUsed=["Mango", "Peach"], User_Created=False, Price=2.50)
+        vanilla = Drink.objects.create(Name="Vanilla Coke", SodaUsed=["Coke"], SyrupsUsed=["Vanilla"], User_Created=False, Price=2.50)
+        for user, drinks in ((self.user1, [coconut, vanilla]), (self.user2, [mango]), (self.user3, [coconut, mango])):
+            order = Order.objects.create(UserID=user, StripeID="dummy_stripe_id")
+            order.Drinks.add(*drinks)
+        mango.Favorite.add(self.user1)
+
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        path_patch = patch('backend.collaborative.embeddings_path', os.path.join(self.tmp, 'cf_embeddings.npz'))
+        path_patch.start()
+        self.addCleanup(path_patch.stop)
+
+    # Orders and favorites end up as weighted user x ingredient counts
+    def testBuildInteractions(self):
+        user_ids, items, matrix = build_interactions()
+        self.assertEqual(user_ids, [self.user1.id, self.user2.id, self.user3.id])
+        self.assertIn("syrups:coconut", items)
+        self.assertIn("addins:cream", items)
+        # user2 never ordered or favorited anything with vanilla in it
+        self.assertEqual(matrix[user_ids.index(self.user2.id), items.index("syrups:vanilla")], 0)
+        # user1 ordered and favorited mango, which counts for more than ordering it once
+        self.assertGreater(matrix[user_ids.index(self.user1.id), items.index("syrups:mango")],
+                           matrix[user_ids.index(self.user2.id), items.index("syrups:mango")])
+
+    def testUserScores(self):
+        index = get_flavor_index()
+        self.assertIsNone(user_embeddings(self.user1.id))
+
+        call_command('build_cf_embeddings', stdout=io.StringIO())
+        boost = user_embeddings(self.user1.id).scores(self.user1.id, index)
+        self.assertEqual(len(boost['syrups']), len(index.syrup_names))
+        self.assertAlmostEqual(max(abs(boost['syrups'])), cf_weight, places=5)
+        self.assertGreater(boost['syrups'][index.syrup_ids["coconut"]], 0)
+        # Ingredients nobody ordered get no boost
+        self.assertEqual(boost['syrups'][index.syrup_ids["lavender"]], 0)
+        # Users without any history are left to the flavor ranking alone
+        new_user = User.objects.create_user(username='user4', password='password123')
+        self.assertIsNone(user_embeddings(new_user.id))
+
+        response = APIClient().get(f'/backend/generate/{self.user1.id}/?count=3')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 3)
+
+
+class PopularityTests(TestCase):
+    def setUp(self):
+        popular_preferences_cache.clear()
+        candidate_pools.clear()
+        self.user = User.objects.create_user(username='user1', password='password123')
+        self.drink1 = Drink.objects.create(Name="Vanilla Coke", SodaUsed=["Coke"], SyrupsUsed=["Vanilla", "Coconut"], AddIns=["Cream"], User_Created=False, Price=1.99)
+        self.drink2 = Drink.objects.create(Name="Mango Sprite", SodaUsed=["Sprite"], SyrupsUsed=["Mango"], User_Created=False, Price=2.50)
+        self.client = APIClient()
+
+    def createOrder(self, drinks):
+        data = {"UserID": self.user.id, "Drinks": [drink.DrinkID for drink in drinks], "StripeID": "dummy_stripe_id"}
+        response = self.client.post('/backend/orders/', data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return response.data["OrderID"]
+
+    def counts(self, item_type, item_name):
+        row = Popularity.objects.get(ItemType=item_type, ItemName=item_name, Day=timezone.localdate())
+        return row.Ordered, row.Completed
+
+    # Creating and completing orders updates the rollup, without counting the same order twice
+    def testOrdersUpdateCounts(self):
+        order_id = self.createOrder([self.drink1, self.drink2])
+        self.createOrder([self.drink1])
+        self.assertEqual(self.counts('Drink', str(self.drink1.DrinkID)), (2, 0))
+        self.assertEqual(self.counts('Syrup', 'vanilla'), (2, 0))
+        self.assertEqual(self.counts('Soda', 'sprite'), (1, 0))
+        self.assertEqual(self.counts('Add In', 'cream'), (2, 0))
+
+        for i in range(2):
+            response = self.client.patch(f'/backend/orders/{order_id}/', {"OrderStatus": "completed"}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.counts('Drink', str(self.drink1.DrinkID)), (2, 1))
+        self.assertEqual(self.counts('Syrup', 'mango'), (1, 1))
+
+    # Saving an order doesn't read its status back, a save that leaves the status alone doesn't look at it at all
+    def testStatusTrackingQueries(self):
+        order = Order.objects.get(OrderID=self.createOrder([self.drink1]))
+        with self.assertNumQueries(1):
+            order.PickupTime = timezone.now()
+            order.save(update_fields=['PickupTime'])
+        order.OrderStatus = 'completed'
+        order.save()
+        order.save()
+        self.assertEqual(self.counts('Drink', str(self.drink1.DrinkID)), (1, 1))
+
+        # An order built in code only has its stored status looked up
+        Order(OrderID=order.OrderID, OrderStatus='completed', CreationTime=order.CreationTime, StripeID="dummy_stripe_id").save()
+        self.assertEqual(self.counts('Drink', str(self.drink1.DrinkID)), (1, 1))
+
+    def testPopularEndpoint(self):
+        self.createOrder([self.drink1, self.drink2])
+        self.createOrder([self.drink2])
+
+        response = self.client.get('/backend/popular/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([row["Drink"]["Name"] for row in response.data], ["Mango Sprite", "Vanilla Coke"])
+        self.assertEqual(response.data[0]["Ordered"], 2)
+
+        response = self.client.get('/backend/popular/?type=syrups&limit=1')
+        self.assertEqual(response.data, [{"ItemName": "mango", "Ordered": 2, "Completed": 0}])
+
+        self.assertEqual(self.client.get('/backend/popular/?type=cups').status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get('/backend/popular/?limit=0').status_code, status.HTTP_400_BAD_REQUEST)
+
+    # General users get drinks built from the popular ingredients once there are orders
+    def testGeneralUserUsesPopularIngredients(self):
+        self.assertEqual(popular_preferences(), [])
+        response = self.client.get('/backend/generate/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        popular_preferences_cache.clear()
+        self.createOrder([self.drink2])
+        self.assertEqual(popular_preferences(), ["mango", "sprite"])
+        response = self.client.get('/backend/generate/?count=3')
+        for drink in response.data:
+            self.assertEqual(drink["SodaUsed"], "sprite")
+
+
+class PrecomputedMatrixTests(TestCase):
+    # Matrices from build_drinkai_matrices are memory-mapped and give the same matches as computing them
+    def testPrecomputedMatrices(self):
+        with tempfile.TemporaryDirectory() as tmp, patch('backend.drinkAI.matrix_dir', tmp):
+            self.assertIsNone(drinkAI.FlavorIndex().syrup_similarity)
+
+            call_command('build_drinkai_matrices', stdout=io.StringIO())
+            mapped = drinkAI.FlavorIndex()
+            computed = drinkAI.FlavorIndex(precomputed=False)
+            self.assertIsInstance(mapped.syrup_vectors, n.memmap)
+            self.assertEqual(os.listdir(tmp), [mapped.digest])
+            for name in ["mango", "vanilla", "peppermint"]:
+                self.assertEqual(mapped.similar_syrups([name], shuffler=n.random.default_rng(0)),
+                                 computed.similar_syrups([name], shuffler=n.random.default_rng(0)))
+            self.assertEqual(mapped.rank_sodas(["fruit tropical"], k=3, shuffler=n.random.default_rng(0)).tolist(),
+                             computed.rank_sodas(["fruit tropical"], k=3, shuffler=n.random.default_rng(0)).tolist())
+
+
+class PregenerationTests(TestCase):
+    def setUp(self):
+        pregen.ready_drinks.clear()
+        candidate_pools.clear()
+        user_preferences.clear()
+        self.user = User.objects.create_user(username='user1', password='password123')
+        self.token = Token.objects.create(user=self.user)
+        Preference.objects.create(UserID=self.user, Preference="mango")
+        Preference.objects.create(UserID=self.user, Preference="vanilla")
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token.key)
+
+    # Drinks are only handed out for the context they were made for, and only once each
+    def testTakeAndRefill(self):
+        def makeDrinks(number):
+            # Every other drink is the one before it with its syrups listed the other way round
+            drinks = [{"syrups": [f"syrup {i // 2}", "vanilla"], "soda": ["coke"], "addins": []} for i in range(number)]
+            for drink in drinks[1::2]:
+                drink["syrups"].reverse()
+            return drinks
+
+        pregen.refill('test', 'context', makeDrinks)
+        pregen.wait_for_refills()
+        self.assertEqual([drink["syrups"] for drink in pregen.take('test', 'context', 2)],
+                         [["syrup 0", "vanilla"], ["syrup 1", "vanilla"]])
+        self.assertEqual(pregen.take('test', 'other context', 1), [])
+        self.assertEqual(pregen.take('missing', 'context', 1), [])
+
+    # A drink listed with its ingredients in another order is still the same drink, wherever the repeat comes from
+    def testCountResponseIsDistinct(self):
+        self.client.get(f'/backend/generate/{self.user.id}/?count=1')
+        pregen.wait_for_refills()
+        context, ready = pregen.ready_drinks.get(self.user.id)
+        reorder = lambda drink: {**drink, "syrups": drink["syrups"][::-1], "addins": drink["addins"][::-1]}
+
+        # A refill that makes the drinks still queued doesn't queue them twice
+        pregen.take(self.user.id, context, 2)
+        pregen.refill(self.user.id, context, lambda number: [reorder(drink) for drink in list(ready)[:number]])
+        pregen.wait_for_refills()
+        self.assertEqual(len(pregen.ready_drinks.get(self.user.id)[1]), pregen.queue_size - 2)
+
+        # Nor does a response take the same drink twice, from the queue or from the sampled pool
+        pool = candidate_pools.get(context)[:2]
+        candidate_pools.set(context, pool)
+        pregen.ready_drinks.set(self.user.id, (context, deque([pool[0], reorder(pool[0])])))
+        response = self.client.get(f'/backend/generate/{self.user.id}/?count=3')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([drink["SyrupsUsed"] for drink in response.data], [pool[0]["syrups"], pool[1]["syrups"]])
+
+
+class ConstraintTests(TestCase):
+    # Two syrups, three sodas and three add-ins small enough to check every bit by hand
+    def makeRules(self, exclusions=()):
+        return CompatibilityRules(
+            syrup_types=[{"fruit", "citrus"}, {"dessert"}],
+            soda_types=[{"citrus"}, {"cola"}, {"energy"}],
+            soda_flavors=[{"fruit", "candy"}, {"fruit", "dessert"}, {"fruit"}],
+            addin_syrup_flavors=[{"fruit", "dessert"}, {"fruit"}, {"dessert"}],
+            addin_soda_flavors=[{"cola"}, {"citrus"}, {"cola"}],
+            exclusions=exclusions,
+        )
+
+    def testCompiledBitsets(self):
+        rules = self.makeRules()
+        self.assertEqual(rules.syrup_sodas, [0b111, 0b010])
+        self.assertEqual(rules.syrup_addins, [0b011, 0b101])
+        self.assertEqual(rules.soda_addins, [0b010, 0b101, 0b000])
+        # An add-in never goes with itself, so it can't be picked twice
+        self.assertEqual(rules.addin_addins, [0b110, 0b101, 0b011])
+        self.assertEqual(rules.sodas_for([0, 1]), 0b010)
+        self.assertEqual(rules.addins_for([0], 1), 0b001)
+        self.assertEqual(rules.addins_for([0, 1], 2), 0)
+
+    def testExclusions(self):
+        rules = self.makeRules([('syrups', 0, 'sodas', 1), ('addins', 0, 'addins', 2), ('sodas', 1, 'addins', 2)])
+        self.assertEqual(rules.syrup_sodas[0], 0b101)
+        self.assertEqual(rules.addin_addins[0], 0b010)
+        self.assertEqual(rules.addin_addins[2], 0b010)
+        self.assertEqual(rules.soda_addins[1], 0b001)
+        with self.assertRaises(ValueError):
+            self.makeRules([('syrups', 0, 'syrups', 1)])
+
+    def testBitConversions(self):
+        self.assertEqual(to_bits([0, 3, 9]), 0b1000001001)
+        self.assertEqual(to_ids(0b1000001001, 12).tolist(), [0, 3, 9])
+        self.assertEqual(to_ids(0, 12).tolist(), [])
+
+    # Generated drinks follow the rules compiled from the csv files and Exclusions.csv
+    def testGeneratedDrinksFollowRules(self):
+        index = get_flavor_index()
+        rules = index.rules
+        # Cream only goes with colas, so it is never put in a citrus soda
+        self.assertFalse(rules.soda_addins[index.soda_ids["sprite"]] >> index.addin_ids["cream"] & 1)
+        self.assertFalse(rules.addin_addins[index.addin_ids["cream"]] >> index.addin_ids["coconut cream"] & 1)
+
+        drinks = generate_sodas(["lemon", "vanilla", "mango", "cream", "coconut cream", "lime wedge"], 20, rng=random.Random(0))
+        self.assertTrue(len(drinks) > 0)
+        for drink in drinks:
+            syrupIds = [index.syrup_ids[syrup] for syrup in drink["syrups"]]
+            sodaId = index.soda_ids[drink["soda"][0]]
+            addinIds = [index.addin_ids[addin] for addin in drink["addins"]]
+            self.assertEqual(len(addinIds), len(set(addinIds)))
+            allowed = rules.addins_for(syrupIds, sodaId)
+            for addinId in addinIds:
+                self.assertTrue(allowed >> addinId & 1)
+                for other in addinIds:
+                    self.assertTrue(addinId == other or rules.addin_addins[addinId] >> other & 1)
+
+
+class TimingTests(TestCase):
+    def tearDown(self):
+        timing.reset()
+
+    # Timing is off by default and then costs nothing but a function call
+    def testDisabledByDefault(self):
+        self.assertIs(timing.stage('a'), timing.stage('b'))
+        response = APIClient().get('/backend/generate/?seed=1')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn('Server-Timing', response)
+
+    def testHistogram(self):
+        histogram = timing.Histogram()
+        for ms in [0.2, 0.3, 0.4, 3, 7000]:
+            histogram.add(ms)
+        self.assertEqual(histogram.count, 5)
+        self.assertEqual(histogram.percentile(50), 0.5)
+        self.assertEqual(histogram.percentile(80), 5)
+        self.assertEqual(histogram.percentile(100), float('inf'))
+
+    # Stage timings come back in a header and end up in the histograms read by drinkai_timings
+    def testServerTimingAndHistograms(self):
+        with tempfile.TemporaryDirectory() as tmp, patch('backend.timing.enabled', True), patch('backend.timing.timing_dir', tmp):
+            response = APIClient().get('/backend/generate/?seed=1')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            stages = [part.split(';')[0] for part in response['Server-Timing'].split(', ')]
+            for name in ['generate_total', 'preferences', 'stock', 'recommend', 'soda_ranking', 'addin_picks']:
+                self.assertIn(name, stages)
+
+            # Chatbot timings are kept apart from drink generation's
+            timing.record('chat:first_token', 120)
+            timing.flush()
+            self.assertEqual(timing.load_histograms(tmp)['generate_total'].count, 1)
+            out = io.StringIO()
+            call_command('drinkai_timings', stdout=out)
+            self.assertIn('recommend', out.getvalue())
+            self.assertNotIn('chat:first_token', out.getvalue())
+            out = io.StringIO()
+            call_command('drinkai_timings', namespace='chat', reset=True, stdout=out)
+            self.assertIn('chat:first_token', out.getvalue())
+            self.assertNotIn('recommend', out.getvalue())
+            self.assertEqual(timing.load_histograms(tmp), {})
+
+
+class ChatbotTests(TestCase):
+    def setUp(self):
+        chatmodel.reply_cache.clear()
+
+    def tearDown(self):
+        connection = getattr(chatmodel._connections, 'connection', None)
+        if connection is not None:
+            connection.close()
+            chatmodel._connections.connection = None
+
+    # Refund and remake requests are answered without ever loading the model
+    def testKeywordsDontLoadModel(self):
+        response = APIClient().post('/backend/chatbot/', {"message": "my drink was made wrong"}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["state"], "choose")
+        self.assertIsNone(chatmodel._model)
+
+    # Web workers can hand messages to a single process that hosts the model
+    def testInferenceServer(self):
+        def reply(message):
+            if message == "fail":
+                raise RuntimeError("out of memory")
+            return message.upper()
+
+        def stream(message):
+            return iter(message.split())
+
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        address = os.path.join(tmp, 'chatbot.sock')
+        with patch('backend.chatmodel.authkey', b'test key'), chatmodel.listen(address) as listener:
+            threading.Thread(target=chatmodel.serve, args=(listener, reply, stream), daemon=True).start()
+            # Other users on the machine can't connect to the socket
+            self.assertEqual(os.stat(address).st_mode & 0o777, 0o600)
+            self.assertEqual(chatmodel.remote_reply("hello", address), "HELLO")
+            self.assertEqual(chatmodel.remote_reply("again", address), "AGAIN")
+            with self.assertRaises(chatmodel.ChatbotUnavailable):
+                chatmodel.remote_reply("fail", address)
+
+            self.assertEqual(list(chatmodel.remote_stream("one two three", address)), ["one", "two", "three"])
+            # A stream dropped halfway doesn't leave its rest to be read as the next reply
+            pieces = chatmodel.remote_stream("one two three", address)
+            next(pieces)
+            pieces.close()
+            self.assertEqual(chatmodel.remote_reply("after", address), "AFTER")
+
+    # Neither the server nor the web workers run without a shared secret of their own
+    def testInferenceServerNeedsAuthkey(self):
+        with patch('backend.chatmodel.authkey', b''):
+            with self.assertRaises(chatmodel.ChatbotUnavailable):
+                chatmodel.listen('127.0.0.1:0')
+            with self.assertRaises(chatmodel.ChatbotUnavailable):
+                chatmodel.remote_reply("hello", '127.0.0.1:1')
+            with self.assertRaises(CommandError):
+                call_command('run_chatbot_server', address='127.0.0.1:0', stdout=io.StringIO())
+
+    # Concurrent messages are answered by one batched call, and each sender gets its own reply back
+    def testBatchScheduler(self):
+        batches = []
+
+        def run_batch(messages):
+            batches.append(len(messages))
+            if "fail" in messages:
+                raise RuntimeError("out of memory")
+            return [message.upper() for message in messages]
+
+        scheduler = chatmodel.BatchScheduler(run_batch, 0.2, 16)
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            replies = list(pool.map(lambda i: scheduler.submit(f"message {i}").result(), range(8)))
+        self.assertEqual(replies, [f"MESSAGE {i}" for i in range(8)])
+        self.assertLess(len(batches), 8)
+        with self.assertRaises(RuntimeError):
+            scheduler.submit("fail").result()
+
+    # The streaming endpoint sends each piece of the reply as it comes, then the full reply
+    def testStreamingReply(self):
+        with patch('backend.customerAI.stream_reply', lambda message: iter(["Hel", "lo!"])):
+            response = APIClient().post('/backend/chatbot/stream/', {"message": "hello there"}, format='json')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Content-Type'], "text/event-stream")
+            events = [event.split("\n") for event in b"".join(response.streaming_content).decode().strip().split("\n\n")]
+        self.assertEqual([lines[0] for lines in events], ["event: token", "event: token", "event: done"])
+        self.assertEqual(json.loads(events[1][1][len("data: "):]), {"token": "lo!"})
+        self.assertEqual(json.loads(events[2][1][len("data: "):])["responses"], ["Hello!"])
+
+        # Refund and remake phases answer with plain JSON, like the regular endpoint
+        response = APIClient().post('/backend/chatbot/stream/', {"message": "I want a refund"}, format='json')
+        self.assertEqual(response.json()["state"], "choose")
+
+    # Without a reachable inference server the chatbot says so instead of erroring
+    def testServerUnavailable(self):
+        with patch('backend.chatmodel.inference_address', '127.0.0.1:1'):
+            response = APIClient().post('/backend/chatbot/', {"message": "hello there"}, format='json')
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(len(response.json()["responses"]), 1)
+            response = APIClient().post('/backend/chatbot/stream/', {"message": "hello there"}, format='json')
+            self.assertEqual(response.status_code, 503)
+
+    # Repeated messages reuse a few kept replies instead of calling the model every time
+    def testReplyCache(self):
+        replies = iter(["Hi!", "Hello!", "Hey!", "Howdy!"])
+        with patch('backend.customerAI.generate_reply', lambda message: next(replies)), \
+                patch.object(chatmodel.reply_cache, 'per_key', 3):
+            answers = [APIClient().post('/backend/chatbot/', {"message": message}, format='json').json()["responses"][0]
+                       for message in ["Hi!", "hi", "  HI ", "hi.", "hi?", "Hi"]]
+        self.assertEqual(answers[:3], ["Hi!", "Hello!", "Hey!"])
+        self.assertTrue(set(answers[3:]) <= {"Hi!", "Hello!", "Hey!"})
+        self.assertEqual((chatmodel.reply_cache.hits, chatmodel.reply_cache.misses), (3, 3))
+
+        # A cached reply streams as one token
+        response = APIClient().post('/backend/chatbot/stream/', {"message": "hi"}, format='json')
+        events = b"".join(response.streaming_content).decode().strip().split("\n\n")
+        self.assertEqual([event.split("\n")[0] for event in events], ["event: token", "event: done"])
+
+        self.assertEqual(chatmodel.normalize_message("What's   your hours?!"), "whats your hours")
+        cache = chatmodel.ReplyCache(10, 60, 0)
+        cache.add("hi", "Hi!")
+        self.assertIsNone(cache.get("hi"))
+
+    # Logged in the way the app does it, with the user's token in the Authorization header
+    def loggedInClient(self, username):
+        user = User.objects.create_user(username=username, password='password123')
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION='Token ' + Token.objects.create(user=user).key)
+        return user, client
+
+    # The remake flow is kept on the server, the client only sends its conversation id back
+    def testRemakeFlow(self):
+        user, client = self.loggedInClient('user1')
+        cola = Drink.objects.create(Name="Cola Vanilla", SodaUsed=["Cola"], SyrupsUsed=["Vanilla"], User_Created=False, Price=1.99)
+        lemonade = Drink.objects.create(Name="Lemonade Mint", SodaUsed=["Lemonade"], AddIns=["Mint"], User_Created=False, Price=2.50)
+        order = Order.objects.create(UserID=user, OrderStatus='completed', PaymentStatus='paid')
+        order.Drinks.add(cola, lemonade)
+        conversation = {}
+
+        def chat(message, **extra):
+            data = client.post('/backend/chatbot/', {"message": message, **conversation, **extra}, format='json').json()
+            conversation["conversation_id"] = data["conversation_id"]
+            return data
+
+        self.assertEqual(chat("my drink was made wrong")["state"], "choose")
+        self.assertEqual(chat("I want it remade")["state"], "remake_order")
+        reply = chat(f"it was order {order.OrderID}")
+        self.assertEqual(reply["state"], "remake_drinks")
+        self.assertIn("[2]: Drink Name: Lemonade Mint", reply["responses"])
+        self.assertEqual(chat("number 3")["state"], "remake_drinks")
+        # Phases and order numbers sent by the client are ignored
+        reply = chat("2", order_num=999, wrong_drink_phase="4", drink_nums="1, 2, 3")
+        self.assertEqual(reply["state"], "remake_accept")
+        self.assertNotIn("order_num", reply)
+        reply = chat("I accept")
+        self.assertEqual(reply["state"], "remade")
+        remade = Order.objects.get(OrderID=reply["order_num"])
+        self.assertEqual((remade.UserID, remade.PaymentStatus), (user, 'remade'))
+        self.assertEqual(list(remade.Drinks.all()), [lemonade])
+
+        # Then it's back to chatting, and cancel ends a flow
+        with patch('backend.customerAI.generate_reply', lambda message: "From the model"):
+            reply = chat("what flavors do you have?")
+        self.assertEqual((reply["state"], reply["responses"]), ("chat", ["From the model"]))
+        self.assertEqual(chat("my drink was made wrong")["state"], "choose")
+        self.assertEqual(chat("cancel")["state"], "chat")
+
+        # A conversation id the server didn't hand out starts a new conversation
+        self.assertEqual(chat("my drink was made wrong")["state"], "choose")
+        with patch('backend.customerAI.generate_reply', lambda message: "From the model"):
+            reply = chat("I want it remade", conversation_id="0" * 32)
+        self.assertEqual((reply["state"], reply["responses"]), ("chat", ["From the model"]))
+        self.assertNotEqual(reply["conversation_id"], "0" * 32)
+
+    def testRefundFlow(self):
+        user, client = self.loggedInClient('user1')
+        order = Order.objects.create(UserID=user, OrderStatus='completed', PaymentStatus='paid', StripeID="pi_123")
+        revenue = Revenue.objects.create(OrderID=order.OrderID, TotalAmount=1.99)
+        conversation = {}
+
+        def chat(message):
+            data = client.post('/backend/chatbot/', {"message": message, **conversation}, format='json').json()
+            conversation["conversation_id"] = data["conversation_id"]
+            return data["state"]
+
+        with patch('backend.chatsession.refund_order', return_value=True) as refund:
+            self.assertEqual(chat("I want my money back"), "choose")
+            self.assertEqual(chat("a refund please"), "refund_order")
+            self.assertEqual(chat(str(order.OrderID)), "refund_confirm")
+            self.assertEqual(chat("yes"), "refund_accept")
+            self.assertEqual(chat("I accept"), "chat")
+        refund.assert_called_once_with("pi_123")
+        revenue.refresh_from_db()
+        self.assertTrue(revenue.Refunded)
+
+    # Nobody can look up, refund or remake an order that isn't theirs, or carry on someone else's conversation
+    def testFlowsOnlyFindOwnOrders(self):
+        owner, owner_client = self.loggedInClient('user1')
+        _, other_client = self.loggedInClient('user2')
+        order = Order.objects.create(UserID=owner, OrderStatus='completed', PaymentStatus='paid', StripeID="pi_123")
+        order.Drinks.add(Drink.objects.create(Name="Cola Vanilla", SodaUsed=["Cola"], SyrupsUsed=["Vanilla"], User_Created=False, Price=1.99))
+
+        def chat(client, message, **extra):
+            return client.post('/backend/chatbot/', {"message": message, **extra}, format='json').json()
+
+        with patch('backend.chatsession.refund_order', return_value=True) as refund:
+            for client in (other_client, APIClient()):
+                conversation_id = chat(client, "I want a refund please")["conversation_id"]
+                chat(client, "refund", conversation_id=conversation_id)
+                reply = chat(client, str(order.OrderID), conversation_id=conversation_id)
+                self.assertEqual(reply["state"], "refund_order")
+                self.assertNotIn("Cola Vanilla", reply["responses"])
+
+            # The owner's conversation, halfway through the refund, is a new conversation for anyone else
+            conversation_id = chat(owner_client, "I want a refund please")["conversation_id"]
+            chat(owner_client, "refund", conversation_id=conversation_id)
+            self.assertEqual(chat(owner_client, str(order.OrderID), conversation_id=conversation_id)["state"], "refund_confirm")
+            with patch('backend.customerAI.generate_reply', lambda message: "From the model"):
+                reply = chat(other_client, "yes", conversation_id=conversation_id)
+            self.assertEqual(reply["state"], "chat")
+            self.assertNotEqual(reply["conversation_id"], conversation_id)
+        refund.assert_not_called()
+
+    # The int8 backend swaps GPT-2's Conv1D layers for quantized linear layers that give nearly the same output
+    def testInferenceBackends(self):
+        import torch
+        from transformers import GPT2Config, GPT2LMHeadModel
+        from transformers.pytorch_utils import Conv1D
+
+        torch.manual_seed(0)
+        model = GPT2LMHeadModel(GPT2Config(vocab_size=64, n_positions=32, n_embd=32, n_layer=2, n_head=2))
+        model = chatmodel.prepare_model(model, 'fp32')
+        input_ids = torch.randint(0, 64, (1, 8))
+        with torch.no_grad():
+            expected = model(input_ids).logits
+            chatmodel.conv1d_to_linear(model)
+            self.assertFalse(any(isinstance(module, Conv1D) for module in model.modules()))
+            self.assertTrue(torch.allclose(model(input_ids).logits, expected, atol=1e-5))
+
+            quantized = chatmodel.prepare_model(model, 'int8')
+            self.assertFalse(any(type(module) is torch.nn.Linear for module in quantized.modules()))
+            self.assertLess((quantized(input_ids).logits - expected).abs().max().item(), 0.1)
+
+        with self.assertRaises(ValueError):
+            chatmodel.load_pretrained('fp16')
+
+
+class IntentTests(TestCase):
+    def setUp(self):
+        self.matcher = IntentMatcher({'refund': ["refund", "want a refund"], 'wrong_drink': ["wrong", "wrong drink", "too sweet"]})
+
+    # The matcher says which intent and phrase it found, ignoring case
+    def testMatch(self):
+        self.assertEqual(self.matcher.match("I WANT A REFUND please"), IntentMatch('refund', "want a refund"))
+        self.assertEqual(self.matcher.match("This is the Wrong Drink"), IntentMatch('wrong_drink', "wrong drink"))
+        self.assertEqual(self.matcher.match("it was too sweet, refund it"), IntentMatch('wrong_drink', "too sweet"))
+        self.assertIsNone(self.matcher.match("what do you recommend?"))
+        self.assertIsNone(self.matcher.match(""))
+
+    # Finds a phrase exactly when scanning every phrase as a substring would
+    def testAgreesWithSubstringScan(self):
+        phrases = [phrase.lower() for phrase in DRINK_MADE_WRONG_PHRASES + REFUND_PHRASES]
+        messages = ["hello", "my drink was made wrong", "Can I get my money back?", "it's missing the lime",
+                    "the soda was flat and warm", "great drink, thanks!", "not what i ordered"]
+        for message in messages:
+            match = complaint_matcher.match(message)
+            self.assertEqual(match is not None, any(phrase in message.lower() for phrase in phrases), message)
+            if match is not None:
+                self.assertIn(match.phrase, message.lower())
+
+    def testChatbotReportsComplaints(self):
+        response = APIClient().post('/backend/chatbot/', {"message": "My drink has the wrong syrup"}, format='json')
+        self.assertEqual(response.json()["state"], "choose")
+
+    # Misspelled complaints, order status questions and small talk are answered without the model
+    def testIntentClassifier(self):
+        phrases, labels = load_phrases()
+        arrays = train_classifier(phrases, labels)
+        classifier = IntentClassifier(arrays)
+
+        # Same probabilities as the scikit-learn model it was exported from
+        from sklearn.feature_extraction.text import TfidfVectorizer
+        from sklearn.linear_model import LogisticRegression
+        vectorizer = TfidfVectorizer(analyzer=char_ngrams, sublinear_tf=True)
+        model = LogisticRegression(C=10.0, max_iter=1000).fit(vectorizer.fit_transform(phrases), labels)
+        for message in ["refnd pls", "wheres my ordr", "helloo", "what should I drink today?"]:
+            probabilities = model.predict_proba(vectorizer.transform([message]))[0]
+            prediction = classifier.predict(message)
+            self.assertEqual(prediction.intent, model.classes_[probabilities.argmax()])
+            self.assertAlmostEqual(prediction.probability, probabilities.max(), places=4)
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'intent_classifier.npz')
+        save_classifier(arrays, path)
+        user = User.objects.create_user(username='user1', password='password123')
+        order = Order.objects.create(UserID=user, OrderStatus='processing')
+        client = APIClient()
+        client.force_authenticate(user)
+        with patch('backend.intents.classifier_path', path), \
+                patch('backend.customerAI.generate_reply', lambda message: "From the model"):
+            def chat(message):
+                return client.post('/backend/chatbot/', {"message": message}, format='json').json()
+
+            self.assertEqual(chat("refnd pls")["state"], "refund_order")
+            self.assertEqual(chat("can u remke my drnk")["state"], "remake_order")
+            self.assertEqual(chat(f"is order {order.OrderID} ready")["responses"], f"Order {order.OrderID} is processing.")
+            # Only the customer's own orders
+            other = Order.objects.create(OrderStatus='processing')
+            self.assertEqual(chat(f"is order {other.OrderID} ready")["responses"], "I'm sorry that order doesn't exist.")
+            self.assertEqual(chat("hellooo")["responses"], SMALL_TALK_REPLIES["greeting"])
+            self.assertEqual(chat("what flavors do you have?")["responses"], ["From the model"])
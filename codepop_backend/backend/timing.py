@@ -0,0 +1,184 @@
+import atexit
+import contextvars
+import json
+import os
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+from django.conf import settings
+
+# Per-stage timers for drink generation, off unless DRINKAI_TIMING is set
+# When off, stage() hands back the same do-nothing context manager, so the timers can stay in hot code
+enabled = getattr(settings, 'DRINKAI_TIMING', False)
+
+# Every process writes its histograms here, the drinkai_timings command merges them
+timing_dir = os.path.join(getattr(settings, 'DRINKAI_CACHE_DIR', os.path.join(settings.BASE_DIR, 'drinkai_cache')), 'timings')
+# How often (in seconds) a process rewrites its histogram file
+flush_interval = getattr(settings, 'DRINKAI_TIMING_FLUSH_INTERVAL', 30)
+
+# Upper bounds of the histogram buckets in milliseconds, one more bucket counts everything slower
+BUCKETS_MS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+class Histogram:
+    """Count of durations per bucket of BUCKETS_MS, plus their total, for one stage."""
+
+    def __init__(self, counts=None, total_ms=0.0):
+        self.counts = list(counts) if counts is not None else [0] * (len(BUCKETS_MS) + 1)
+        self.total_ms = total_ms
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def add(self, ms):
+        self.counts[bisect_left(BUCKETS_MS, ms)] += 1
+        self.total_ms += ms
+
+    def merge(self, other):
+        self.counts = [mine + theirs for mine, theirs in zip(self.counts, other.counts)]
+        self.total_ms += other.total_ms
+
+    def percentile(self, pct):
+        """Upper bound (ms) of the bucket holding the pct-th percentile, inf if it is in the last bucket."""
+        rank = pct / 100 * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS_MS + (float('inf'),), self.counts):
+            seen += count
+            if count and seen >= rank:
+                return bound
+        return 0.0
+
+    def to_dict(self):
+        return {'counts': self.counts, 'total_ms': self.total_ms}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['counts'], data['total_ms'])
+
+
+_disabled = nullcontext()
+# Durations of the stages run for the current request, see collect()
+_request_timings = contextvars.ContextVar('drinkai_request_timings', default=None)
+_histograms = {}
+_lock = threading.Lock()
+_last_flush = time.monotonic()
+# Named when the file is first written, the pid alone could be reused by a later process
+_file_name = None
+
+
+class _Stage:
+    __slots__ = ('name', 'started')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        record(self.name, (time.perf_counter() - self.started) * 1000)
+
+
+def namespace(name):
+    """
+    Return the part of a stage name before ':', e.g. 'chat' for 'chat:first_token'.
+    Drink generation's own stages have no prefix and are in the '' namespace.
+    """
+    return name.partition(':')[0] if ':' in name else ''
+
+
+def stage(name):
+    """Time the with block as stage name (does nothing unless timing is enabled)."""
+    if not enabled:
+        return _disabled
+    return _Stage(name)
+
+
+def record(name, ms):
+    """Add a duration to the stage's histogram, and to the current request's timings if collect() is active."""
+    timings = _request_timings.get()
+    if timings is not None:
+        # A stage that runs several times in one request (e.g. a fallback) adds up
+        timings[name] = timings.get(name, 0.0) + ms
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = Histogram()
+        histogram.add(ms)
+        flush_due = time.monotonic() - _last_flush >= flush_interval
+    if flush_due:
+        flush()
+
+
+@contextmanager
+def collect():
+    """Collect the stage durations (ms) recorded inside the with block into the yielded dict, empty when disabled."""
+    timings = {}
+    if not enabled:
+        yield timings
+        return
+    token = _request_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _request_timings.reset(token)
+
+
+def server_timing_header(timings):
+    """Format collected timings as a Server-Timing header value, browsers show it in their network tools."""
+    return ", ".join(f"{name};dur={ms:.2f}" for name, ms in timings.items())
+
+
+def flush():
+    """Write this process's histograms to its file in timing_dir."""
+    global _last_flush, _file_name
+    with _lock:
+        _last_flush = time.monotonic()
+        if not _histograms:
+            return
+        data = {name: histogram.to_dict() for name, histogram in _histograms.items()}
+        if _file_name is None:
+            _file_name = f"{os.getpid()}-{int(time.time())}.json"
+    try:
+        os.makedirs(timing_dir, exist_ok=True)
+        # Written next to the final file and renamed over it, so a reader never sees half a file
+        fd, tmp_path = tempfile.mkstemp(dir=timing_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as file:
+            json.dump(data, file)
+        os.replace(tmp_path, os.path.join(timing_dir, _file_name))
+    except OSError as e:
+        print(f"Could not write drink generation timings: {e}")
+
+
+def load_histograms(directory=None):
+    """Return {stage: Histogram} merged from every process's file in directory (timing_dir by default)."""
+    directory = directory or timing_dir
+    merged = {}
+    try:
+        names = sorted(os.listdir(directory))
+    except FileNotFoundError:
+        return merged
+    for name in names:
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            continue
+        for stage_name, histogram in data.items():
+            merged.setdefault(stage_name, Histogram()).merge(Histogram.from_dict(histogram))
+    return merged
+
+
+def reset():
+    """Forget this process's histograms (the files already written are left alone)."""
+    with _lock:
+        _histograms.clear()
+
+
+if enabled:
+    atexit.register(flush)
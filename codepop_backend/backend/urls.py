@@ -7,8 +7,8 @@ from .views import DrinkOperations, UserDrinksLookup
 from .views import InventoryListAPIView, InventoryReportAPIView, InventoryUpdateAPIView
 from .views import NotificationOperations, UserNotificationLookup
 from .views import OrderOperations, UserOrdersLookup
-from .customerAI import Chatbot
-from .views import GenerateAIDrink
+from .customerAI import Chatbot, ChatbotStream
+from .views import GenerateAIDrink, PopularItems
 from .views import RevenueViewSet
 from .views import UserOperations
 from .views import emailAPI
@@ -182,15 +182,23 @@ urlpatterns = [
     # Customer Service Chatbot
     # - POST: Send the User response and get back what the chatbot says
     path('chatbot/', Chatbot.as_view(), name='chatbot'),
+    # - POST: Same as chatbot/, but a reply from the model streams back as server-sent events while it is generated
+    path('chatbot/stream/', ChatbotStream.as_view(), name='chatbot_stream'),
     # Endpoint to call the drinkAI when the generate drink button is clicked
     # One for account users and one for general users
     # - GET: Retrive generated-drink information the AI sends back
+    # - Optional ?count=N (1-10): return a list of N distinct drinks generated together
+    # - Optional ?seed=N: same seed and preferences give the same drink(s), for tests and benchmarks
     # For account users: expects a user_id to be provided
     path('generate/<int:user_id>/', GenerateAIDrink.as_view(), name='account_ai_drink'),
     
     # For general users: no user_id provided
     path('generate/', GenerateAIDrink.as_view(), name='general_ai_drink'),
 
+    # Endpoint to get the most popular drinks or ingredients, most completed orders first
+    # - GET: ?type=drinks (default), syrups, sodas or addins, ?limit=N (1-50, default 10), ?days=N (default 30)
+    path('popular/', PopularItems.as_view(), name='popular_items'),
+
     # Revenue related URLs
     # Endpoint to list all revenues or create a new revenue.
     # - GET: Retrieve a list of all revenues.
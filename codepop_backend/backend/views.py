@@ -23,7 +23,10 @@ from django.utils.decorators import method_decorator
 import json
 from rest_framework.decorators import action
 from django.utils.dateparse import parse_datetime
-from .drinkAI import generate_soda
+from .popularity import popular_days, popular_drinks, popular_items, popular_preferences
+from .recommendations import get_user_preferences, recommend
+from .stock import get_stock
+from . import timing
 from rest_framework.permissions import BasePermission
 
 stripe.api_key = settings.STRIPE_SECRET_KEY
@@ -561,42 +564,82 @@ class emailAPI(APIView):
     
 class GenerateAIDrink(APIView):
     permission_classes = [AllowAny]
+    # Upper bound on how many drinks a single request can ask for
+    max_count = 10
+    # Used for general users and for account users without any preferences
+    default_preferences = ["mango", "peach", "vanilla", "salted caramel", "orange", "lavender", "peppermint", "blue raspberry"]
 
     def get(self, request, user_id=None):
-        try:
-            if user_id:
-                # Generate drink for account user
-                response_data = self.generate_account_user(user_id)
-            else:
-                # Generate drink for general user
-                response_data = self.generate_general_user()
-            return Response(response_data)
-        except Exception as e:
-            return Response({'error': str(e)}, status=400)
+        # Optional ?count=N returns a list of N distinct drinks instead of a single drink
+        count = request.query_params.get('count')
+        if count is not None:
+            try:
+                count = int(count)
+            except ValueError:
+                return Response({'error': "'count' must be a whole number."}, status=400)
+            if count < 1 or count > self.max_count:
+                return Response({'error': f"'count' must be between 1 and {self.max_count}."}, status=400)
+
+        # Optional ?seed=N makes the result reproducible, for tests and benchmarks
+        seed = request.query_params.get('seed')
+        if seed is not None:
+            try:
+                seed = int(seed)
+            except ValueError:
+                return Response({'error': "'seed' must be a whole number."}, status=400)
+
+        # With DRINKAI_TIMING on, the time spent in each stage is sent back in a Server-Timing header
+        with timing.collect() as timings:
+            try:
+                with timing.stage('generate_total'):
+                    if user_id:
+                        # Generate drink for account user
+                        response_data = self.generate_account_user(user_id, count, seed)
+                    else:
+                        # Generate drink for general user
+                        response_data = self.generate_general_user(count, seed)
+                response = Response(response_data)
+            except Exception as e:
+                response = Response({'error': str(e)}, status=400)
+        if timings:
+            response['Server-Timing'] = timing.server_timing_header(timings)
+        return response
     
-    def generate_account_user(self, user_id):
+    def generate_account_user(self, user_id, count=None, seed=None):
         """Generate AI drink for a registered user using their preferences."""
-        user = get_object_or_404(User, pk=user_id)
-        preferences = Preference.objects.filter(UserID=user)
-        preferences_list = []
-
-        if preferences.exists():
-            for pref in preferences:
-                preferences_list.append(pref.Preference)
-        else:
-            preferences_list = ["mango", "peach", "vanilla", "salted caramel", "orange", "lavender", "peppermint", "blue raspberry"]
+        # Cached per user, the Preference signal handlers (signals.py) drop the entry when the user's preferences change
+        with timing.stage('preferences'):
+            preferences_list = get_user_preferences(user_id, self.default_preferences)
         print("User") # Test code
-        return self.generate_response_data(preferences_list, user_created=True)
+        return self.generate_response_data(preferences_list, user_created=True, count=count, seed=seed, user_id=user_id)
 
-    def generate_general_user(self):
-        """Generate AI drink for a general user with hardcoded preferences."""
-        preferences = ["mango", "peach", "vanilla", "salted caramel", "orange", "lavender", "peppermint", "blue raspberry"]
+    def generate_general_user(self, count=None, seed=None):
+        """Generate AI drink for a general user from the most popular ingredients (hardcoded preferences until there are orders)."""
         print("General") # Test code
-        return self.generate_response_data(preferences, user_created=False)
-
-    def generate_response_data(self, preferences, user_created):
-        """Helper function to generate response data."""
-        result = generate_soda(preferences)
+        with timing.stage('preferences'):
+            preferences = popular_preferences() or self.default_preferences
+        return self.generate_response_data(preferences, user_created=False, count=count, seed=seed,
+                                           fallback_preferences=self.default_preferences)
+
+    def generate_response_data(self, preferences, user_created, count=None, seed=None, user_id=None, fallback_preferences=None):
+        """Helper function to generate response data, a list of drinks when a count is given.
+        fallback_preferences are used if no drink can be made from preferences."""
+        # Cached stock, so nothing that is out of stock gets recommended without querying Inventory every request
+        with timing.stage('stock'):
+            stock = get_stock()
+        # Drinks are sampled from a pool generated once per preference set (or generated from the seed)
+        # Account users are also steered by their order history once build_cf_embeddings has run
+        with timing.stage('recommend'):
+            results = recommend(preferences, count or 1, stock, seed, user_id)
+            if not results and fallback_preferences is not None:
+                results = recommend(fallback_preferences, count or 1, stock, seed, user_id)
+        if count is not None:
+            return [self.format_drink(result, user_created) for result in results]
+        result = results[0] if results else {}
+        return self.format_drink(result, user_created)
+
+    def format_drink(self, result, user_created):
+        """Shape a generated drink the way the app expects it."""
         return {
             'SyrupsUsed': result["syrups"],
             'SodaUsed': result["soda"][0],
@@ -607,6 +650,33 @@ class GenerateAIDrink(APIView):
         }
 
 
+class PopularItems(APIView):
+    permission_classes = [AllowAny]
+    # ?type= value -> Popularity ItemType
+    item_types = {'drinks': 'Drink', 'syrups': 'Syrup', 'sodas': 'Soda', 'addins': 'Add In'}
+    max_limit = 50
+
+    def get(self, request):
+        item_type = self.item_types.get(request.query_params.get('type', 'drinks'))
+        if item_type is None:
+            return Response({'error': f"'type' must be one of {', '.join(self.item_types)}."}, status=400)
+        try:
+            limit = int(request.query_params.get('limit', 10))
+            days = int(request.query_params.get('days', popular_days))
+        except ValueError:
+            return Response({'error': "'limit' and 'days' must be whole numbers."}, status=400)
+        if limit < 1 or limit > self.max_limit or days < 1:
+            return Response({'error': f"'limit' must be between 1 and {self.max_limit} and 'days' at least 1."}, status=400)
+
+        # Read from the Popularity rollup, not from the orders themselves
+        if item_type == 'Drink':
+            return Response([
+                {'Drink': DrinkSerializer(drink).data, 'Ordered': counts['Ordered'], 'Completed': counts['Completed']}
+                for drink, counts in popular_drinks(limit, days)
+            ])
+        return Response(popular_items(item_type, limit, days))
+
+
 class RevenueViewSet(viewsets.ModelViewSet):
     """
     A viewset for listing, retrieving, creating, and filtering revenue records.
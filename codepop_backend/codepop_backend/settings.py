@@ -26,6 +26,59 @@ SECRET_KEY = 'django-insecure-20c3kbxd-=q$-6^1^i@6u)jklu(js%g87$9sko85kirto!8afv
 STRIPE_SECRET_KEY = 'TODO: get a new secret stripe key'
 STRIPE_PUBLISHABLE_KEY = 'TODO: get a new publishable stripe key'
 
+# Drink AI Configuration
+# Seconds between checks of Syrups.csv / Sodas.csv / AddIns.csv for edits (the catalog reloads itself in the background)
+DRINKAI_CATALOG_CHECK_INTERVAL = 5
+# Seconds the cached out of stock items can be reused before Inventory is read again (saves in this process refresh it right away)
+DRINKAI_STOCK_TTL = 30
+# Drinks generated up front per preference set, /generate/ samples from them
+DRINKAI_CANDIDATE_POOL_SIZE = 20
+# Entries of the per-user preference and candidate pool caches, and lifetime (seconds) of the candidate pools
+DRINKAI_RECOMMENDATION_CACHE_SIZE = 1024
+DRINKAI_RECOMMENDATION_CACHE_TTL = 300
+# Seconds a user's cached preferences can be reused (saves in this process drop them right away, other worker processes see them after at most this long)
+DRINKAI_PREFERENCE_CACHE_TTL = 5
+# Drinks kept ready per active user (and for general users), refilled by a background thread, 0 turns it off
+DRINKAI_PREGEN_QUEUE_SIZE = 5
+# Generated files (collaborative filtering embeddings, precomputed flavor matrices), rebuilt by management commands and not checked in
+DRINKAI_CACHE_DIR = BASE_DIR / 'drinkai_cache'
+# Vector length for build_cf_embeddings, and how much the embeddings can move the flavor ranking (0 turns them off)
+DRINKAI_CF_COMPONENTS = 16
+DRINKAI_CF_WEIGHT = 0.3
+# Days of order counts /popular/ and the general user drink look back over
+DRINKAI_POPULAR_DAYS = 30
+# Per-stage timers for drink generation: a Server-Timing header on /generate/ and histograms read by drinkai_timings
+# Each process rewrites its histogram file in DRINKAI_CACHE_DIR/timings every DRINKAI_TIMING_FLUSH_INTERVAL seconds
+DRINKAI_TIMING = False
+DRINKAI_TIMING_FLUSH_INTERVAL = 30
+
+# Customer Service Chatbot Configuration
+CHATBOT_MODEL_NAME = 'microsoft/DialoGPT-medium'
+# 'fp32' runs the model as downloaded, 'int8' quantizes its linear layers when loading it (smaller and faster on CPU),
+# compare them with the bench_chatbot_backends command
+CHATBOT_INFERENCE_BACKEND = 'fp32'
+# Unix socket path (e.g. str(BASE_DIR / 'chatbot.sock'), only the user running the server can connect) or
+# "127.0.0.1:port" of run_chatbot_server, never an address other machines can reach
+# Both sides also need the CHATBOT_INFERENCE_AUTHKEY environment variable
+# None loads the model in every web worker instead, on its first chat message that needs it
+CHATBOT_INFERENCE_ADDRESS = None
+# Chat messages arriving within this many milliseconds of each other run through the model as one batch (0 turns it off)
+CHATBOT_BATCH_WINDOW_MS = 5
+CHATBOT_MAX_BATCH_SIZE = 16
+# Most tokens the model generates for one reply (None lets it run up to 1000 tokens including the message)
+CHATBOT_MAX_NEW_TOKENS = 128
+# Replies kept for repeated messages (greetings, store hours...): messages remembered, seconds a reply is reused,
+# and replies the model generates per message before they are reused at random (0 turns the cache off)
+CHATBOT_CACHE_SIZE = 512
+CHATBOT_CACHE_TTL = 3600
+CHATBOT_CACHE_REPLIES = 3
+# Least probability the intent classifier (built by train_intent_classifier) needs to answer a message itself
+# (refunds, remakes, order status, greetings) instead of the model
+CHATBOT_INTENT_THRESHOLD = 0.5
+# Seconds a chatbot conversation (where it is in a refund or remake) is kept after its last message
+# Conversations live in Django's cache, with more than one web worker CACHES must be shared between them (e.g. Redis)
+CHATBOT_SESSION_TTL = 1800
+
 
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = True